@@ -12,4 +12,7 @@
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 # GNU General Public License for more details.
 
-__all__ = ["multifile", "targetconfig", "vidparse", "errors"]
\ No newline at end of file
+__all__ = ["calibrate", "catalog", "checkpoint", "decodecaps", "library",
+           "multifile", "passcache", "pipeline", "plan", "probecache",
+           "procgraph", "progress", "segment", "streamout", "targetconfig",
+           "vidparse", "errors"]
\ No newline at end of file
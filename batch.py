@@ -0,0 +1,342 @@
+#!/usr/bin/python
+# Mark's Media Framework
+# Copyright (C) 2011  Mark Pariente
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+import ctypes
+import ctypes.util
+import json
+import optparse
+import os
+import os.path
+import shlex
+import signal
+import subprocess
+import sys
+import time
+
+from mmf import errors
+from mmf import transcode
+
+DEFAULT_JOB_COUNT = 2 # Jobs running concurrently
+_POLL_INTERVAL = 0.5 # Seconds between checks on running jobs
+KILL_GRACE = 10.0 # Seconds a job gets to wind down before SIGKILL
+
+STATUS_PENDING = "pending"
+STATUS_RUNNING = "running"
+STATUS_OK = "ok"
+STATUS_FAILED = "failed"
+STATUS_INVALID = "invalid"
+
+# Runs transcode.main() in a fresh interpreter with the remaining arguments
+_TRANSCODE_CMD = [sys.executable, "-c",
+                  "from mmf import transcode; transcode.main()"]
+
+_PR_SET_PDEATHSIG = 1
+
+def _load_prctl():
+    """Returns the C library's prctl() on Linux, or None"""
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        return ctypes.CDLL(ctypes.util.find_library("c")).prctl
+    except (OSError, AttributeError):
+        return None
+
+_prctl = _load_prctl()
+
+def _setup_job_process():
+    """
+    Runs in the forked job process before mmfxcode starts. The job leads its
+    own process group so that BatchJob.kill() reaches its encoders, and gets
+    SIGTERM when the scheduler or spool worker running it dies.
+    """
+    os.setsid()
+    if _prctl is not None:
+        _prctl(_PR_SET_PDEATHSIG, signal.SIGTERM)
+
+def read_manifest(manifest_file):
+    """
+    Reads a job manifest and returns a list of BatchJob objects. Each
+    non-empty line that isn't a '#' comment holds the mmfxcode arguments
+    (options, targets and input files) for one job. A row repeating an
+    earlier one, which would share its working directory, or writing an
+    output file of an earlier one is invalid.
+    """
+    job_list = []
+    job_by_args = {}
+    job_by_output = {}
+    try:
+        cur_file = open(manifest_file, 'r')
+    except IOError as e:
+        raise errors.MMFError("Failed to open job manifest '%s': %s" %
+                              (manifest_file, e.strerror))
+    for line in cur_file:
+        line = line.strip()
+        if line == "" or line.startswith("#"):
+            continue
+        job = BatchJob(len(job_list), shlex.split(line))
+        job_list.append(job)
+        if job.status == STATUS_INVALID:
+            continue
+        args_key = tuple(job.args)
+        if args_key in job_by_args:
+            job.set_invalid("Same as job %d" % job_by_args[args_key])
+            continue
+        job_by_args[args_key] = job.job_id
+        for output_path in job.output_list:
+            output_path = os.path.abspath(output_path)
+            if output_path in job_by_output:
+                job.set_invalid("Writes '%s' like job %d" %
+                                (output_path, job_by_output[output_path]))
+                break
+        else:
+            for output_path in job.output_list:
+                job_by_output[os.path.abspath(output_path)] = job.job_id
+    cur_file.close()
+    return job_list
+
+def _read_bytes_read(log_file):
+    """
+    Returns the input bytes read reported in a job's log, or None if the job
+    didn't report it
+    """
+    bytes_read = None
+    try:
+        log_fd = open(log_file, 'r')
+    except IOError:
+        return None
+    for line in log_fd:
+        if line.startswith(transcode.INPUT_BYTES_READ_PREFIX):
+            bytes_read = int(line[len(transcode.INPUT_BYTES_READ_PREFIX):]
+                             .split()[0])
+    log_fd.close()
+    return bytes_read
+
+class BatchJob:
+    """A single mmfxcode job of a batch"""
+
+    def __init__(self, job_id, args, work_dir = None):
+        """
+        Creates a job running mmfxcode with the given arguments. Relative
+        paths in the arguments are resolved against work_dir, which defaults
+        to the current directory.
+        """
+        self.job_id = job_id
+        self.args = args
+        self.work_dir = work_dir
+        self.status = STATUS_PENDING
+        self.returncode = None
+        self.wall_time = None
+        self.log_file = None
+        self.bytes_read = None
+        self.error = None
+        self._proc = None
+        self._start_time = None
+
+        # Validate the arguments up front so bad rows fail before any work
+        optparser = transcode.make_option_parser()
+        optparser.error = self._parse_error
+        try:
+            (options, extra_args) = optparser.parse_args(args)
+            if (options.target_strings is None and
+                options.device_class is None):
+                raise errors.MMFError("No target specified")
+            if len(extra_args) == 0:
+                raise errors.MMFError("No input file specified")
+            self.output_list = transcode.get_output_list(options,
+                                                         work_dir or "")
+        except errors.MMFError as e:
+            self.set_invalid(e.msg)
+
+    def set_invalid(self, error):
+        """Marks the job as one that won't be run, for the given reason"""
+        self.status = STATUS_INVALID
+        self.error = error
+        self.output_list = []
+
+    def _parse_error(self, msg):
+        raise errors.MMFError(msg)
+
+    def start(self, log_dir):
+        """Starts the job in its own process, logging to log_dir"""
+        self.log_file = os.path.join(log_dir, "job-%s.log" % self.job_id)
+        log_fd = open(self.log_file, 'w')
+        self._start_time = time.time()
+        self._proc = subprocess.Popen(_TRANSCODE_CMD + self.args,
+                                      stdout = log_fd,
+                                      stderr = subprocess.STDOUT,
+                                      cwd = self.work_dir,
+                                      preexec_fn = _setup_job_process)
+        log_fd.close()
+        self.status = STATUS_RUNNING
+
+    def poll(self):
+        """Updates the job status, returns True if the job has finished"""
+        if self._proc is None or self._proc.poll() is None:
+            return False
+        self.wall_time = time.time() - self._start_time
+        self.returncode = self._proc.returncode
+        self.bytes_read = _read_bytes_read(self.log_file)
+        if self.returncode == 0:
+            self.status = STATUS_OK
+        else:
+            self.status = STATUS_FAILED
+        self._proc = None
+        return True
+
+    def _signal_group(self, signum):
+        try:
+            os.killpg(self._proc.pid, signum)
+        except OSError:
+            # Everything in the group has exited already
+            pass
+
+    def kill(self):
+        """
+        Kills the job if it's running. The job gets SIGTERM first, which has
+        mmfxcode terminate its encoders and keep its checkpoints, and after
+        KILL_GRACE seconds whatever is left of its process group is killed.
+        """
+        if self._proc is not None:
+            self._signal_group(signal.SIGTERM)
+            deadline = time.time() + KILL_GRACE
+            while self._proc.poll() is None and time.time() < deadline:
+                time.sleep(0.1)
+            self._signal_group(signal.SIGKILL)
+            self._proc.wait()
+            self._proc = None
+            self.status = STATUS_FAILED
+
+    def output_size(self):
+        """Returns the total size in bytes of the job's outputs"""
+        size = 0
+        for output_path in self.output_list:
+            if os.path.isfile(output_path):
+                size += os.path.getsize(output_path)
+        return size
+
+    def get_summary(self):
+        """Returns a dict summarizing the job's result"""
+        return {"job": self.job_id,
+                "args": self.args,
+                "status": self.status,
+                "returncode": self.returncode,
+                "wall_time": self.wall_time,
+                "outputs": self.output_list,
+                "output_size": self.output_size(),
+                "bytes_read": self.bytes_read,
+                "log_file": self.log_file,
+                "error": self.error}
+
+class Scheduler:
+    """Runs batch jobs with a bound on the number of concurrent jobs"""
+
+    def __init__(self, job_list, job_count = DEFAULT_JOB_COUNT,
+                 log_dir = None):
+        self.job_list = job_list
+        self.job_count = max(1, job_count)
+        self.log_dir = log_dir
+
+    def run(self):
+        """Runs all valid jobs to completion"""
+        pending = [job for job in self.job_list
+                   if job.status == STATUS_PENDING]
+        running = []
+        try:
+            while len(pending) > 0 or len(running) > 0:
+                while len(pending) > 0 and len(running) < self.job_count:
+                    job = pending.pop(0)
+                    print "Starting job %d: %s" % (job.job_id,
+                                                   " ".join(job.args))
+                    job.start(self.log_dir)
+                    running.append(job)
+
+                time.sleep(_POLL_INTERVAL)
+
+                for job in list(running):
+                    if job.poll():
+                        running.remove(job)
+                        print "Job %d %s in %.1f seconds" % (job.job_id,
+                                                             job.status,
+                                                             job.wall_time)
+        except KeyboardInterrupt:
+            for job in running:
+                job.kill()
+            raise
+
+    def get_summary(self):
+        """Returns a list of per-job summary dicts"""
+        return [job.get_summary() for job in self.job_list]
+
+    def __repr__(self):
+        retStr = "\n%-5s %-8s %10s %14s  %s\n" % ("Job", "Status",
+                                                  "Time (s)", "Output (B)",
+                                                  "Outputs")
+        for job in self.job_list:
+            if job.wall_time is None:
+                wall_time_str = "-"
+            else:
+                wall_time_str = "%.1f" % job.wall_time
+            retStr += "%-5d %-8s %10s %14d  %s\n" % (job.job_id, job.status,
+                                                     wall_time_str,
+                                                     job.output_size(),
+                                                     " ".join(job.output_list))
+            if job.error is not None:
+                retStr += "\t%s\n" % job.error
+        return retStr
+
+def main(argv = sys.argv):
+    optparser = optparse.OptionParser(
+        usage = "%prog [options] manifest\n\nEach line of the manifest holds \
+the mmfxcode arguments for one job.")
+    optparser.add_option(
+        "-j", "--jobs", type="int", dest="job_count",
+        default=DEFAULT_JOB_COUNT,
+        help="Number of jobs to run concurrently (default %default)")
+    optparser.add_option(
+        "-l", "--log-dir", action="store", type="string", dest="log_dir",
+        help="Directory for per-job logs (defaults to <manifest>.logs)")
+    optparser.add_option(
+        "-s", "--summary", action="store", type="string", dest="summary_file",
+        help="Write a JSON summary of all jobs to this file")
+    (options, extra_args) = optparser.parse_args(argv[1:])
+
+    if len(extra_args) != 1:
+        print "No job manifest specified, exiting."
+        sys.exit(1)
+
+    try:
+        job_list = read_manifest(extra_args[0])
+    except errors.MMFError as e:
+        print e.msg
+        sys.exit(1)
+
+    if options.log_dir is None:
+        log_dir = os.path.abspath(extra_args[0]) + ".logs"
+    else:
+        log_dir = os.path.abspath(options.log_dir)
+    if not os.path.isdir(log_dir):
+        os.makedirs(log_dir)
+
+    scheduler = Scheduler(job_list, options.job_count, log_dir)
+    scheduler.run()
+    print scheduler
+
+    if options.summary_file is not None:
+        summary_fd = open(options.summary_file, 'w')
+        json.dump(scheduler.get_summary(), summary_fd, indent = 2)
+        summary_fd.close()
+
+    for job in job_list:
+        if job.status != STATUS_OK:
+            sys.exit(1)
@@ -0,0 +1,101 @@
+#!/usr/bin/python
+# Mark's Media Framework
+# Copyright (C) 2011  Mark Pariente
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Measures MultiFileInput.write_all() throughput in MB/s into a consumer
+# process for the kernel side and buffered copy paths at various chunk sizes.
+
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from mmf import multifile
+
+class _RawInput(multifile.MultiFileInput):
+    """MultiFileInput that skips mediainfo validation of the input files"""
+
+    def _validate_list(self, file_list):
+        pass
+
+def _make_files(temp_dir, file_count, file_size):
+    """Creates file_count files of file_size bytes and returns their paths"""
+    block = os.urandom(1024 * 1024)
+    file_list = []
+    for i in range(file_count):
+        file_name = os.path.join(temp_dir, "input-%d.bin" % i)
+        cur_file = open(file_name, 'wb')
+        remaining = file_size
+        while remaining > 0:
+            cur_file.write(block[:min(remaining, len(block))])
+            remaining -= len(block)
+        cur_file.close()
+        file_list.append(file_name)
+    return file_list
+
+def run(file_list, chunk_size, zero_copy, consumer):
+    """Streams all files into a consumer process, returns MB/s"""
+    input_files = _RawInput(file_list, chunk_size = chunk_size,
+                            zero_copy = zero_copy)
+    total_size = sum(os.path.getsize(file_name) for file_name in file_list)
+    sink = subprocess.Popen(consumer, stdin = subprocess.PIPE)
+    input_files.set_output(sink.stdin)
+    start = time.time()
+    input_files.write_all()
+    sink.wait()
+    elapsed = time.time() - start
+    return total_size / (1024.0 * 1024.0) / elapsed
+
+def main(argv = sys.argv):
+    optparser = optparse.OptionParser()
+    optparser.add_option(
+        "-n", "--file-count", type="int", dest="file_count", default=4,
+        help="Number of input files (default %default)")
+    optparser.add_option(
+        "-s", "--file-size", type="int", dest="file_size", default=256,
+        help="Size of each input file in MB (default %default)")
+    optparser.add_option(
+        "-r", "--repeat", type="int", dest="repeat", default=3,
+        help="Runs per configuration, best one is reported (default %default)")
+    optparser.add_option(
+        "-c", "--consumer", action="store", type="string", dest="consumer",
+        default="cat > /dev/null",
+        help="Shell command consuming the stream (default '%default')")
+    (options, extra_args) = optparser.parse_args(argv[1:])
+
+    configs = [("buffered", 4 * 1024, False),
+               ("buffered", multifile.DEFAULT_CHUNK_SIZE, False)]
+    if multifile.zero_copy_supported():
+        configs.append(("zero-copy", multifile.DEFAULT_CHUNK_SIZE, True))
+    else:
+        print "Kernel side copy not supported on this platform"
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        file_list = _make_files(temp_dir, options.file_count,
+                                options.file_size * 1024 * 1024)
+        consumer = ["/bin/sh", "-c", options.consumer]
+        for (mode, chunk_size, zero_copy) in configs:
+            best = max(run(file_list, chunk_size, zero_copy, consumer)
+                       for i in range(options.repeat))
+            print "%-10s %8d KB chunks: %10.1f MB/s" % (mode,
+                                                        chunk_size / 1024,
+                                                        best)
+    finally:
+        shutil.rmtree(temp_dir)
+
+if __name__ == "__main__":
+    main()
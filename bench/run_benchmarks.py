@@ -0,0 +1,403 @@
+#!/usr/bin/python
+# Mark's Media Framework
+# Copyright (C) 2011  Mark Pariente
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Benchmarks of the probe, plan and I/O hot paths. mediainfo and ffmpeg are
+# replaced by the stand-ins in bench/fakebin replaying the recorded output
+# in bench/fixtures, so that the numbers measure our own code and are
+# comparable across machines without media files. Real encodes of
+# synthetic lavfi sources can be added with --real.
+#
+# Results are printed and written as JSON with --output. --check compares
+# them against the bounds in thresholds.json and, with --baseline, against
+# an earlier results file, exiting with status 1 on any regression.
+
+import json
+import optparse
+import os
+import os.path
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from mmf import errors
+from mmf import multifile
+from mmf import plan
+from mmf import targetconfig
+from mmf import vidparse
+
+import multifile_throughput
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURE_DIR = os.path.join(BENCH_DIR, "fixtures")
+FAKEBIN_DIR = os.path.join(BENCH_DIR, "fakebin")
+INSTALL_DIR = os.path.dirname(BENCH_DIR)
+THRESHOLDS_FILE = os.path.join(BENCH_DIR, "thresholds.json")
+
+FIXTURES = ["h264-aac", "mpeg2-interlaced"]
+BENCH_TARGETS = ["iphone4", "1080p-mp4-h264-aac"]
+DEFAULT_TOLERANCE = 0.25 # Allowed slowdown against a baseline
+
+_TRANSCODE_CMD = [sys.executable, "-c",
+                  "from mmf import transcode; transcode.main()"]
+_REAL_DURATION = 10 # Seconds of synthetic source for real encodes
+_REAL_FPS = 25
+
+def _read_fixture(fixture, extension):
+    fixture_fd = open(os.path.join(FIXTURE_DIR, fixture + extension), 'r')
+    output = fixture_fd.read()
+    fixture_fd.close()
+    return output
+
+def _make_inputs(temp_dir, file_count, file_size = 0, fixtures = FIXTURES):
+    """
+    Creates input files named after the given fixtures in turn, so the
+    stand-in mediainfo reports each file with its fixture
+    """
+    file_list = []
+    for i in range(file_count):
+        fixture = fixtures[i % len(fixtures)]
+        file_name = os.path.join(temp_dir, "input-%d-%s.mkv" % (i, fixture))
+        cur_file = open(file_name, 'wb')
+        cur_file.write("\0" * file_size)
+        cur_file.close()
+        file_list.append(file_name)
+    return file_list
+
+def _make_env(temp_dir, fake = True):
+    """Returns the environment for benchmarked processes"""
+    env = dict(os.environ)
+    if fake:
+        env["PATH"] = FAKEBIN_DIR + os.pathsep + env.get("PATH", "")
+    env[targetconfig.INSTALL_ENV_VAR] = INSTALL_DIR
+    # Caches would turn repeated runs into lookups
+    env["MMF_CACHE_DIR"] = os.path.join(temp_dir, "cache")
+    env["MMF_NO_PROBE_CACHE"] = "1"
+    env["MMF_NO_PASS_CACHE"] = "1"
+    return env
+
+def _best_time(func, repeat):
+    """Runs func() repeat times, returns the shortest wall time"""
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+class BenchResults:
+    """Named benchmark results with their units and direction"""
+
+    def __init__(self):
+        self.results = {}
+
+    def add(self, name, value, unit, higher_is_better = True):
+        self.results[name] = {"value": value,
+                              "unit": unit,
+                              "higher_is_better": higher_is_better}
+
+    def check_thresholds(self, thresholds):
+        """
+        Returns a list of failure messages for results outside the "min" or
+        "max" bound given for them in thresholds
+        """
+        failures = []
+        for (name, bounds) in sorted(thresholds.items()):
+            if name not in self.results:
+                continue
+            value = self.results[name]["value"]
+            if "min" in bounds and value < bounds["min"]:
+                failures.append("%s: %.3f below minimum %.3f" %
+                                (name, value, bounds["min"]))
+            if "max" in bounds and value > bounds["max"]:
+                failures.append("%s: %.3f above maximum %.3f" %
+                                (name, value, bounds["max"]))
+        return failures
+
+    def check_baseline(self, baseline, tolerance):
+        """
+        Returns a list of failure messages for results more than tolerance
+        (a fraction) worse than the same result in an earlier summary
+        """
+        failures = []
+        for (name, result) in sorted(self.results.items()):
+            if name not in baseline.get("results", {}):
+                continue
+            base_value = baseline["results"][name]["value"]
+            value = result["value"]
+            if result["higher_is_better"]:
+                regressed = value < base_value * (1.0 - tolerance)
+            else:
+                regressed = value > base_value * (1.0 + tolerance)
+            if regressed:
+                failures.append("%s: %.3f against baseline %.3f" %
+                                (name, value, base_value))
+        return failures
+
+    def get_summary(self):
+        """Returns a dict of the results and the machine they came from"""
+        return {"time": time.time(),
+                "host": platform.node(),
+                "machine": platform.machine(),
+                "python": platform.python_version(),
+                "results": self.results}
+
+    def __repr__(self):
+        retStr = "\n%-34s %14s  %s\n" % ("Benchmark", "Result", "Unit")
+        for (name, result) in sorted(self.results.items()):
+            retStr += "%-34s %14.3f  %s\n" % (name, result["value"],
+                                             result["unit"])
+        return retStr
+
+def bench_probe(results, temp_dir, file_count, repeat):
+    """Measures mediainfo output parsing, probing and planning"""
+    parse_count = 1000
+    file_list = _make_inputs(temp_dir, file_count)
+    target_list = [targetconfig.TargetConfig(target)
+                   for target in BENCH_TARGETS]
+
+    saved_path = os.environ.get("PATH", "")
+    os.environ["PATH"] = FAKEBIN_DIR + os.pathsep + saved_path
+    try:
+        parser_list = vidparse.probe_batch(file_list)
+
+        # Parsing alone, without the mediainfo runs
+        for fixture in FIXTURES:
+            text_output = _read_fixture(fixture, ".txt")
+            json_output = _read_fixture(fixture, ".json")
+            parser = parser_list[FIXTURES.index(fixture)]
+
+            def parse_text():
+                for i in range(parse_count):
+                    parser._parse_text(text_output)
+            def parse_json():
+                for i in range(parse_count):
+                    vidparse._parse_json_media(
+                        json.loads(json_output)["media"])
+
+            results.add("probe.parse_text.%s" % fixture,
+                        parse_count / _best_time(parse_text, repeat),
+                        "parses/s")
+            results.add("probe.parse_json.%s" % fixture,
+                        parse_count / _best_time(parse_json, repeat),
+                        "parses/s")
+
+        def probe_single():
+            for file_name in file_list:
+                vidparse.VidParser(file_name)
+        def probe_batch():
+            vidparse.probe_batch(file_list)
+        def plan_single():
+            for i in range(parse_count / len(parser_list)):
+                for parser in parser_list:
+                    for target_config in target_list:
+                        plan.plan_transcode(parser, target_config)
+        def plan_library():
+            plan.plan_library(file_list, target_list)
+
+        results.add("probe.single", file_count /
+                    _best_time(probe_single, repeat), "files/s")
+        results.add("probe.batch", file_count /
+                    _best_time(probe_batch, repeat), "files/s")
+        results.add("plan.transcode", parse_count * len(target_list) /
+                    _best_time(plan_single, repeat), "plans/s")
+        results.add("plan.library", file_count * len(target_list) /
+                    _best_time(plan_library, repeat), "plans/s")
+    finally:
+        os.environ["PATH"] = saved_path
+        for file_name in file_list:
+            os.remove(file_name)
+
+def bench_concat(results, temp_dir, file_count, file_size, repeat):
+    """Measures MultiFileInput.write_all() throughput into a pipe"""
+    file_list = multifile_throughput._make_files(temp_dir, file_count,
+                                                 file_size * 1024 * 1024)
+    consumer = ["/bin/sh", "-c", "cat > /dev/null"]
+    configs = [("concat.buffered", False)]
+    if multifile.zero_copy_supported():
+        configs.append(("concat.zero_copy", True))
+    try:
+        for (name, zero_copy) in configs:
+            best = max(multifile_throughput.run(file_list,
+                                                multifile.DEFAULT_CHUNK_SIZE,
+                                                zero_copy, consumer)
+                       for i in range(repeat))
+            results.add(name, best, "MB/s")
+    finally:
+        for file_name in file_list:
+            os.remove(file_name)
+
+def _run_transcode(args, temp_dir, env):
+    """Runs mmfxcode to completion, returns its wall time"""
+    log_fd = open(os.path.join(temp_dir, "transcode.log"), 'w')
+    start = time.time()
+    returncode = subprocess.call(_TRANSCODE_CMD + args, stdout = log_fd,
+                                 stderr = subprocess.STDOUT, cwd = temp_dir,
+                                 env = env)
+    elapsed = time.time() - start
+    log_fd.close()
+    if returncode != 0:
+        raise errors.MMFError("mmfxcode %s failed, see %s" %
+                              (" ".join(args),
+                               os.path.join(temp_dir, "transcode.log")))
+    return elapsed
+
+def bench_orchestration(results, temp_dir, repeat):
+    """
+    Measures the wall time of whole mmfxcode runs against the stand-in
+    ffmpeg, which leaves only our own process and pipe handling
+    """
+    env = _make_env(temp_dir)
+    # Concatenated inputs have to match
+    input_list = _make_inputs(temp_dir, 3, 1024 * 1024, FIXTURES[:1])
+    output = os.path.join(temp_dir, "output.mp4")
+    cases = [("xcode.single", ["-t", BENCH_TARGETS[0], "-o", output,
+                               input_list[0]]),
+             ("xcode.double_pass", ["-2", "-t", BENCH_TARGETS[0],
+                                    "-o", output, input_list[0]]),
+             ("xcode.concat_pipe", ["-t", BENCH_TARGETS[0], "-o", output] +
+              input_list),
+             ("xcode.segmented", ["--segments", "4", "-t", BENCH_TARGETS[0],
+                                  "-o", output, input_list[0]]),
+             ("xcode.plan_only", ["--plan-only", "-t", BENCH_TARGETS[0],
+                                  "-t", BENCH_TARGETS[1]] + input_list)]
+    for (name, args) in cases:
+        best = min(_run_transcode(args, temp_dir, env)
+                   for i in range(repeat))
+        results.add(name, best, "s", False)
+
+def _find_executable(name):
+    for path_dir in os.environ.get("PATH", "").split(os.pathsep):
+        path = os.path.join(path_dir, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+def bench_real(results, temp_dir):
+    """Measures real encodes of a synthetic lavfi test source"""
+    for tool in ("ffmpeg", "mediainfo"):
+        if _find_executable(tool) is None:
+            print "No %s found, skipping real encodes" % tool
+            return
+
+    source = os.path.join(temp_dir, "lavfi-source.mkv")
+    returncode = subprocess.call(
+        ["ffmpeg", "-v", "error", "-y",
+         "-f", "lavfi", "-i", "testsrc=duration=%d:size=1280x720:rate=%d" %
+         (_REAL_DURATION, _REAL_FPS),
+         "-f", "lavfi", "-i", "sine=frequency=1000:duration=%d" %
+         _REAL_DURATION,
+         "-c:v", "libx264", "-preset", "ultrafast", "-c:a", "ac3",
+         source])
+    if returncode != 0:
+        print "Failed to generate the lavfi source, skipping real encodes"
+        return
+
+    env = _make_env(temp_dir, False)
+    output = os.path.join(temp_dir, "output.mp4")
+    frame_count = _REAL_DURATION * _REAL_FPS
+    for (name, args) in [("real.single", []), ("real.double_pass", ["-2"])]:
+        elapsed = _run_transcode(args + ["-t", BENCH_TARGETS[0],
+                                         "-o", output, source],
+                                 temp_dir, env)
+        results.add(name, frame_count / elapsed, "frames/s")
+
+def main(argv = sys.argv):
+    optparser = optparse.OptionParser()
+    optparser.add_option(
+        "-o", "--output", action="store", type="string", dest="output_file",
+        help="Write the results as JSON to this file")
+    optparser.add_option(
+        "-r", "--repeat", type="int", dest="repeat", default=3,
+        help="Runs per benchmark, best one is reported (default %default)")
+    optparser.add_option(
+        "-n", "--file-count", type="int", dest="file_count", default=64,
+        help="Number of input files for probe benchmarks (default %default)")
+    optparser.add_option(
+        "-s", "--file-size", type="int", dest="file_size", default=64,
+        help="Size of each concat input file in MB (default %default)")
+    optparser.add_option(
+        "--only", action="append", type="choice", dest="only",
+        choices=["probe", "concat", "orchestration"],
+        help="Run only this group of benchmarks, can be given multiple times")
+    optparser.add_option(
+        "--real", action = "store_true", dest="real",
+        help="Also run real encodes of lavfi sources with ffmpeg from PATH")
+    optparser.add_option(
+        "--check", action = "store_true", dest="check",
+        help="Exit with status 1 if any result is outside the bounds in \
+thresholds.json")
+    optparser.add_option(
+        "--thresholds", action="store", type="string", dest="thresholds_file",
+        default=THRESHOLDS_FILE,
+        help="Threshold file used by --check (default %default)")
+    optparser.add_option(
+        "--baseline", action="store", type="string", dest="baseline_file",
+        help="Results file of an earlier run to compare against with --check")
+    optparser.add_option(
+        "--tolerance", type="float", dest="tolerance",
+        default=DEFAULT_TOLERANCE,
+        help="Fraction a result may be worse than the baseline \
+(default %default)")
+    (options, extra_args) = optparser.parse_args(argv[1:])
+
+    groups = options.only or ["probe", "concat", "orchestration"]
+    # Target files are found through the install directory in-process too
+    os.environ[targetconfig.INSTALL_ENV_VAR] = INSTALL_DIR
+    results = BenchResults()
+    temp_dir = tempfile.mkdtemp(prefix = "mmfbench-")
+    try:
+        if "probe" in groups:
+            bench_probe(results, temp_dir, options.file_count, options.repeat)
+        if "concat" in groups:
+            bench_concat(results, temp_dir, 4, options.file_size,
+                         options.repeat)
+        if "orchestration" in groups:
+            bench_orchestration(results, temp_dir, options.repeat)
+        if options.real:
+            bench_real(results, temp_dir)
+    except errors.MMFError as e:
+        print e.msg
+        sys.exit(1)
+    finally:
+        shutil.rmtree(temp_dir, True)
+
+    print results
+    summary = results.get_summary()
+    if options.output_file is not None:
+        output_fd = open(options.output_file, 'w')
+        json.dump(summary, output_fd, indent = 2, sort_keys = True)
+        output_fd.close()
+
+    if not options.check:
+        return
+    thresholds_fd = open(options.thresholds_file, 'r')
+    failures = results.check_thresholds(json.load(thresholds_fd))
+    thresholds_fd.close()
+    if options.baseline_file is not None:
+        baseline_fd = open(options.baseline_file, 'r')
+        failures += results.check_baseline(json.load(baseline_fd),
+                                           options.tolerance)
+        baseline_fd.close()
+    for failure in failures:
+        print "REGRESSION: " + failure
+    if len(failures) > 0:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+#!/usr/bin/python
+# Mark's Media Framework
+# Copyright (C) 2011  Mark Pariente
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Local check of spool worker failover. Two workers share a spool in a
+# temporary directory: the first claims a job and is killed with SIGKILL
+# while the job runs, the second reclaims it once the heartbeat expires and
+# runs it. The job has to finish exactly once, with a single result and a
+# single write of its output. ffmpeg and mediainfo are the stand-ins in
+# bench/fakebin, the ffmpeg one made to take --job-time seconds.
+
+import glob
+import json
+import optparse
+import os
+import os.path
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from mmf import spool
+
+from run_benchmarks import INSTALL_DIR, _make_env, _make_inputs
+
+_WORKER_CMD = [sys.executable, "-c", "from mmf import spool; spool.main()",
+               "worker", "--poll-interval", "0.2", "--heartbeat-interval",
+               "0.5", "--exit-when-idle"]
+_TARGET_FILE = os.path.join(INSTALL_DIR, "targets", "iphone4.mmftarget")
+
+def _start_worker(spool_dir, log_file, env, claim_timeout):
+    log_fd = open(log_file, 'w')
+    worker = subprocess.Popen(_WORKER_CMD + ["--claim-timeout",
+                                             str(claim_timeout), spool_dir],
+                              stdout = log_fd, stderr = subprocess.STDOUT,
+                              env = env)
+    log_fd.close()
+    return worker
+
+def _wait_for(condition, timeout):
+    """Waits for condition() to become true, returns whether it did"""
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.1)
+    return True
+
+def run(temp_dir, job_time, claim_timeout):
+    """Runs the failover scenario, returns a list of failure messages"""
+    failures = []
+    spool_dir = os.path.join(temp_dir, "spool")
+    output_path = os.path.join(temp_dir, "output.mp4")
+    output_log = os.path.join(temp_dir, "outputs.log")
+    env = _make_env(temp_dir)
+    env["MMF_FAKE_FFMPEG_TIME"] = str(job_time)
+    env["MMF_FAKE_FFMPEG_LOG"] = output_log
+
+    input_file = _make_inputs(temp_dir, 1)[0]
+    job_name = spool.submit(spool_dir, ["-t", _TARGET_FILE, "-o",
+                                        output_path, input_file])
+    print "Submitted job %s" % job_name
+
+    first = _start_worker(spool_dir, os.path.join(temp_dir, "worker-1.log"),
+                          env, claim_timeout)
+    claimed_dir = os.path.join(spool_dir, spool.CLAIMED_DIR)
+    if not _wait_for(lambda: len(os.listdir(claimed_dir)) > 0, 30):
+        first.kill()
+        first.wait()
+        return ["First worker never claimed the job"]
+    # Let the job get into its encode before pulling the plug
+    time.sleep(job_time / 2.0)
+    print "Killing the first worker mid-job"
+    first.send_signal(signal.SIGKILL)
+    first.wait()
+
+    second = _start_worker(spool_dir, os.path.join(temp_dir,
+                                                   "worker-2.log"),
+                           env, claim_timeout)
+    timeout = claim_timeout + spool._RECLAIM_GRACE + job_time * 2 + 60
+    if not _wait_for(lambda: second.poll() is not None, timeout):
+        second.kill()
+        failures.append("Second worker didn't finish in %d seconds" %
+                        timeout)
+    second.wait()
+
+    result_files = glob.glob(os.path.join(spool_dir, spool.DONE_DIR,
+                                          "*" + spool.RESULT_EXTENSION))
+    if len(result_files) != 1:
+        failures.append("%d results instead of 1" % len(result_files))
+    for result_file in result_files:
+        result_fd = open(result_file, 'r')
+        result = json.load(result_fd)
+        result_fd.close()
+        print "Result: %s by %s" % (result.get("status"),
+                                    result.get("worker"))
+        if result.get("status") != "ok":
+            failures.append("Job status is %s" % result.get("status"))
+    for sub_dir in (spool.PENDING_DIR, spool.CLAIMED_DIR, spool.FAILED_DIR):
+        if len(os.listdir(os.path.join(spool_dir, sub_dir))) > 0:
+            failures.append("Jobs left in %s/" % sub_dir)
+
+    output_writes = 0
+    if os.path.exists(output_log):
+        output_log_fd = open(output_log, 'r')
+        output_writes = output_log_fd.read().split("\n").count(output_path)
+        output_log_fd.close()
+    print "Output written %d times" % output_writes
+    if output_writes != 1:
+        failures.append("Output written %d times instead of once" %
+                        output_writes)
+    return failures
+
+def main(argv = sys.argv):
+    optparser = optparse.OptionParser()
+    optparser.add_option(
+        "--job-time", type="float", dest="job_time", default=4.0,
+        help="Seconds the stand-in ffmpeg takes per pass (default %default)")
+    optparser.add_option(
+        "--claim-timeout", type="float", dest="claim_timeout", default=2.0,
+        help="Worker claim timeout in seconds (default %default)")
+    optparser.add_option(
+        "--keep", action="store_true", dest="keep",
+        help="Keep the temporary spool and worker logs")
+    (options, extra_args) = optparser.parse_args(argv[1:])
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        failures = run(temp_dir, options.job_time, options.claim_timeout)
+    finally:
+        if options.keep:
+            print "Spool kept in " + temp_dir
+        else:
+            shutil.rmtree(temp_dir)
+
+    if len(failures) > 0:
+        for failure in failures:
+            print "FAILED: " + failure
+        sys.exit(1)
+    print "OK: job finished exactly once"
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,279 @@
+#!/usr/bin/python
+# Mark's Media Framework
+# Copyright (C) 2011  Mark Pariente
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Encode settings derived from short sample encodes of a few windows spread
+# across the input.
+#
+# Deadline driven x264 preset selection measures the encoding speed of a
+# candidate preset, which is extrapolated to the whole encode from the input
+# frame rate and the output duration. Slower presets are never faster, so
+# the slowest preset finishing before the deadline is found by bisecting the
+# preset list, calibrating only a handful of presets.
+#
+# Complexity aware bit rate selection encodes the windows at the planned
+# size with constant quality (CRF) rate control, and uses the bit rate
+# x264 needed for that quality instead of the target maximum when it is
+# lower. Simple content like animation or slides needs a fraction of the
+# bits of a busy scene at the same quality.
+
+import os
+import os.path
+import re
+import shlex
+import time
+
+from mmf import errors
+from mmf import procgraph
+
+# x264 presets from fastest to slowest
+PRESETS = ["ultrafast", "superfast", "veryfast", "faster", "fast", "medium",
+           "slow", "slower", "veryslow"]
+
+DEFAULT_WINDOW_COUNT = 3
+DEFAULT_WINDOW_LENGTH = 10.0 # Seconds of input encoded per window
+MIN_VIDEO_BITRATE = 100 # Kbps, floor for bit rates from complexity analysis
+
+_DEADLINE_UNITS = {"": 1, "s": 1, "m": 60, "h": 3600}
+_SAMPLE_FILE = "crf-sample-%d.264"
+
+def _sample_windows(sample_start, sample_length, window_count,
+                    window_length):
+    """
+    Returns a (window_length, window_starts) tuple for window_count windows
+    spread evenly over a range of the input, shortened for short ranges
+    """
+    window_length = min(window_length, sample_length / float(window_count))
+    window_starts = []
+    for i in range(window_count):
+        window_starts.append(sample_start +
+                             (sample_length - window_length) *
+                             (i + 0.5) / window_count)
+    return (window_length, window_starts)
+
+def _run_window(input_file, window_start, window_length, video_str, output,
+                work_dir):
+    """Encodes the video of a window of the input, returns the wall time"""
+    ffmpeg_cmdline = ("ffmpeg -v error -y -ss %.3f -t %.3f -i \"%s\"" %
+                      (window_start, window_length, input_file) +
+                      video_str + " -an " + output)
+    start_time = time.time()
+    graph = procgraph.ProcessGraph()
+    ffmpeg = graph.add_process("ffmpeg", shlex.split(ffmpeg_cmdline),
+                               work_dir, echo_stderr = False)
+    graph.run()
+    if ffmpeg.returncode != 0:
+        raise errors.MMFError("Sample encode of '%s' at %.1f seconds failed \
+with status %d:\n%s" % (input_file, window_start, ffmpeg.returncode,
+                        ffmpeg.get_stderr_str()))
+    return time.time() - start_time
+
+def parse_deadline(deadline_str):
+    """
+    Converts a deadline like '3600', '90m' or '2h' to seconds, raising
+    MMFError for anything else
+    """
+    match = re.match(r'^([0-9.]+)([smh]?)$', deadline_str.strip())
+    if match is None:
+        raise errors.MMFError("Invalid deadline '%s', use seconds or a \
+number followed by s, m or h" % deadline_str)
+    return float(match.group(1)) * _DEADLINE_UNITS[match.group(2)]
+
+class PresetCalibration:
+    """
+    Picks the slowest x264 preset that finishes an encode by a deadline,
+    given as an absolute time.time() value, from calibration encodes of the
+    input's video with the ffmpeg video options of a TranscodePlan.
+    """
+
+    def __init__(self, input_file, target_plan, vid_fps, duration,
+                 deadline_time, pass_count = 1, work_dir = None,
+                 sample_range = None, window_count = DEFAULT_WINDOW_COUNT,
+                 window_length = DEFAULT_WINDOW_LENGTH):
+        """
+        Calibrates for an encode of duration seconds of output. Windows are
+        sampled from the (start, length) range of input_file given in
+        seconds, which defaults to its first duration seconds.
+        """
+        if not vid_fps:
+            raise errors.MMFError("No frame rate information for '%s', can't \
+calibrate presets" % input_file)
+        (sample_start, sample_length) = sample_range or (0, duration)
+        if not duration or not sample_length:
+            raise errors.MMFError("No duration information for '%s', can't \
+calibrate presets" % input_file)
+
+        self.input_file = input_file
+        self.target_plan = target_plan
+        self.vid_fps = vid_fps
+        self.duration = duration
+        self.deadline_time = deadline_time
+        self.pass_count = pass_count
+        self.work_dir = work_dir
+        self.frame_count = int(duration * vid_fps)
+        self.preset = None
+        self.fps = {} # Measured frames per second by preset
+        self.estimates = {} # Estimated encode seconds by preset
+        self.calibration_time = 0.0
+
+        (self.window_length, self.windows) = _sample_windows(
+            sample_start, sample_length, window_count, window_length)
+
+    def _measure(self, preset):
+        """Encodes the calibration windows with a preset, returns its fps"""
+        video_str = self.target_plan.get_video_str(preset)
+        elapsed = 0.0
+        for window_start in self.windows:
+            elapsed += _run_window(self.input_file, window_start,
+                                   self.window_length, video_str,
+                                   "-f null -", self.work_dir)
+
+        frames = self.window_length * len(self.windows) * self.vid_fps
+        fps = frames / max(elapsed, 0.001)
+        self.fps[preset] = fps
+        self.estimates[preset] = self.frame_count * self.pass_count / fps
+        print "Calibration: preset %s encodes at %.1f fps, estimated %.0f \
+seconds" % (preset, fps, self.estimates[preset])
+        return fps
+
+    def _fits(self, preset):
+        """Returns whether an encode with the preset meets the deadline"""
+        self._measure(preset)
+        return time.time() + self.estimates[preset] <= self.deadline_time
+
+    def run(self):
+        """
+        Calibrates and returns the chosen preset, the fastest one if even
+        that won't meet the deadline
+        """
+        start_time = time.time()
+        low = 0
+        high = len(PRESETS) - 1
+        best = None
+        while low <= high:
+            middle = (low + high) / 2
+            if self._fits(PRESETS[middle]):
+                best = middle
+                low = middle + 1
+            else:
+                high = middle - 1
+        self.calibration_time = time.time() - start_time
+
+        # Later calibration encodes ate into the time left, fall back to the
+        # slowest measured preset that still fits
+        while best is not None:
+            if (PRESETS[best] in self.estimates and
+                time.time() + self.estimates[PRESETS[best]] <=
+                self.deadline_time):
+                break
+            best -= 1
+            if best < 0:
+                best = None
+
+        if best is None:
+            print "WARNING: No preset meets the deadline, using " + PRESETS[0]
+            best = 0
+        self.preset = PRESETS[best]
+        return self.preset
+
+    def __repr__(self):
+        retStr = "\nPreset calibration for %s\n" % self.input_file
+        retStr += "\tFrames to encode: %d in %d pass(es)\n" % (
+            self.frame_count, self.pass_count)
+        retStr += "\tTime left: %.0f seconds\n" % (self.deadline_time -
+                                                   time.time())
+        for preset in PRESETS:
+            if preset in self.fps:
+                retStr += "\t%-10s %8.1f fps %10.0f seconds\n" % (
+                    preset, self.fps[preset], self.estimates[preset])
+        retStr += "\tCalibration time: %.1f seconds\n" % self.calibration_time
+        retStr += "\tChosen preset: %s\n" % self.preset
+        return retStr
+
+class ComplexityAnalysis:
+    """
+    Finds the video bit rate needed to reach a CRF quality with the ffmpeg
+    video options of a TranscodePlan, from CRF encodes of windows sampled
+    from the (start, length) range of the input given in seconds
+    """
+
+    def __init__(self, input_file, target_plan, crf, sample_range,
+                 work_dir = None, window_count = DEFAULT_WINDOW_COUNT,
+                 window_length = DEFAULT_WINDOW_LENGTH):
+        (sample_start, sample_length) = sample_range
+        if not sample_length:
+            raise errors.MMFError("No duration information for '%s', can't \
+analyze complexity" % input_file)
+
+        self.input_file = input_file
+        self.target_plan = target_plan
+        self.crf = crf
+        self.work_dir = work_dir
+        self.window_bitrates = [] # Kbps needed by each window
+        self.bitrate = None # Kbps needed overall
+        self.analysis_time = 0.0
+        (self.window_length, self.windows) = _sample_windows(
+            sample_start, sample_length, window_count, window_length)
+
+    def run(self, preset = None):
+        """Runs the sample encodes and returns the bit rate needed in Kbps"""
+        start_time = time.time()
+        video_str = self.target_plan.get_video_str(preset, crf = self.crf)
+        total_size = 0
+        for (i, window_start) in enumerate(self.windows):
+            sample_file = os.path.join(self.work_dir or "", _SAMPLE_FILE % i)
+            _run_window(self.input_file, window_start, self.window_length,
+                        video_str, "-f h264 \"%s\"" % sample_file,
+                        self.work_dir)
+            try:
+                size = os.path.getsize(sample_file)
+                os.remove(sample_file)
+            except OSError as e:
+                raise errors.MMFError("Sample encode of '%s' produced no \
+output: %s" % (self.input_file, e.strerror))
+            total_size += size
+            self.window_bitrates.append(int(size * 8 / 1000.0 /
+                                            self.window_length))
+
+        # Black or still windows need next to nothing, which doesn't carry
+        # over to the rest of the input
+        self.bitrate = max(MIN_VIDEO_BITRATE,
+                           int(total_size * 8 / 1000.0 /
+                               (self.window_length * len(self.windows))))
+        self.analysis_time = time.time() - start_time
+        return self.bitrate
+
+    def __repr__(self):
+        retStr = "\nComplexity analysis for %s at CRF %s\n" % (
+            self.input_file, self.crf)
+        for (window_start, bitrate) in zip(self.windows,
+                                           self.window_bitrates):
+            retStr += "\t%8.1f seconds: %6d Kbps\n" % (window_start, bitrate)
+        retStr += "\tBit rate needed: %s Kbps\n" % self.bitrate
+        retStr += "\tAnalysis time: %.1f seconds\n" % self.analysis_time
+        return retStr
+
+if __name__ == "__main__":
+    import sys
+    from mmf import plan
+    from mmf import targetconfig
+    from mmf import vidparse
+    testInfo = vidparse.VidParser(sys.argv[1])
+    testPlan = plan.plan_transcode(testInfo,
+                                   targetconfig.TargetConfig(sys.argv[2]),
+                                   passthrough = False)
+    testCalibration = PresetCalibration(
+        sys.argv[1], testPlan, testInfo.vid_fps, testInfo.duration,
+        time.time() + parse_deadline(sys.argv[3]))
+    testCalibration.run()
+    print testCalibration
@@ -0,0 +1,277 @@
+#!/usr/bin/python
+# Mark's Media Framework
+# Copyright (C) 2011  Mark Pariente
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Target catalog and automatic target selection. The catalog holds every
+# target file in the target directory, parsed through an index file in the
+# cache directory so that unchanged targets aren't parsed again for every
+# job. Each target file is still stat'ed on every load to tell whether it
+# changed. Target files that fail to parse are left out with a warning.
+# Targets are ranked for an input by predicted transcode cost: the plan's
+# cost tier first, then the video pixel rate to encode.
+
+import json
+import os
+import os.path
+
+from mmf import errors
+from mmf import plan
+from mmf import probecache
+from mmf import targetconfig
+from mmf import vidparse
+
+INDEX_FILE_NAME = "targets.json"
+_INDEX_VERSION = 2
+
+# Cost tiers in increasing order of transcode cost
+TIER_PASSTHROUGH = 0
+TIER_ENCODE = 1
+TIER_RESCALE = 2
+TIER_DEINTERLACE = 3
+TIER_DEINTERLACE_RESCALE = 4
+_TIER_NAMES = ["passthrough", "encode", "rescale", "deinterlace",
+               "deinterlace+rescale"]
+
+_default_catalog = None
+
+def get_default_catalog():
+    """
+    Returns the process-wide catalog of installed targets, indexed in the
+    cache directory
+    """
+    global _default_catalog
+
+    if _default_catalog is None:
+        _default_catalog = TargetCatalog(
+            index_file = os.path.join(probecache.get_cache_dir(),
+                                      INDEX_FILE_NAME))
+    return _default_catalog
+
+class TargetCatalog:
+    """
+    All valid target files in a target directory. With an index file, parsed
+    targets are kept in it keyed on the file's path, size and modification
+    time, and only new or modified target files are parsed.
+    """
+
+    def __init__(self, target_dir = None, index_file = None):
+        if target_dir is None:
+            target_dir = targetconfig.get_target_dir()
+        self.target_dir = target_dir
+        self.index_file = index_file
+        self.targets = []
+        self.index_hits = 0
+        self.index_misses = 0
+        self._load()
+
+    def _read_index(self):
+        """Returns the indexed entries, empty if there is no usable index"""
+        if self.index_file is None:
+            return {}
+        try:
+            index_fd = open(self.index_file, 'r')
+            index = json.load(index_fd)
+            index_fd.close()
+        except (IOError, ValueError):
+            return {}
+        if index.get("version") != _INDEX_VERSION:
+            return {}
+        return index.get("targets", {})
+
+    def _write_index(self, entries):
+        temp_file = "%s.tmp-%d" % (self.index_file, os.getpid())
+        try:
+            index_dir = os.path.dirname(self.index_file)
+            if not os.path.isdir(index_dir):
+                os.makedirs(index_dir)
+            index_fd = open(temp_file, 'w')
+            json.dump({"version": _INDEX_VERSION, "targets": entries},
+                      index_fd, indent = 2, sort_keys = True)
+            index_fd.close()
+            # Concurrent jobs only ever see a complete index
+            os.rename(temp_file, self.index_file)
+        except (IOError, OSError) as e:
+            print "WARNING: Failed to write target index '%s': %s" % (
+                self.index_file, e)
+
+    def _load(self):
+        index = self._read_index()
+        entries = {}
+        for target_file in targetconfig.list_target_files(self.target_dir):
+            path = os.path.abspath(target_file)
+            try:
+                st = os.stat(path)
+            except OSError:
+                # Removed since the directory was listed
+                continue
+            entry = index.get(path)
+            target_config = None
+            if (isinstance(entry, dict) and entry.get("size") == st.st_size
+                and entry.get("mtime") == st.st_mtime):
+                try:
+                    target_config = targetconfig.TargetConfig(
+                        path, entry["fields"])
+                    self.index_hits += 1
+                except Exception:
+                    # Damaged entry, parse the file instead
+                    pass
+            if target_config is None:
+                try:
+                    target_config = targetconfig.TargetConfig(path)
+                except errors.MMFError as e:
+                    print "WARNING: Skipping target: " + e.msg
+                    continue
+                except Exception as e:
+                    print "WARNING: Skipping target file '%s': %s" % (path, e)
+                    continue
+                entry = {"size": st.st_size,
+                         "mtime": st.st_mtime,
+                         "fields": target_config.get_fields()}
+                self.index_misses += 1
+            entries[path] = entry
+            self.targets.append(target_config)
+
+        # Also drops entries of target files that have been removed
+        if self.index_file is not None and entries != index:
+            self._write_index(entries)
+
+    def get_device_classes(self):
+        """Returns the sorted list of device classes in the catalog"""
+        return sorted(set(target_config.device_class
+                          for target_config in self.targets
+                          if target_config.device_class is not None))
+
+    def get_targets(self, device_class = None):
+        """Returns the targets of a device class, or all of them"""
+        return [target_config for target_config in self.targets
+                if device_class is None or
+                target_config.device_class == device_class]
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __repr__(self):
+        retStr = "\nTarget catalog: %s\n" % self.target_dir
+        retStr += "\tIndex: %s\n" % self.index_file
+        retStr += "\tIndex hits: %d\n" % self.index_hits
+        retStr += "\tIndex misses: %d\n" % self.index_misses
+        for target_config in self.targets:
+            retStr += "\t%-8s %s (%s)\n" % (target_config.device_class,
+                                            target_config.target_name,
+                                            target_config.target_file)
+        return retStr
+
+class RankedTarget:
+    """A compatible target for an input with its predicted transcode cost"""
+
+    def __init__(self, target_config, target_plan, vid_info):
+        self.target_config = target_config
+        self.plan = target_plan
+
+        if target_plan.copy_video:
+            self.tier = TIER_PASSTHROUGH
+            self.pixel_rate = 0.0
+            return
+
+        if target_plan.size is not None:
+            (width, height) = target_plan.size
+        else:
+            (width, height) = (vid_info.vid_width, vid_info.vid_height)
+        # Per frame if the frame rate is unknown, deinterlacing with yadif=1
+        # outputs a frame per field
+        fps = vid_info.vid_fps or 1.0
+        if target_plan.deinterlace:
+            fps *= 2
+        self.pixel_rate = width * height * fps
+
+        if target_plan.deinterlace and target_plan.size is not None:
+            self.tier = TIER_DEINTERLACE_RESCALE
+        elif target_plan.deinterlace:
+            self.tier = TIER_DEINTERLACE
+        elif target_plan.size is not None:
+            self.tier = TIER_RESCALE
+        else:
+            self.tier = TIER_ENCODE
+
+    def get_cost(self):
+        """Returns the sort key, lower is cheaper"""
+        return (self.tier, self.pixel_rate, not self.plan.copy_audio)
+
+    def __repr__(self):
+        return "%-20s %-30s %8.1f Mpixel/s  %s" % (
+            _TIER_NAMES[self.tier], os.path.basename(
+                self.target_config.target_file),
+            self.pixel_rate / 1000000.0, self.target_config.target_name)
+
+def _is_compatible(vid_info, target_config):
+    """
+    Returns whether a target can be produced from the input at all, as
+    opposed to plan_transcode() which plans whatever it is asked to
+    """
+    if target_config.video_interlaced and not vid_info.vid_interlaced:
+        # Interlaced output needs interlaced input
+        return False
+    if (target_config.codec_h264_same and
+        vid_info.vid_codec != vidparse.VIDEO_CODEC_H264):
+        # No H.264 profile/level to keep
+        return False
+    return True
+
+def rank_targets(vid_info, target_list, video_bitrate = None,
+                 start_offset = None, passthrough = True):
+    """
+    Returns a RankedTarget for every target in target_list compatible with a
+    probed input, cheapest first
+    """
+    ranked_list = []
+    for target_config in target_list:
+        if not _is_compatible(vid_info, target_config):
+            continue
+        try:
+            target_plan = plan.plan_transcode(vid_info, target_config,
+                                              video_bitrate, start_offset,
+                                              passthrough)
+        except errors.MMFError:
+            continue
+        ranked_list.append(RankedTarget(target_config, target_plan,
+                                        vid_info))
+    ranked_list.sort(key = lambda ranked: ranked.get_cost())
+    return ranked_list
+
+def rank_device_class(vid_info, catalog, device_class, video_bitrate = None,
+                      start_offset = None, passthrough = True):
+    """
+    Returns the ranked list of targets of a device class compatible with a
+    probed input, cheapest first. Raises MMFError if there are none.
+    """
+    target_list = catalog.get_targets(device_class)
+    if len(target_list) == 0:
+        raise errors.MMFError(
+            "Unknown device class '%s', available classes: %s" %
+            (device_class, ", ".join(catalog.get_device_classes())))
+    ranked_list = rank_targets(vid_info, target_list, video_bitrate,
+                               start_offset, passthrough)
+    if len(ranked_list) == 0:
+        raise errors.MMFError("No '%s' target is compatible with '%s'" %
+                              (device_class, vid_info.input_file_name))
+    return ranked_list
+
+if __name__ == "__main__":
+    import sys
+    testCatalog = get_default_catalog()
+    print testCatalog
+    if len(sys.argv) > 2:
+        testInfo = vidparse.VidParser(sys.argv[2])
+        for testRanked in rank_device_class(testInfo, testCatalog,
+                                            sys.argv[1]):
+            print testRanked
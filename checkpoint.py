@@ -0,0 +1,317 @@
+#!/usr/bin/python
+# Mark's Media Framework
+# Copyright (C) 2011  Mark Pariente
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Checkpoints for resumable transcodes. A job works in a directory named
+# after a key of its command line and input files, so running the same
+# command again finds the intermediate files of an earlier run. A checkpoint
+# file in it records the stages that finished, and values such as calibration
+# results that the later stages were planned with. The files of a stage are
+# synced to disk before the stage is recorded, so a recorded stage survives
+# a crash or reboot:
+#
+#   {"version": 1, "key": <job key>, "stages": [<name>...],
+#    "values": {<name>: <value>}}
+#
+# A lock on the directory is held for the life of the job. It keeps a second
+# run of the same job out and tells the directories of jobs that died apart
+# from those of running jobs.
+#
+# Job directory names are predictable and usually live in a shared temporary
+# directory, so a directory is created private to the user and only reused
+# if it is a real directory owned by the user that nobody else can access.
+
+import errno
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import os.path
+import shutil
+import stat
+import tempfile
+import threading
+import time
+
+from mmf import errors
+
+JOB_DIR_PREFIX = "mmf-job-"
+DEFAULT_STALE_AGE = 7 * 24 * 3600 # Seconds until a dead job's directory goes
+_CHECKPOINT_FILE = "checkpoint.json"
+_LOCK_FILE = "job.lock"
+_CHECKPOINT_VERSION = 1
+_JOB_DIR_MODE = 0700
+
+def make_job_key(args, input_files):
+    """
+    Returns the job key of a command line run on the input files. Any change
+    to an input file results in a different key.
+    """
+    key_list = [_CHECKPOINT_VERSION, os.getcwd(), args]
+    for input_file in input_files:
+        path = os.path.abspath(input_file)
+        st = os.stat(path)
+        key_list.append([path, st.st_ino, st.st_size, st.st_mtime])
+    return hashlib.sha1(json.dumps(key_list)).hexdigest()
+
+def _try_lock(lock_path):
+    """
+    Returns an open descriptor holding an exclusive lock on lock_path, None if
+    another process holds it
+    """
+    lock_fd = os.open(lock_path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW,
+                      0600)
+    try:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError as e:
+        os.close(lock_fd)
+        if e.errno in (errno.EAGAIN, errno.EACCES):
+            return None
+        raise
+    return lock_fd
+
+def _is_private_dir(dir_path):
+    """
+    Returns whether dir_path is a directory, not a link to one, owned by
+    this user and inaccessible to anyone else
+    """
+    st = os.lstat(dir_path)
+    return (stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid() and
+            stat.S_IMODE(st.st_mode) & 0077 == 0)
+
+def _sync_dir(dir_path, sync_files = True):
+    """
+    Flushes the directory entries of dir_path and, with sync_files, its
+    regular files to disk
+    """
+    if sync_files:
+        for file_name in os.listdir(dir_path):
+            file_path = os.path.join(dir_path, file_name)
+            if not os.path.isfile(file_path):
+                # Named pipes hold nothing to flush
+                continue
+            try:
+                file_fd = os.open(file_path, os.O_RDONLY)
+            except OSError as e:
+                if e.errno == errno.ENOENT:
+                    # Renamed or removed by a stage still running, e.g.
+                    # x264's temporary pass logs
+                    continue
+                raise
+            try:
+                os.fsync(file_fd)
+            finally:
+                os.close(file_fd)
+    dir_fd = os.open(dir_path, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+def clean_stale(temp_root = None, max_age = DEFAULT_STALE_AGE):
+    """
+    Removes the directories of dead jobs under temp_root that haven't been
+    touched for max_age seconds, returning how many were removed
+    """
+    removed = 0
+    now = time.time()
+    for job_path in glob.glob(os.path.join(temp_root or tempfile.gettempdir(),
+                                           JOB_DIR_PREFIX + "*")):
+        try:
+            if (not _is_private_dir(job_path) or
+                now - os.path.getmtime(job_path) < max_age):
+                # Someone else's, or not stale yet
+                continue
+            lock_fd = _try_lock(os.path.join(job_path, _LOCK_FILE))
+        except (IOError, OSError):
+            continue
+        if lock_fd is None:
+            # Still running
+            continue
+        try:
+            shutil.rmtree(job_path)
+            removed += 1
+        except OSError as e:
+            print "WARNING: Failed to remove stale working directory \
+'%s': %s" % (job_path, e.strerror)
+        os.close(lock_fd)
+    return removed
+
+class JobDir:
+    """
+    Working directory of a job, keyed on job_key, under temp_root or the
+    system temporary directory. With resume the stages recorded by an earlier
+    run are kept, otherwise its files are discarded.
+    """
+
+    def __init__(self, temp_root, job_key, resume = False):
+        self.key = job_key
+        self.path = os.path.join(temp_root or tempfile.gettempdir(),
+                                 JOB_DIR_PREFIX + job_key)
+        self.checkpoint_file = os.path.join(self.path, _CHECKPOINT_FILE)
+        self.stages = []
+        self.values = {}
+        self.discarded = False
+        self._lock = threading.Lock()
+
+        try:
+            try:
+                os.mkdir(self.path, _JOB_DIR_MODE)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            st = os.lstat(self.path)
+            if (stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid() and
+                stat.S_IMODE(st.st_mode) & 0022 == 0):
+                # Left by a run that didn't make it private, but nobody
+                # else could have put anything in it
+                os.chmod(self.path, _JOB_DIR_MODE)
+            if not _is_private_dir(self.path):
+                raise errors.MMFError("Working directory '%s' is not a \
+private directory of this user, not using it" % self.path)
+            self._lock_fd = _try_lock(os.path.join(self.path, _LOCK_FILE))
+        except (IOError, OSError) as e:
+            raise errors.MMFError("Failed to create working directory \
+'%s': %s" % (self.path, e.strerror))
+        if self._lock_fd is None:
+            raise errors.MMFError("The same job is already running in '%s'" %
+                                  self.path)
+
+        if resume:
+            self._read()
+        if not self.has_checkpoints():
+            self._discard()
+
+    def _read(self):
+        try:
+            checkpoint_fd = open(self.checkpoint_file, 'r')
+            checkpoint = json.load(checkpoint_fd)
+            checkpoint_fd.close()
+        except (IOError, ValueError):
+            return
+        if (checkpoint.get("version") != _CHECKPOINT_VERSION or
+            checkpoint.get("key") != self.key):
+            return
+        self.stages = checkpoint.get("stages", [])
+        self.values = checkpoint.get("values", {})
+
+    def _discard(self):
+        """Removes whatever an earlier run left behind"""
+        for file_name in os.listdir(self.path):
+            if file_name == _LOCK_FILE:
+                continue
+            self.discarded = True
+            file_path = os.path.join(self.path, file_name)
+            try:
+                if os.path.isdir(file_path):
+                    shutil.rmtree(file_path)
+                else:
+                    os.remove(file_path)
+            except OSError as e:
+                raise errors.MMFError("Failed to clean working directory \
+'%s': %s" % (self.path, e.strerror))
+
+    def _write(self):
+        temp_file = self.checkpoint_file + ".tmp"
+        try:
+            _sync_dir(self.path)
+            checkpoint_fd = open(temp_file, 'w')
+            json.dump({"version": _CHECKPOINT_VERSION, "key": self.key,
+                       "stages": self.stages, "values": self.values},
+                      checkpoint_fd, indent = 2, sort_keys = True)
+            checkpoint_fd.flush()
+            os.fsync(checkpoint_fd.fileno())
+            checkpoint_fd.close()
+            os.rename(temp_file, self.checkpoint_file)
+            _sync_dir(self.path, False)
+        except (IOError, OSError) as e:
+            # The job goes on, only resuming it would redo more
+            print "WARNING: Failed to write checkpoint '%s': %s" % (
+                self.checkpoint_file, e)
+
+    def has_checkpoints(self):
+        """Returns whether any stage or value has been recorded"""
+        return len(self.stages) > 0 or len(self.values) > 0
+
+    def is_done(self, stage_name):
+        """Returns whether a stage finished in this or an earlier run"""
+        return stage_name in self.stages
+
+    def record(self, stage_name):
+        """Records a finished stage once its files are on disk"""
+        with self._lock:
+            if stage_name not in self.stages:
+                self.stages.append(stage_name)
+                self._write()
+
+    def wrap(self, stage_name, func):
+        """Returns a stage function that records the stage after func()"""
+        def run_stage():
+            func()
+            self.record(stage_name)
+        return run_stage
+
+    def get_value(self, name):
+        """Returns a recorded value, None if there is none"""
+        return self.values.get(name)
+
+    def set_value(self, name, value):
+        """Records a value the rest of the job depends on"""
+        with self._lock:
+            self.values[name] = value
+            self._write()
+
+    def remove(self):
+        """
+        Removes the checkpoint, the lock and the directory of a finished
+        job, whose own files must have been removed already
+        """
+        for file_name in [_CHECKPOINT_FILE, _LOCK_FILE]:
+            file_path = os.path.join(self.path, file_name)
+            if os.path.exists(file_path):
+                os.remove(file_path)
+        os.rmdir(self.path)
+        os.close(self._lock_fd)
+        self._lock_fd = None
+
+    def remove_all(self):
+        """Removes the directory of a job with nothing worth resuming"""
+        # Processes of a cancelled stage may still be exiting
+        shutil.rmtree(self.path, True)
+        os.close(self._lock_fd)
+        self._lock_fd = None
+
+    def __repr__(self):
+        retStr = "\nJob directory: %s\n" % self.path
+        retStr += "\tKey: %s\n" % self.key
+        for stage_name in self.stages:
+            retStr += "\tDone: %s\n" % stage_name
+        for name in sorted(self.values):
+            retStr += "\t%s: %s\n" % (name, self.values[name])
+        return retStr
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == "clean":
+        print "Removed %d stale working directories" % clean_stale(None, 0)
+    else:
+        for testPath in sorted(glob.glob(os.path.join(
+                tempfile.gettempdir(), JOB_DIR_PREFIX + "*"))):
+            print testPath
+            try:
+                testFd = open(os.path.join(testPath, _CHECKPOINT_FILE), 'r')
+                print testFd.read()
+                testFd.close()
+            except IOError:
+                print "No checkpoint"
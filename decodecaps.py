@@ -0,0 +1,178 @@
+#!/usr/bin/python
+# Mark's Media Framework
+# Copyright (C) 2011  Mark Pariente
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Hardware decode capability cache. mmfplay records whether VDPAU decoding
+# worked for a (codec, profile, resolution) combination on this host, so
+# that combinations known to fail go straight to software decoding. The
+# cache is a JSON file in the cache directory holding an entry per host,
+# since the cache directory may be shared between machines:
+#
+#   {"version": 1, "hosts": {<host>: {<codec|profile|WxH>: true/false}}}
+#
+# Updates are made under an flock on <caps file>.lock so that players on
+# other hosts or in other processes don't lose each other's results.
+
+import fcntl
+import json
+import os
+import os.path
+import socket
+import threading
+
+from mmf import probecache
+
+CAPS_FILE_NAME = "hwdecode.json"
+NO_CAPS_ENV_VAR = "MMF_NO_DECODE_CAPS"
+_CAPS_VERSION = 1
+_LOCK_EXTENSION = ".lock"
+
+_default_caps = None
+
+def get_default_caps():
+    """
+    Returns the process-wide capability cache, or None if it is disabled
+    through the environment
+    """
+    global _default_caps
+
+    if os.getenv(NO_CAPS_ENV_VAR):
+        return None
+    if _default_caps is None:
+        _default_caps = DecodeCapabilities(
+            os.path.join(probecache.get_cache_dir(), CAPS_FILE_NAME))
+    return _default_caps
+
+def make_key(vid_info):
+    """Returns the capability key of a probed input's video stream"""
+    if vid_info.vid_width is not None and vid_info.vid_height is not None:
+        resolution = "%dx%d" % (vid_info.vid_width, vid_info.vid_height)
+    else:
+        resolution = None
+    return "%s|%s|%s" % (vid_info.vid_codec, vid_info.vid_format_profile,
+                         resolution)
+
+class DecodeCapabilities:
+    """Hardware decode results of this host, kept in a JSON file"""
+
+    def __init__(self, caps_file, host = None):
+        self.caps_file = caps_file
+        self.host = host or socket.gethostname()
+        self._lock = threading.Lock()
+
+    def _read(self):
+        """Returns the results of all hosts, empty if the file is unusable"""
+        try:
+            caps_fd = open(self.caps_file, 'r')
+            caps = json.load(caps_fd)
+            caps_fd.close()
+        except (IOError, ValueError):
+            return {}
+        if caps.get("version") != _CAPS_VERSION:
+            return {}
+        return caps.get("hosts", {})
+
+    def lookup(self, key):
+        """
+        Returns True or False if hardware decoding of key is known to work
+        or fail on this host, None if it hasn't been tried
+        """
+        return self._read().get(self.host, {}).get(key)
+
+    def _lock_file(self):
+        """
+        Returns an open descriptor holding an exclusive lock on the caps
+        file's lock file, None if it can't be locked
+        """
+        try:
+            caps_dir = os.path.dirname(self.caps_file)
+            if not os.path.isdir(caps_dir):
+                os.makedirs(caps_dir)
+            lock_fd = os.open(self.caps_file + _LOCK_EXTENSION,
+                              os.O_RDWR | os.O_CREAT, 0644)
+        except OSError as e:
+            print "WARNING: Failed to lock decode capabilities '%s': %s" % (
+                self.caps_file, e)
+            return None
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        except IOError as e:
+            os.close(lock_fd)
+            print "WARNING: Failed to lock decode capabilities '%s': %s" % (
+                self.caps_file, e)
+            return None
+        return lock_fd
+
+    def _update(self, update_func):
+        """
+        Applies update_func() to the results of all hosts while holding the
+        lock, writing them back if it returns True
+        """
+        with self._lock:
+            lock_fd = self._lock_file()
+            if lock_fd is None:
+                return
+            try:
+                hosts = self._read()
+                if update_func(hosts):
+                    self._write(hosts)
+            finally:
+                # Closing drops the flock
+                os.close(lock_fd)
+
+    def _write(self, hosts):
+        temp_file = "%s.tmp-%d" % (self.caps_file, os.getpid())
+        try:
+            caps_fd = open(temp_file, 'w')
+            json.dump({"version": _CAPS_VERSION, "hosts": hosts}, caps_fd,
+                      indent = 2, sort_keys = True)
+            caps_fd.close()
+            # Concurrent players only ever see a complete file
+            os.rename(temp_file, self.caps_file)
+        except (IOError, OSError) as e:
+            print "WARNING: Failed to write decode capabilities '%s': %s" % (
+                self.caps_file, e)
+
+    def store(self, key, works):
+        """Records whether hardware decoding of key works on this host"""
+        def set_result(hosts):
+            if hosts.get(self.host, {}).get(key) == works:
+                return False
+            hosts.setdefault(self.host, {})[key] = works
+            return True
+        self._update(set_result)
+
+    def clear(self):
+        """Forgets the results of this host"""
+        self._update(lambda hosts: hosts.pop(self.host, None) is not None)
+
+    def __repr__(self):
+        retStr = "\nDecode capabilities: %s\n" % self.caps_file
+        retStr += "\tHost: %s\n" % self.host
+        results = self._read().get(self.host, {})
+        for key in sorted(results):
+            if results[key]:
+                retStr += "\thardware  %s\n" % key
+            else:
+                retStr += "\tsoftware  %s\n" % key
+        return retStr
+
+if __name__ == "__main__":
+    import sys
+    testCaps = get_default_caps()
+    if testCaps is None:
+        print "Decode capability cache disabled"
+    elif len(sys.argv) > 1 and sys.argv[1] == "clear":
+        testCaps.clear()
+    else:
+        print testCaps
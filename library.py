@@ -0,0 +1,414 @@
+#!/usr/bin/python
+# Mark's Media Framework
+# Copyright (C) 2011  Mark Pariente
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Media library index. Every file under the indexed directories gets a row
+# in an SQLite database in the cache directory, with a column per probed
+# field instead of the probe cache's JSON blob, so that questions about the
+# whole library are indexed SQL queries rather than a re-probe of every
+# file. Rescans only probe files whose size or modification time changed,
+# and drop rows of files that are gone. Files that fail to probe are kept
+# with their error so that they aren't retried on every rescan either.
+#
+# Query results are MediaRecords, which hold the same attributes as a
+# VidParser in slots, and can be planned against targets directly.
+
+import json
+import optparse
+import os
+import os.path
+import sqlite3
+import sys
+import threading
+
+from mmf import errors
+from mmf import plan
+from mmf import probecache
+from mmf import targetconfig
+from mmf import vidparse
+
+INDEX_FILE_NAME = "library.db"
+
+# Plan outcomes that --needs can select files by
+NEEDS_PASSTHROUGH = "passthrough"
+NEEDS_ENCODE = "encode"
+NEEDS_RESCALE = "rescale"
+NEEDS_DEINTERLACE = "deinterlace"
+NEEDS_CHOICES = [NEEDS_PASSTHROUGH, NEEDS_ENCODE, NEEDS_RESCALE,
+                 NEEDS_DEINTERLACE]
+
+_PROBE_CHUNK_SIZE = 256 # Files probed between commits during a scan
+
+# Columns besides the probed fields. vid_codec is derived from the fields
+# but stored too, being the most common filter.
+_FILE_COLUMNS = ["path", "size", "mtime", "probe_version", "error",
+                 "vid_codec"]
+_COLUMNS = _FILE_COLUMNS + vidparse.PARSED_FIELDS
+_COLUMN_TYPES = {"path": "TEXT PRIMARY KEY", "size": "INTEGER",
+                 "mtime": "REAL", "probe_version": "INTEGER",
+                 "error": "TEXT", "vid_codec": "TEXT",
+                 "vid_interlaced": "INTEGER", "vid_width": "INTEGER",
+                 "vid_height": "INTEGER", "vid_bitrate": "INTEGER",
+                 "vid_fps": "REAL", "audio_channels": "INTEGER",
+                 "audio_bitrate": "INTEGER", "audio_samplerate": "INTEGER",
+                 "duration": "REAL"}
+
+# A path itself or anything under it as a directory. Ranges on the path
+# column, unlike substr(), are answered from its primary key index.
+_PATH_CONDITION = "(path = ? OR (path >= ? AND path < ?))"
+
+def _decode_path(path):
+    """Returns an absolute path as unicode for binding into sqlite3"""
+    db_path = probecache.decode_path(path)
+    if db_path is None:
+        raise errors.MMFError("Can't index '%s', its name isn't valid in \
+the file system encoding or UTF-8" % path)
+    return db_path
+
+def _get_path_params(path):
+    """Returns the parameters of _PATH_CONDITION for an absolute path"""
+    path = _decode_path(path)
+    prefix = os.path.join(path, "")
+    # Paths starting with prefix sort below it with its separator bumped
+    return [path, prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)]
+
+def get_default_path():
+    """Returns the path of the library index in the cache directory"""
+    return os.path.join(probecache.get_cache_dir(), INDEX_FILE_NAME)
+
+class MediaRecord(object):
+    """
+    A file's row in the index. Holds the attributes of a VidParser for the
+    file without its per-instance dict, so large result sets stay small,
+    and can be passed to plan.plan_transcode() in place of one.
+    """
+
+    __slots__ = _COLUMNS + ["input_file_name"]
+
+    def __init__(self, row):
+        for (column, value) in zip(_COLUMNS, row):
+            # Paths and text are byte strings everywhere else
+            setattr(self, column, probecache.encode_path(value))
+        if self.vid_interlaced is not None:
+            self.vid_interlaced = bool(self.vid_interlaced)
+        self.input_file_name = self.path
+
+    def get_fields(self):
+        """Returns the probed fields like VidParser.get_fields()"""
+        fields = {"version": self.probe_version}
+        for field in vidparse.PARSED_FIELDS:
+            fields[field] = getattr(self, field)
+        return fields
+
+    def __repr__(self):
+        if self.error is not None:
+            return "%s: %s" % (self.path, self.error)
+        if self.vid_interlaced:
+            scan_str = "interlaced"
+        else:
+            scan_str = "progressive"
+        return "%s: %s %s %sx%s %s fps, %s" % (
+            self.path, self.vid_codec, self.vid_format_profile,
+            self.vid_width, self.vid_height, self.vid_fps, scan_str)
+
+class LibraryIndex:
+    """Incrementally updated index of the media files in a library"""
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+        self.unchanged = 0
+        self.probed = 0
+        self.failed = 0
+        self.removed = 0
+        self._lock = threading.Lock()
+
+        index_dir = os.path.dirname(os.path.abspath(index_path))
+        try:
+            if not os.path.isdir(index_dir):
+                os.makedirs(index_dir)
+            self._db = sqlite3.connect(index_path, timeout = 30,
+                                       check_same_thread = False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS media (%s)" % ", ".join(
+                    "%s %s" % (column, _COLUMN_TYPES.get(column, "TEXT"))
+                    for column in _COLUMNS))
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS media_codec "
+                "ON media (vid_codec, vid_interlaced, vid_width)")
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS media_size "
+                "ON media (vid_width, vid_height)")
+            self._db.commit()
+        except (OSError, sqlite3.Error) as e:
+            raise errors.MMFError("Failed to open library index '%s': %s" %
+                                  (index_path, e))
+
+    def _get_known(self, path_list):
+        """Returns {path: (size, mtime, probe version)} under the paths"""
+        known = {}
+        for path in path_list:
+            path = os.path.abspath(path)
+            rows = self._db.execute(
+                "SELECT path, size, mtime, probe_version FROM media "
+                "WHERE " + _PATH_CONDITION, _get_path_params(path))
+            for row in rows:
+                known[probecache.encode_path(row[0])] = tuple(row[1:])
+        return known
+
+    def _store(self, path, st, parser, error):
+        if parser is not None:
+            row = [_decode_path(path), st.st_size, st.st_mtime,
+                   vidparse.PROBE_VERSION, None, parser.vid_codec]
+            row += [getattr(parser, field)
+                    for field in vidparse.PARSED_FIELDS]
+        else:
+            # The message may quote the path
+            error_msg = (probecache.decode_path(error.msg) or
+                         error.msg.decode("utf-8", "replace"))
+            row = [_decode_path(path), st.st_size, st.st_mtime,
+                   vidparse.PROBE_VERSION, error_msg, None]
+            row += [None] * len(vidparse.PARSED_FIELDS)
+        self._db.execute("INSERT OR REPLACE INTO media (%s) VALUES (%s)" %
+                         (", ".join(_COLUMNS),
+                          ", ".join(["?"] * len(_COLUMNS))), row)
+
+    def scan(self, path_list):
+        """
+        Brings the index up to date with the files under path_list,
+        probing only new and modified files
+        """
+        with self._lock:
+            known = self._get_known(path_list)
+            changed = []
+            for file_name in plan.find_files(path_list):
+                path = os.path.abspath(file_name)
+                if probecache.decode_path(path) is None:
+                    print "WARNING: Skipping '%s', its name isn't valid in \
+the file system encoding or UTF-8" % path
+                    continue
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    # Vanished since the directory was read
+                    continue
+                if known.pop(path, None) == (st.st_size, st.st_mtime,
+                                             vidparse.PROBE_VERSION):
+                    self.unchanged += 1
+                else:
+                    changed.append((path, st))
+
+            for chunk_start in range(0, len(changed), _PROBE_CHUNK_SIZE):
+                chunk = changed[chunk_start:chunk_start + _PROBE_CHUNK_SIZE]
+                results = plan.probe_library([path for (path, st) in chunk],
+                                             None)
+                for ((path, st), (parser, error)) in zip(chunk, results):
+                    self._store(path, st, parser, error)
+                    if parser is not None:
+                        self.probed += 1
+                    else:
+                        self.failed += 1
+                # An interrupted scan keeps what it has probed so far
+                self._db.commit()
+
+            # Whatever is left wasn't found any more
+            for path in known:
+                self._db.execute("DELETE FROM media WHERE path = ?",
+                                 (_decode_path(path),))
+                self.removed += 1
+            self._db.commit()
+
+    def query(self, codec = None, interlaced = None, min_width = None,
+              max_width = None, min_height = None, max_height = None,
+              path_list = None, include_errors = False):
+        """
+        Returns the MediaRecords matching all of the given conditions,
+        ordered by path. Files that failed to probe are left out unless
+        include_errors is set.
+        """
+        conditions = []
+        params = []
+        if not include_errors:
+            conditions.append("error IS NULL")
+        if codec is not None:
+            conditions.append("vid_codec = ?")
+            params.append(codec)
+        if interlaced is not None:
+            conditions.append("vid_interlaced = ?")
+            params.append(int(interlaced))
+        for (column, operator, value) in (("vid_width", ">=", min_width),
+                                          ("vid_width", "<=", max_width),
+                                          ("vid_height", ">=", min_height),
+                                          ("vid_height", "<=", max_height)):
+            if value is not None:
+                conditions.append("%s %s ?" % (column, operator))
+                params.append(value)
+        if path_list:
+            path_conditions = []
+            for path in path_list:
+                path_conditions.append(_PATH_CONDITION)
+                params += _get_path_params(os.path.abspath(path))
+            conditions.append("(%s)" % " OR ".join(path_conditions))
+
+        sql = "SELECT %s FROM media" % ", ".join(_COLUMNS)
+        if len(conditions) > 0:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY path"
+        with self._lock:
+            return [MediaRecord(row) for row in self._db.execute(sql, params)]
+
+    def get_count(self):
+        """Returns the (indexed files, files that failed to probe) counts"""
+        with self._lock:
+            return self._db.execute(
+                "SELECT COUNT(*), COUNT(error) FROM media").fetchone()
+
+    def close(self):
+        self._db.close()
+
+    def __repr__(self):
+        (file_count, error_count) = self.get_count()
+        retStr = "\nLibrary index: %s\n" % self.index_path
+        retStr += "\tFiles: %d (%d failed to probe)\n" % (file_count,
+                                                          error_count)
+        retStr += "\tUnchanged: %d\n" % self.unchanged
+        retStr += "\tProbed: %d\n" % self.probed
+        retStr += "\tFailed: %d\n" % self.failed
+        retStr += "\tRemoved: %d\n" % self.removed
+        return retStr
+
+def filter_needs(record_list, target_config, needs):
+    """
+    Returns the records whose plan for a target has the given NEEDS_*
+    outcome, e.g. all files that would have to be rescaled
+    """
+    needs_list = []
+    for record in record_list:
+        try:
+            target_plan = plan.plan_transcode(record, target_config)
+        except errors.MMFError:
+            continue
+        if needs == NEEDS_PASSTHROUGH:
+            matched = target_plan.copy_video
+        elif needs == NEEDS_ENCODE:
+            matched = not target_plan.copy_video
+        elif needs == NEEDS_RESCALE:
+            matched = target_plan.size is not None
+        else:
+            matched = target_plan.deinterlace
+        if matched:
+            needs_list.append(record)
+    return needs_list
+
+def _open_index(index_path):
+    try:
+        return LibraryIndex(index_path or get_default_path())
+    except errors.MMFError as e:
+        print e.msg
+        sys.exit(1)
+
+def main(argv = sys.argv):
+    """Entry point for 'mmfxcode index' and 'mmfxcode query'"""
+    if len(argv) > 1 and argv[1] == "index":
+        optparser = optparse.OptionParser(
+            usage = "%prog index [options] directories_or_files")
+        optparser.add_option(
+            "--index", type="string", dest="index_path",
+            help="Library index database (default %s in the cache \
+directory)" % INDEX_FILE_NAME)
+        (options, extra_args) = optparser.parse_args(argv[2:])
+        if len(extra_args) == 0:
+            print "No directory specified, exiting."
+            sys.exit(1)
+        library_index = _open_index(options.index_path)
+        try:
+            library_index.scan(extra_args)
+        except errors.MMFError as e:
+            print e.msg
+            sys.exit(1)
+        print library_index
+        library_index.close()
+        return
+
+    optparser = optparse.OptionParser(
+        usage = "%prog query [options] [directories_or_files]")
+    optparser.add_option(
+        "--index", type="string", dest="index_path",
+        help="Library index database (default %s in the cache directory)" %
+        INDEX_FILE_NAME)
+    optparser.add_option(
+        "-c", "--codec", type="string", dest="codec",
+        help="Video codec, e.g. H.264, VC-1, WMV3 or 'MPEG 1/2'")
+    optparser.add_option(
+        "-i", "--interlaced", action="store_true", dest="interlaced",
+        help="Interlaced files only")
+    optparser.add_option(
+        "-p", "--progressive", action="store_false", dest="interlaced",
+        help="Progressive files only")
+    optparser.add_option("--min-width", type="int", dest="min_width")
+    optparser.add_option("--max-width", type="int", dest="max_width")
+    optparser.add_option("--min-height", type="int", dest="min_height")
+    optparser.add_option("--max-height", type="int", dest="max_height")
+    optparser.add_option(
+        "-t", "--target", type="string", dest="target_string",
+        help="Target to plan the matching files for, with --needs")
+    optparser.add_option(
+        "--needs", type="choice", dest="needs", choices=NEEDS_CHOICES,
+        help="Only files whose plan for the target is one of: %s" %
+        ", ".join(NEEDS_CHOICES))
+    optparser.add_option(
+        "--errors", action="store_true", dest="include_errors",
+        help="Include files that failed to probe")
+    optparser.add_option(
+        "--json", action="store_true", dest="json",
+        help="Print the matching files' probed fields as JSON")
+    (options, extra_args) = optparser.parse_args(argv[2:])
+    if (options.needs is None) != (options.target_string is None):
+        print "--needs and -t go together."
+        sys.exit(1)
+
+    library_index = _open_index(options.index_path)
+    try:
+        record_list = library_index.query(
+            options.codec, options.interlaced, options.min_width,
+            options.max_width, options.min_height, options.max_height,
+            extra_args, options.include_errors)
+    except errors.MMFError as e:
+        print e.msg
+        sys.exit(1)
+    library_index.close()
+    if options.needs is not None:
+        try:
+            target_config = targetconfig.TargetConfig(options.target_string)
+        except errors.MMFError as e:
+            print e.msg
+            sys.exit(1)
+        record_list = filter_needs(record_list, target_config, options.needs)
+
+    if options.json:
+        json_list = []
+        for record in record_list:
+            fields = record.get_fields()
+            fields["path"] = record.path
+            fields["vid_codec"] = record.vid_codec
+            fields["error"] = record.error
+            json_list.append(fields)
+        print json.dumps(json_list, indent = 2, sort_keys = True)
+    else:
+        for record in record_list:
+            print record
+
+if __name__ == "__main__":
+    testIndex = LibraryIndex(get_default_path())
+    if len(sys.argv) > 1:
+        testIndex.scan(sys.argv[1:])
+    print testIndex
@@ -12,20 +12,168 @@
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 # GNU General Public License for more details.
 
+import copy
+import ctypes
+import ctypes.util
+import errno
+import os
 import os.path
+import stat
+import sys
+import threading
 
 from mmf import vidparse
 from mmf import errors
 
-_READ_BUFFER_SIZE = 4 * 1024 # 4KB per buffer read iteration
+DEFAULT_CHUNK_SIZE = 1024 * 1024 # 1MB per transfer iteration
+DEFAULT_PROBE_JOBS = 4 # Concurrent mediainfo probes during validation
+_PROBE_WAIT_TIMEOUT = 1.0 # Keeps waits on probe results interruptible
+
+_SPLICE_F_MOVE = 1
+
+def _load_libc_splice():
+    """Returns a wrapper around the C library's splice() on Linux, or None"""
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno = True)
+        libc_splice = libc.splice
+    except (OSError, AttributeError):
+        return None
+    libc_splice.restype = ctypes.c_ssize_t
+    libc_splice.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+                            ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+
+    def splice(in_fd, out_fd, count):
+        result = libc_splice(in_fd, None, out_fd, None, count, _SPLICE_F_MOVE)
+        if result < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return result
+    return splice
+
+# Kernel side copy primitives, not available in every Python version
+_splice = getattr(os, "splice", None) or _load_libc_splice()
+_sendfile = getattr(os, "sendfile", None)
+
+def zero_copy_supported():
+    """Returns whether write_all() can move data without user space copies"""
+    return _splice is not None or _sendfile is not None
+
+class ProbePool:
+    """
+    Bounded pool of threads that probe a list of files in list order. With
+    a lookahead, probes stay at most that many files ahead of the last file
+    asked for with get(), e.g. to prefetch upcoming items of a playlist.
+    """
+
+    def __init__(self, file_list, cache, jobs, lookahead = None):
+        self._file_list = file_list
+        self._cache = cache
+        self._lookahead = lookahead
+        self._results = [None] * len(file_list)
+        self._next_idx = 0
+        self._wanted_idx = 0
+        self._cancelled = False
+        self._cond = threading.Condition()
+
+        self._threads = []
+        self._live_workers = max(1, min(jobs, len(file_list)))
+        for i in range(self._live_workers):
+            thread = threading.Thread(target = self._worker)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _worker(self):
+        try:
+            self._probe_files()
+        finally:
+            with self._cond:
+                self._live_workers -= 1
+                self._cond.notify_all()
+
+    def _probe_files(self):
+        """Probes files until the list is exhausted or the pool cancelled"""
+        while True:
+            with self._cond:
+                while (not self._cancelled and self._lookahead is not None and
+                       self._next_idx > self._wanted_idx + self._lookahead):
+                    self._cond.wait(_PROBE_WAIT_TIMEOUT)
+                if self._cancelled or self._next_idx >= len(self._file_list):
+                    return
+                idx = self._next_idx
+                self._next_idx += 1
+
+            try:
+                result = (vidparse.VidParser(self._file_list[idx],
+                                             self._cache), None)
+            except errors.MMFError as e:
+                result = (None, e)
+            except Exception as e:
+                # Unexpected mediainfo output, e.g. a malformed number
+                result = (None, errors.MMFError(
+                    "Failed to parse '%s': %s" % (self._file_list[idx], e)))
+
+            with self._cond:
+                self._results[idx] = result
+                self._cond.notify_all()
+
+    def get(self, idx):
+        """
+        Waits for the file at the given index to be probed and returns a
+        (parser, error) tuple for it. The error is set if the file can no
+        longer be probed because the pool was cancelled.
+        """
+        with self._cond:
+            if idx > self._wanted_idx:
+                self._wanted_idx = idx
+                self._cond.notify_all()
+            while self._results[idx] is None:
+                if self._live_workers == 0:
+                    return (None, errors.MMFError(
+                        "Probe of '%s' was cancelled" % self._file_list[idx]))
+                self._cond.wait(_PROBE_WAIT_TIMEOUT)
+            return self._results[idx]
+
+    def cancel(self):
+        """Stops workers from starting any more probes"""
+        with self._cond:
+            self._cancelled = True
+            self._cond.notify_all()
+
+    def join(self):
+        """Waits for all in-flight probes to complete"""
+        for thread in self._threads:
+            thread.join()
 
 class MultiFileInput:
     """Multiple input file implementation"""
     
-    def __init__(self, file_list):
+    def __init__(self, file_list, cache = None,
+                 probe_jobs = DEFAULT_PROBE_JOBS, fail_fast = False,
+                 chunk_size = DEFAULT_CHUNK_SIZE, zero_copy = True):
+        """
+        Validates that all files in the list are compatible, probing up to
+        probe_jobs files concurrently. Incompatibilities are always reported
+        for the first offending file in list order, and no further probes are
+        started once one is found. With fail_fast set, probes that are
+        already running aren't waited for either.
+
+        write_all() moves chunk_size bytes per iteration and, if zero_copy is
+        set, uses splice()/sendfile() to have the kernel move the data where
+        the platform supports it.
+        """
         self.parser = None
+        self.duration = 0.0
+        self._cache = cache
+        self._probe_jobs = probe_jobs
+        self._fail_fast = fail_fast
+        self._chunk_size = chunk_size
+        self._zero_copy = zero_copy and zero_copy_supported()
         self._current_file = None
         self._current_idx = -1
+        self.bytes_read = 0
         
         try:
             self._validate_list(file_list)
@@ -38,27 +186,38 @@ class MultiFileInput:
             self._file_list.append(os.path.abspath(cur_file))
 
         self._output_fd = None 
+        self._pending = "" # Read by write_chunk() but not written yet
         
     def _validate_list(self, file_list):
         """Validate the input file list to make sure all files are similar"""
         print "Validating multiple file compatibility..."
 
-        for cur_file in file_list:
-            if self.parser is None:
-                try:
-                    self.parser = vidparse.VidParser(cur_file)
-                except errors.MMFError:
-                    raise
-            else:
-                try:
-                    cur_parser = vidparse.VidParser(cur_file)
-                except errors.MMFError:
-                    raise
+        pool = ProbePool(file_list, self._cache, self._probe_jobs)
+        try:
+            for idx in range(len(file_list)):
+                (cur_parser, error) = pool.get(idx)
+                if error is not None:
+                    raise error
 
-                if cur_parser != self.parser:
+                # Combined duration of all files, if known for every file
+                if (self.duration is not None and
+                    cur_parser.duration is not None):
+                    self.duration += cur_parser.duration
+                else:
+                    self.duration = None
+
+                if self.parser is None:
+                    self.parser = cur_parser
+                elif cur_parser != self.parser:
                     raise errors.MMFError(
                         "Files '%s' and '%s' are incompatible:\n%s" %
-                        (file_list[0], cur_file, cur_parser.diff_str))
+                        (file_list[0], file_list[idx], cur_parser.diff_str))
+        except errors.MMFError:
+            pool.cancel()
+            if not self._fail_fast:
+                pool.join()
+            raise
+        pool.join()
 
         # TODO: Validate that the file containers are concat-able
         
@@ -74,22 +233,52 @@ class MultiFileInput:
         else:
             self._current_file = None
 
-    def _read(self):
-        """Reads data from the current file and returns it"""
-        buf = ""
-        
-        if (self._current_idx == -1):
-            self._open_next()
+    def _copy_buffered(self):
+        """Copies the rest of the current file through a user space buffer"""
+        buf = self._current_file.read(self._chunk_size)
+        while buf != "":
+            self.bytes_read += len(buf)
+            try:
+                self._output_fd.write(buf)
+            except IOError:
+                # Output file descriptor closed, reader process is gone...
+                raise
+            buf = self._current_file.read(self._chunk_size)
 
-        if self._current_file is not None:
-            buf = self._current_file.read(_READ_BUFFER_SIZE)
+    def _copy_kernel(self, use_splice):
+        """
+        Copies the current file with splice() or sendfile(), returning False
+        if the kernel refused the transfer before anything was copied
+        """
+        in_fd = self._current_file.fileno()
+        out_fd = self._output_fd.fileno()
+        copied = 0
+        try:
+            while True:
+                if use_splice:
+                    count = _splice(in_fd, out_fd, self._chunk_size)
+                else:
+                    count = _sendfile(out_fd, in_fd, copied, self._chunk_size)
+                if count == 0:
+                    return True
+                copied += count
+                self.bytes_read += count
+        except OSError as e:
+            if e.errno in (errno.EINVAL, errno.ENOSYS) and copied == 0:
+                return False
+            # Output file descriptor closed, reader process is gone...
+            raise IOError(e.errno, e.strerror)
 
-        if buf == "":
-            self._open_next()
-            if self._current_file is not None:
-                buf = self._current_file.read(_READ_BUFFER_SIZE)
+    def get_file_list(self):
+        """Returns the absolute paths of the input files in order"""
+        return list(self._file_list)
 
-        return buf
+    def get_total_size(self):
+        """Returns the combined size in bytes of all the input files"""
+        total_size = 0
+        for cur_file in self._file_list:
+            total_size += os.path.getsize(cur_file)
+        return total_size
 
     def set_output(self, output_fd):
         """Set the output file descriptor for write_all() to write to"""
@@ -104,19 +293,98 @@ class MultiFileInput:
             raise errors.MMFError(
                 "No output descriptor set for %s" % self)
 
-        buf = self._read()
-        while buf != "":
-            try:
-                self._output_fd.write(buf)
-            except IOError:
-                # Output file descriptor closed, reader process is gone...
-                raise
-            buf = self._read()
+        use_splice = False
+        if self._zero_copy:
+            self._output_fd.flush()
+            # splice() needs a pipe on one end, so regular file outputs such
+            # as a concatenated intermediate go through sendfile()
+            use_splice = (_splice is not None and
+                          stat.S_ISFIFO(os.fstat(
+                              self._output_fd.fileno()).st_mode))
+        zero_copy = self._zero_copy and (use_splice or _sendfile is not None)
+
+        self._open_next()
+        while self._current_file is not None:
+            if zero_copy and not self._copy_kernel(use_splice):
+                print "WARNING: Kernel side copy not supported, falling back \
+to buffered copy"
+                self._zero_copy = False
+                zero_copy = False
+            if not zero_copy:
+                self._copy_buffered()
+            self._open_next()
         self._output_fd.close()
     
+    def write_chunk(self):
+        """
+        Writes up to one chunk of the input files to the output set with
+        set_output(), for callers multiplexing a non-blocking output. Returns
+        the number of bytes written, or 0 once all files have been written
+        and the output closed. Raises IOError with EAGAIN if the output is
+        full.
+        """
+        if self._output_fd is None:
+            raise errors.MMFError(
+                "No output descriptor set for %s" % self)
+
+        if self._current_idx < 0:
+            self._open_next()
+        out_fd = self._output_fd.fileno()
+        while self._current_file is not None:
+            if (self._pending == "" and self._zero_copy and
+                _splice is not None and
+                stat.S_ISFIFO(os.fstat(out_fd).st_mode)):
+                try:
+                    count = _splice(self._current_file.fileno(), out_fd,
+                                    self._chunk_size)
+                except OSError as e:
+                    if e.errno not in (errno.EINVAL, errno.ENOSYS):
+                        raise IOError(e.errno, e.strerror)
+                    # splice() moves the file position, so the buffered copy
+                    # carries on where it stopped
+                    print "WARNING: Kernel side copy not supported, falling \
+back to buffered copy"
+                    self._zero_copy = False
+                    continue
+                if count > 0:
+                    self.bytes_read += count
+                    return count
+                self._open_next()
+                continue
+
+            if self._pending == "":
+                self._pending = self._current_file.read(self._chunk_size)
+                self.bytes_read += len(self._pending)
+                if self._pending == "":
+                    self._open_next()
+                    continue
+            try:
+                count = os.write(out_fd, self._pending)
+            except OSError as e:
+                raise IOError(e.errno, e.strerror)
+            self._pending = self._pending[count:]
+            return count
+
+        self._output_fd.close()
+        return 0
+
     def rewind(self):
         """Rewind to the beginning of the input list"""
         if self._current_file is not None:
             self._current_file.close()
             self._current_file = None
-        self._current_idx = -1
\ No newline at end of file
+        self._current_idx = -1
+        self._pending = ""
+
+    def clone(self):
+        """
+        Returns a new reader over the same validated file list, with its own
+        position and output, so that it can feed another process concurrently
+        """
+        new_input = copy.copy(self)
+        new_input._current_file = None
+        new_input._current_idx = -1
+        new_input._output_fd = None
+        new_input._pending = ""
+        new_input.bytes_read = 0
+        return new_input
\ No newline at end of file
@@ -0,0 +1,203 @@
+#!/usr/bin/python
+# Mark's Media Framework
+# Copyright (C) 2011  Mark Pariente
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+import hashlib
+import json
+import os
+import os.path
+import shutil
+import threading
+
+from mmf import errors
+from mmf import probecache
+
+NO_CACHE_ENV_VAR = "MMF_NO_PASS_CACHE"
+CACHE_DIR_NAME = "passlog"
+
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024 # 1GB of first pass logs
+
+# Files written by an x264 first pass in ffmpeg's working directory
+PASS_LOG_FILES = ["ffmpeg2pass-0.log", "x264_2pass.log",
+                  "x264_2pass.log.mbtree"]
+
+# Bump when the first pass command line changes in ways the key can't see
+_KEY_VERSION = 1
+
+_default_cache = None
+
+def get_default_cache():
+    """
+    Returns the process-wide first pass cache, or None if caching is disabled
+    through the environment or the cache could not be opened
+    """
+    global _default_cache
+
+    if os.getenv(NO_CACHE_ENV_VAR):
+        return None
+
+    if _default_cache is None:
+        try:
+            _default_cache = PassCache(
+                os.path.join(probecache.get_cache_dir(), CACHE_DIR_NAME))
+        except errors.MMFError as e:
+            print "WARNING: " + e.msg
+            return None
+    return _default_cache
+
+def make_key(input_files, params):
+    """
+    Returns the cache key for a first pass over the input files in order
+    with the given analysis affecting parameters. Any change to an input
+    file results in a different key.
+    """
+    key_list = [_KEY_VERSION]
+    for input_file in input_files:
+        path = os.path.abspath(input_file)
+        st = os.stat(path)
+        key_list.append([path, st.st_ino, st.st_size, st.st_mtime])
+    key_list.append(params)
+    return hashlib.sha1(json.dumps(key_list, sort_keys = True)).hexdigest()
+
+def _entry_size(entry_path):
+    size = 0
+    for entry_file in os.listdir(entry_path):
+        size += os.path.getsize(os.path.join(entry_path, entry_file))
+    return size
+
+class PassCache:
+    """
+    Persistent cache of x264 first pass logs.
+
+    Each entry is a directory named by its key holding the pass log files.
+    The directory modification time records the last use, and the least
+    recently used entries are evicted once the cache grows over max_size
+    bytes.
+    """
+
+    def __init__(self, cache_dir, max_size = DEFAULT_MAX_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+        except OSError as e:
+            raise errors.MMFError("Failed to open pass cache '%s': %s" %
+                                  (cache_dir, e.strerror))
+
+    def lookup(self, key, dest_dir):
+        """
+        Copies the pass log files of a cached entry to dest_dir, returning
+        False on a miss
+        """
+        entry_path = os.path.join(self.cache_dir, key)
+        with self._lock:
+            try:
+                for log_file in PASS_LOG_FILES:
+                    shutil.copy(os.path.join(entry_path, log_file), dest_dir)
+                os.utime(entry_path, None)
+            except (IOError, OSError):
+                self.misses += 1
+                return False
+            self.hits += 1
+        return True
+
+    def store(self, key, src_dir):
+        """
+        Stores the pass log files found in src_dir under key and evicts the
+        least recently used entries over the size bound
+        """
+        entry_path = os.path.join(self.cache_dir, key)
+        temp_path = "%s.tmp-%d" % (entry_path, os.getpid())
+        with self._lock:
+            if os.path.isdir(entry_path):
+                # Stored concurrently by another encode
+                return
+            try:
+                os.mkdir(temp_path)
+                for log_file in PASS_LOG_FILES:
+                    shutil.copy(os.path.join(src_dir, log_file), temp_path)
+                # Entries only ever appear complete to other processes
+                os.rename(temp_path, entry_path)
+            except (IOError, OSError) as e:
+                print "WARNING: Failed to cache first pass logs: %s" % e
+                shutil.rmtree(temp_path, True)
+                return
+            self._evict()
+
+    def _evict(self):
+        """Drops the least recently used entries until under max_size"""
+        entries = []
+        total_size = 0
+        for key in os.listdir(self.cache_dir):
+            if ".tmp-" in key:
+                # Still being stored
+                continue
+            entry_path = os.path.join(self.cache_dir, key)
+            try:
+                entry_size = _entry_size(entry_path)
+                entries.append((os.stat(entry_path).st_mtime, entry_path,
+                                entry_size))
+            except OSError:
+                # Being evicted by another process
+                continue
+            total_size += entry_size
+
+        entries.sort()
+        for (mtime, entry_path, entry_size) in entries:
+            if total_size <= self.max_size:
+                break
+            shutil.rmtree(entry_path, True)
+            total_size -= entry_size
+
+    def clear(self):
+        """Removes all cache entries"""
+        with self._lock:
+            for key in os.listdir(self.cache_dir):
+                shutil.rmtree(os.path.join(self.cache_dir, key), True)
+
+    def get_size(self):
+        """Returns the total size in bytes of all cache entries"""
+        size = 0
+        for key in os.listdir(self.cache_dir):
+            try:
+                size += _entry_size(os.path.join(self.cache_dir, key))
+            except OSError:
+                continue
+        return size
+
+    def __len__(self):
+        return len(os.listdir(self.cache_dir))
+
+    def __repr__(self):
+        retStr = "\nPass cache: %s\n" % self.cache_dir
+        retStr += "\tEntries: %d\n" % len(self)
+        retStr += "\tSize: %d bytes (max %d)\n" % (self.get_size(),
+                                                   self.max_size)
+        retStr += "\tHits: %d\n" % self.hits
+        retStr += "\tMisses: %d\n" % self.misses
+        return retStr
+
+if __name__ == "__main__":
+    import sys
+    testCache = get_default_cache()
+    if testCache is None:
+        print "Pass cache disabled."
+        sys.exit(1)
+    if len(sys.argv) > 1 and sys.argv[1] == "clear":
+        testCache.clear()
+    print testCache
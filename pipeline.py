@@ -0,0 +1,176 @@
+#!/usr/bin/python
+# Mark's Media Framework
+# Copyright (C) 2011  Mark Pariente
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+import threading
+import time
+
+from mmf import errors
+from mmf import procgraph
+
+_WAIT_TIMEOUT = 1.0 # Keeps waits on running stages interruptible
+
+class Stage:
+    """
+    A step of a transcode pipeline. The stage's function runs once all the
+    stages it depends on have finished successfully, and signals failure by
+    raising MMFError. A stage running longer than its timeout in seconds
+    fails the pipeline.
+    """
+
+    def __init__(self, name, func, deps, timeout = None):
+        self.name = name
+        self.func = func
+        self.deps = deps
+        self.timeout = timeout
+        self.start_time = None
+        self.end_time = None
+        self.error = None
+        self._thread = None
+
+    def is_ready(self):
+        for dep in self.deps:
+            if dep.end_time is None or dep.error is not None:
+                return False
+        return True
+
+    def is_done(self):
+        return self.end_time is not None
+
+    def is_timed_out(self, now):
+        return (self.timeout is not None and self.end_time is None and
+                now - self.start_time > self.timeout)
+
+    def _run(self, cond, graphs):
+        graphs.enter()
+        try:
+            self.func()
+        except errors.MMFError as e:
+            self.error = e
+        except Exception as e:
+            self.error = errors.MMFError("Stage '%s' failed: %s" %
+                                         (self.name, e))
+        with cond:
+            self.end_time = time.time()
+            cond.notify_all()
+
+    def start(self, cond, graphs):
+        self.start_time = time.time()
+        self._thread = threading.Thread(target = self._run,
+                                        args = (cond, graphs))
+        self._thread.daemon = True
+        self._thread.start()
+
+class Pipeline:
+    """
+    Runs a graph of stages, starting every stage as soon as its dependencies
+    are done with at most max_running stages in flight at once. Stages time
+    out after stage_timeout seconds unless given their own timeout. When a
+    stage fails, times out or the run is interrupted, the process graphs run
+    by the stages still running are cancelled and cancel(), if given, is
+    called to stop them early. Graphs run by other pipelines or threads are
+    left alone.
+    """
+
+    def __init__(self, max_running = None, cancel = None,
+                 stage_timeout = None):
+        self.max_running = max_running
+        self.cancel = cancel
+        self.stage_timeout = stage_timeout
+        self.stages = []
+        self._cond = threading.Condition()
+        self._graphs = procgraph.GraphGroup()
+
+    def add_stage(self, name, func, deps = None, timeout = None):
+        """
+        Adds a stage running func() after deps and returns it, failing the
+        pipeline if it runs longer than timeout seconds
+        """
+        if timeout is None:
+            timeout = self.stage_timeout
+        stage = Stage(name, func, list(deps or []), timeout)
+        self.stages.append(stage)
+        return stage
+
+    def run(self):
+        """
+        Runs all stages to completion. If a stage fails no further stages
+        are started, the running ones are cancelled and waited for and the
+        first error is raised.
+        """
+        pending = list(self.stages)
+        running = []
+        error = None
+        with self._cond:
+            try:
+                while len(running) > 0 or (len(pending) > 0 and error is None):
+                    for stage in list(pending):
+                        if error is not None:
+                            break
+                        if (self.max_running is not None and
+                            len(running) >= self.max_running):
+                            break
+                        if stage.is_ready():
+                            pending.remove(stage)
+                            running.append(stage)
+                            stage.start(self._cond, self._graphs)
+
+                    if len(running) == 0:
+                        if len(pending) > 0 and error is None:
+                            raise errors.MMFError(
+                                "Pipeline stage '%s' can never run" %
+                                pending[0].name)
+                        break
+
+                    self._cond.wait(_WAIT_TIMEOUT)
+
+                    now = time.time()
+                    for stage in list(running):
+                        if stage.is_done():
+                            running.remove(stage)
+                            if stage.error is not None and error is None:
+                                error = stage.error
+                                self._cancel()
+                        elif stage.is_timed_out(now) and error is None:
+                            error = errors.MMFError(
+                                "Stage '%s' timed out after %d seconds" %
+                                (stage.name, stage.timeout))
+                            self._cancel()
+            except KeyboardInterrupt:
+                # Wait for the cancelled stages so that none of their
+                # processes outlive the interrupted run
+                self._cancel()
+                while any(not stage.is_done() for stage in running):
+                    self._cond.wait(_WAIT_TIMEOUT)
+                raise
+
+        if error is not None:
+            raise error
+
+    def _cancel(self):
+        self._graphs.cancel()
+        if self.cancel is not None:
+            self.cancel()
+
+    def __repr__(self):
+        retStr = "\nPipeline stages:\n"
+        start_times = [stage.start_time for stage in self.stages
+                       if stage.start_time is not None]
+        for stage in self.stages:
+            if stage.end_time is not None:
+                retStr += "\t%s: %.1f - %.1f seconds\n" % (
+                    stage.name, stage.start_time - min(start_times),
+                    stage.end_time - min(start_times))
+            else:
+                retStr += "\t%s: not run\n" % stage.name
+        return retStr
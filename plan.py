@@ -0,0 +1,410 @@
+#!/usr/bin/python
+# Mark's Media Framework
+# Copyright (C) 2011  Mark Pariente
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+import json
+import os
+import os.path
+
+from mmf import errors
+from mmf import targetconfig
+from mmf import vidparse
+
+# H.264 profiles in increasing order of decoder requirements
+_H264_PROFILES = ["baseline", "main", "high"]
+
+def _calc_scaled_bitrate(target_config, video_max_bitrate,
+                         scaled_width, scaled_height):
+    return (int(video_max_bitrate * 
+            float(scaled_width * scaled_height) /
+            float(target_config.video_max_width * 
+                  target_config.video_max_height)))
+
+def _calc_audio_bitrate(vid_info, target_config, warnings):
+    """Returns the audio bit rate in bps to encode with for a target"""
+    if vid_info.audio_bitrate is None:
+        warnings.append("No audio bitrate information for %s using %d Kbps" %
+                        (vid_info.input_file_name,
+                         target_config.audio_max_bitrate))
+        audio_bitrate = target_config.audio_max_bitrate
+    else:
+        audio_bitrate = min(vid_info.audio_bitrate,
+                            target_config.audio_max_bitrate)
+    if audio_bitrate < target_config.audio_max_bitrate:
+        # Round up bitrate to a standard step unless it is > 320 in which
+        # case just keep it
+        audio_bitrate_steps = [320, 256, 192, 160, 128, 112, 96, 64, 0]
+        prev_rate = audio_bitrate
+        for rate in audio_bitrate_steps:
+            if audio_bitrate > rate:
+                audio_bitrate = prev_rate
+                break
+            prev_rate = rate
+    return audio_bitrate * 1000
+
+def _calc_h264_profile_level(vid_info, target_config):
+    """Returns the (profile, level) strings to pass to ffmpeg for a target"""
+    if target_config.codec_h264_same:
+        # use same profile/level as input
+        if vid_info.vid_format_profile is None:
+            raise errors.MMFError(
+                "Same H.264 profile/level as input requested, but no info \
+found in input file.")
+        partition = vid_info.vid_format_profile.partition('@')
+        h264_profile_str = partition[0].lower()
+        h264_level_str = partition[2].replace('.','').replace('L','')
+    else:
+        # use target preset for profile/level
+        h264_level_str = target_config.codec_h264_level.replace('.', '')
+        h264_profile_str = target_config.codec_h264_profile.lower()
+    return (h264_profile_str, h264_level_str)
+
+def _calc_video_max_bitrate(vid_info, target_config, video_bitrate):
+    """
+    Returns the maximum video bit rate in Kbps for a target given an optional
+    user override
+    """
+    if video_bitrate is not None:
+        return min(target_config.video_max_bitrate, int(video_bitrate))
+    elif vid_info.vid_bitrate is not None:
+        return min(target_config.video_max_bitrate, vid_info.vid_bitrate)
+    else:
+        raise errors.MMFError(
+            "No video bitrate information for '%s' use -v [bitrate]" %
+            vid_info.input_file_name)
+
+def _calc_video_size(vid_info, target_config, video_max_bitrate):
+    """
+    Returns a (size, bit_rate) tuple for a target where size is the
+    (width, height) to scale to, or None if no scaling is needed, and
+    bit_rate is the video bit rate in Kbps
+    """
+    if vid_info.vid_width is None or vid_info.vid_height is None:
+        raise errors.MMFError("No video width/height information for '%s'" %
+                              vid_info.input_file_name)
+
+    if vid_info.vid_width > target_config.video_max_width:
+        # Scale down width and see if height is within maximum allowed
+        scale_factor = (float(target_config.video_max_width) /
+                        vid_info.vid_width)
+        scaled_height = int(float(vid_info.vid_height) * scale_factor)
+        if scaled_height % 2 == 1: # make sure scaled height divisible by 2
+            scaled_height += 1
+        if scaled_height < target_config.video_max_height:
+            size = (target_config.video_max_width, scaled_height)
+            bit_rate = _calc_scaled_bitrate(target_config,
+                                            video_max_bitrate,
+                                            target_config.video_max_width,
+                                            scaled_height)
+        else:
+            # Failed, have to break aspect ratio
+            size = (target_config.video_max_width,
+                    target_config.video_max_height)
+            bit_rate = video_max_bitrate
+    elif vid_info.vid_height > target_config.video_max_height:
+        # Scale down height and see if width is within maximum allowed
+        scale_factor = (float(target_config.video_max_height) /
+                        vid_info.vid_height)
+        scaled_width = int(float(vid_info.vid_width) * scale_factor)
+        if scaled_width % 2 == 1: # make sure scaled width divisible by 2
+            scaled_width += 1
+        if scaled_width < target_config.video_max_width:
+            size = (scaled_width, target_config.video_max_height)
+            bit_rate = _calc_scaled_bitrate(target_config,
+                                            video_max_bitrate,
+                                            scaled_width,
+                                            target_config.video_max_height)
+        else:
+            # Failed, have to break aspect ratio
+            size = (target_config.video_max_width,
+                    target_config.video_max_height)
+            bit_rate = video_max_bitrate
+    else:
+        # Video is smaller than target's max width/height, use max bitrate
+        size = None
+        bit_rate = video_max_bitrate
+    return (size, bit_rate)
+
+def _calc_interlace(vid_info, target_config, warnings):
+    """
+    Returns a (deinterlace, ildct, fps) tuple for a target, where deinterlace
+    means the input needs a yadif pass, ildct means the output should be
+    encoded interlaced and fps is the output frame rate to force, if any
+    """
+    if vid_info.vid_interlaced:
+        if target_config.video_interlaced:
+            deinterlace = False
+            ildct = True
+        else:
+            deinterlace = True
+            ildct = False
+
+        if vid_info.vid_fps is None:
+            fps = None
+        elif vid_info.vid_fps == 23.976:
+            fps = "24000/1001"
+        elif vid_info.vid_fps == 29.970:
+            fps = "30000/1001"
+        else:
+            fps = str(vid_info.vid_fps)
+    else:
+        if target_config.video_interlaced:
+            warnings.append("Interlaced output for progressive input not \
+supported!")
+        deinterlace = False
+        ildct = False
+        fps = None
+    return (deinterlace, ildct, fps)
+
+def _can_copy_video(vid_info, target_config):
+    """
+    Returns whether the input video stream already satisfies a target, i.e.
+    it is H.264 within the target's profile, level, size and bit rate limits
+    and needs no deinterlacing, so it can be copied without re-encoding
+    """
+    if (vid_info.vid_codec != vidparse.VIDEO_CODEC_H264 or
+        vid_info.vid_format_profile is None):
+        return False
+
+    partition = vid_info.vid_format_profile.partition('@')
+    profile = partition[0].lower().replace("constrained ", "")
+    if profile not in _H264_PROFILES:
+        return False
+    if not target_config.codec_h264_same:
+        target_profile = target_config.codec_h264_profile.lower()
+        if target_profile not in _H264_PROFILES:
+            return False
+        try:
+            level = float(partition[2].replace('L', ''))
+            target_level = float(target_config.codec_h264_level)
+        except ValueError:
+            return False
+        if (_H264_PROFILES.index(profile) >
+            _H264_PROFILES.index(target_profile) or level > target_level):
+            return False
+
+    if (vid_info.vid_width is None or vid_info.vid_height is None or
+        vid_info.vid_width > target_config.video_max_width or
+        vid_info.vid_height > target_config.video_max_height):
+        return False
+    if (vid_info.vid_bitrate is None or
+        vid_info.vid_bitrate > target_config.video_max_bitrate):
+        return False
+    if vid_info.vid_interlaced and not target_config.video_interlaced:
+        return False
+    return True
+
+def _can_copy_audio(vid_info, target_config):
+    """
+    Returns whether the input audio stream is AAC within the target's bit
+    rate, sample rate and channel limits so it can be copied without
+    re-encoding
+    """
+    return (vid_info.audio_format == "AAC" and
+            vid_info.audio_bitrate is not None and
+            vid_info.audio_bitrate <= target_config.audio_max_bitrate and
+            vid_info.audio_samplerate == target_config.audio_sample_rate and
+            vid_info.audio_channels is not None and
+            vid_info.audio_channels <= target_config.audio_channel_count)
+
+class TranscodePlan:
+    """
+    Encoding decisions for one input against one target. Plans are computed
+    by plan_transcode() from probe results alone, without running anything.
+    """
+
+    def __init__(self, input_file_name, target_config):
+        self.input_file_name = input_file_name
+        self.target_name = target_config.target_name
+        self.target_file = target_config.target_file
+        self.copy_video = False
+        self.copy_audio = False
+        self.h264_profile = None
+        self.h264_level = None
+        self.size = None # (width, height) to scale to, None for no scaling
+        self.video_bitrate = None # Kbps
+        self.deinterlace = False
+        self.ildct = False
+        self.fps = None # Output frame rate to force, None to keep input's
+        self.audio_bitrate = None # bps
+        self.audio_channels = target_config.audio_channel_count
+        self.audio_sample_rate = target_config.audio_sample_rate
+        self.vid_stream_id = None
+        self.audio_stream_id = None
+        self.warnings = []
+
+    def get_video_str(self, preset = None, filtered = False, crf = None):
+        """
+        Returns the ffmpeg video encoding options. With filtered set, scaling
+        and deinterlacing are left to a filter graph built by the caller.
+        With crf set, constant quality rate control replaces the bit rate.
+        """
+        if self.copy_video:
+            return " -vcodec copy"
+
+        video_str = ""
+        if self.size is not None and not filtered:
+            video_str += " -s %dx%d" % self.size
+        video_str += (" -vcodec libx264 -threads 0 -level " + self.h264_level)
+        if preset:
+            video_str += " -preset " + preset
+        video_str += " -vprofile " + self.h264_profile
+        if crf is not None:
+            video_str += " -crf " + str(crf)
+        else:
+            video_str += " -b:v " + str(self.video_bitrate * 1000)
+        if self.ildct:
+            video_str += " -flags +ildct"
+        elif self.deinterlace and not filtered:
+            video_str += " -vf yadif=1"
+        if self.fps is not None:
+            video_str += " -r " + self.fps
+        return video_str
+
+    def get_audio_str(self):
+        """Returns the ffmpeg audio encoding options"""
+        if self.copy_audio:
+            return " -acodec copy"
+        return (" -acodec libvo_aacenc -ac " + str(self.audio_channels) +
+                " -ar " + str(self.audio_sample_rate) + " -ab " +
+                str(self.audio_bitrate))
+
+    def get_stream_map_str(self):
+        """
+        Returns the ffmpeg stream mapping that takes the video from the first
+        input and the audio from a separately encoded second input
+        """
+        if self.audio_stream_id is None or self.vid_stream_id is None:
+            return ""
+        elif self.audio_stream_id > self.vid_stream_id:
+            return " -map 0:0 -map 1:0"
+        else:
+            return " -map 0:1 -map 1:0"
+
+    def get_fields(self):
+        """Returns the plan as a dict suitable for JSON serialization"""
+        return {"input": self.input_file_name,
+                "target": self.target_name,
+                "target_file": self.target_file,
+                "copy_video": self.copy_video,
+                "copy_audio": self.copy_audio,
+                "h264_profile": self.h264_profile,
+                "h264_level": self.h264_level,
+                "size": self.size,
+                "video_bitrate": self.video_bitrate,
+                "deinterlace": self.deinterlace,
+                "ildct": self.ildct,
+                "fps": self.fps,
+                "audio_bitrate": self.audio_bitrate,
+                "audio_channels": self.audio_channels,
+                "audio_sample_rate": self.audio_sample_rate,
+                "warnings": self.warnings}
+
+    def __repr__(self):
+        retStr = "\nPlan for %s -> %s\n" % (self.input_file_name,
+                                             self.target_name)
+        retStr += "Video: %s\n" % self.get_video_str()
+        retStr += "Audio: %s\n" % self.get_audio_str()
+        for warning in self.warnings:
+            retStr += "WARNING: %s\n" % warning
+        return retStr
+
+def plan_transcode(vid_info, target_config, video_bitrate = None,
+                   start_offset = None, passthrough = True):
+    """
+    Returns the TranscodePlan for encoding a probed input to a target, with
+    an optional video bit rate override in Kbps. With passthrough set,
+    streams that already satisfy the target are copied. Raises MMFError if
+    the input lacks information needed to plan the encode.
+    """
+    plan = TranscodePlan(vid_info.input_file_name, target_config)
+    plan.vid_stream_id = vid_info.vid_stream_id
+    plan.audio_stream_id = vid_info.audio_stream_id
+
+    # Seeking only lands on keyframes when copying video, so an offset always
+    # gets re-encoded, as does a user requested video bitrate
+    plan.copy_video = (passthrough and not start_offset and
+                       video_bitrate is None and
+                       _can_copy_video(vid_info, target_config))
+    plan.copy_audio = passthrough and _can_copy_audio(vid_info, target_config)
+
+    plan.audio_bitrate = _calc_audio_bitrate(vid_info, target_config,
+                                             plan.warnings)
+    if plan.copy_video:
+        return plan
+
+    (plan.h264_profile, plan.h264_level) = _calc_h264_profile_level(
+        vid_info, target_config)
+    video_max_bitrate = _calc_video_max_bitrate(vid_info, target_config,
+                                                video_bitrate)
+    (plan.size, plan.video_bitrate) = _calc_video_size(vid_info, target_config,
+                                                       video_max_bitrate)
+    (plan.deinterlace, plan.ildct, plan.fps) = _calc_interlace(
+        vid_info, target_config, plan.warnings)
+    return plan
+
+def find_files(path_list):
+    """
+    Expands directories in a list of paths to the media files under them.
+    Paths that aren't directories are kept whatever their extension.
+    """
+    file_list = []
+    for path in path_list:
+        if not os.path.isdir(path):
+            file_list.append(path)
+            continue
+        for (dir_path, dir_names, file_names) in os.walk(path):
+            dir_names.sort()
+            for file_name in sorted(file_names):
+                if vidparse.is_media_file(file_name):
+                    file_list.append(os.path.join(dir_path, file_name))
+    return file_list
+
+def probe_library(file_list, cache):
+    """
+    Returns a (parser, error) tuple per file, probing in batches. A file
+    that fails to probe only gets an error of its own.
+    """
+    return vidparse.probe_batch_results(file_list, cache)
+
+def plan_library(path_list, target_list, video_bitrate = None,
+                 start_offset = None, passthrough = True, cache = None):
+    """
+    Plans every file in path_list, with directories searched recursively,
+    against every TargetConfig in target_list. Returns a list of plan field
+    dicts, with an "error" entry instead for inputs that can't be planned.
+    """
+    plan_list = []
+    file_list = find_files(path_list)
+    for (file_name, (parser, error)) in zip(file_list,
+                                            probe_library(file_list, cache)):
+        for target_config in target_list:
+            if parser is not None:
+                try:
+                    plan_list.append(plan_transcode(parser, target_config,
+                                                    video_bitrate,
+                                                    start_offset,
+                                                    passthrough).get_fields())
+                    continue
+                except errors.MMFError as e:
+                    error = e
+            plan_list.append({"input": file_name,
+                              "target": target_config.target_name,
+                              "target_file": target_config.target_file,
+                              "error": error.msg})
+    return plan_list
+
+if __name__ == "__main__":
+    import sys
+    testConfig = targetconfig.TargetConfig(sys.argv[1])
+    print json.dumps(plan_library(sys.argv[2:], [testConfig]), indent = 2)
@@ -13,14 +13,202 @@
 # GNU General Public License for more details.
 
 import optparse
+import os.path
 import subprocess
 import sys
+import time
 
+from mmf import decodecaps
+from mmf import multifile
+from mmf import plan
+from mmf import probecache
+from mmf import procgraph
 from mmf import vidparse
 from mmf import errors
 
+# mplayer stderr output meaning hardware decoding or output doesn't work
+_HW_FAILURE_MARKERS = ["FATAL:", "[vdpau] Error"]
+
+_PLAYLIST_EXTENSIONS = [".m3u", ".m3u8"]
+
+# Playlist items probed in the background ahead of the one playing
+DEFAULT_PREFETCH = 2
+
+# Seconds of hardware playback without failure before the video's kind is
+# recorded as decoding fine in hardware. Shorter runs, even ones that exit
+# cleanly, record nothing.
+_HW_CONFIRM_TIME = 5.0
+
+class _FailureWatch:
+    """
+    Follows mplayer's stderr while it plays and stops it as soon as hardware
+    decoding fails, instead of letting it give up or hang
+    """
+
+    def __init__(self):
+        self.process = None
+        self.failure = None
+        self._partial = ""
+
+    def feed(self, data):
+        lines = (self._partial + data).split("\n")
+        self._partial = lines.pop()
+        if data == "":
+            lines.append(self._partial)
+        for line in lines:
+            if self.failure is not None:
+                break
+            for marker in _HW_FAILURE_MARKERS:
+                if marker in line:
+                    self.failure = line.strip()
+                    self.process.terminate()
+                    break
+
+def _play_hardware(mplayer_cmdline):
+    """
+    Plays with hardware decoding, returning a (failure, seconds played)
+    tuple where failure is the offending mplayer output or None
+    """
+    watch = _FailureWatch()
+    graph = procgraph.ProcessGraph()
+    # The shell interprets the command line as with software decoding (e.g.
+    # quoting in --mplayer-opts) and exec leaves mplayer as the process
+    # that gets terminated on failure
+    watch.process = graph.add_process("mplayer",
+                                      ["/bin/sh", "-c",
+                                       "exec " + mplayer_cmdline],
+                                      echo_stderr = False,
+                                      on_stderr = watch.feed)
+    start_time = time.time()
+    try:
+        graph.run()
+    except errors.MMFError as e:
+        return (e.msg, 0.0)
+    return (watch.failure, time.time() - start_time)
+
+class PlaybackPlan:
+    """
+    mplayer options for playing a probed video with VDPAU decoding and
+    output, and with software decoding as a fallback
+    """
+
+    def __init__(self, vid_info):
+        self.vid_info = vid_info
+        self.vdpau_codec = ""
+        self.vdpau_opts = ""
+        self.sw_opts = ""
+
+        # Deinterlace for non-progressive videos
+        if vid_info.vid_interlaced is not None:
+            if vid_info.vid_interlaced:
+                self.vdpau_opts = self.vdpau_opts + ":deint=4"
+                self.sw_opts = self.sw_opts + "-vf pp=yadif:1"
+            else:
+                # Sharpen and de-noise progressive videos. Using these
+                # filters in conjunction with deinterlace puts too much load
+                # on the GPU
+                self.vdpau_opts = self.vdpau_opts + ":sharpen=0.4:denoise=0.4"
+
+        # HQ scaling only if video isn't in native resolution
+        if ((vid_info.vid_width is not None) and
+            (vid_info.vid_height is not None)):
+            if vid_info.vid_width != 1920 and vid_info.vid_height != 1080:
+                self.vdpau_opts = self.vdpau_opts + ":hqscaling=1"
+
+        # Codec selection
+        if vid_info.vid_codec is not None:
+            if vid_info.vid_codec == vidparse.VIDEO_CODEC_H264:
+                self.vdpau_codec = "-vc ffh264vdpau"
+            elif vid_info.vid_codec == vidparse.VIDEO_CODEC_WMV3:
+                self.vdpau_codec = "-vc ffwmv3vdpau"
+            elif vid_info.vid_codec == vidparse.VIDEO_CODEC_DIVX:
+                self.vdpau_codec = "-vc ffodivxvdpau"
+            elif vid_info.vid_codec == vidparse.VIDEO_CODEC_MPEG12:
+                self.vdpau_codec = "-vc ffmpeg12vdpau"
+            elif vid_info.vid_codec == vidparse.VIDEO_CODEC_VC1:
+                self.vdpau_codec = "-vc ffvc1vdpau"
+
+    def __repr__(self):
+        retStr = "VDPAU options: " + self.vdpau_opts + "\n"
+        retStr += "VDPAU codec: " + self.vdpau_codec + "\n"
+        retStr += "S/W options: " + self.sw_opts
+        return retStr
+
+def _read_playlist(playlist_file):
+    """Returns the entries of an m3u playlist, relative to its directory"""
+    try:
+        playlist_fd = open(playlist_file, 'r')
+    except IOError as e:
+        raise errors.MMFError("Failed to read playlist '%s': %s" %
+                              (playlist_file, e.strerror))
+    entries = []
+    for line in playlist_fd:
+        line = line.strip()
+        if line == "" or line.startswith("#"):
+            continue
+        entries.append(os.path.join(os.path.dirname(playlist_file), line))
+    playlist_fd.close()
+    return entries
+
+def _expand_inputs(path_list):
+    """
+    Expands playlists and directories (searched recursively) in a list of
+    inputs to the files to play in order
+    """
+    expanded_list = []
+    for path in path_list:
+        if os.path.splitext(path)[1].lower() in _PLAYLIST_EXTENSIONS:
+            expanded_list.extend(_read_playlist(path))
+        else:
+            expanded_list.append(path)
+    return plan.find_files(expanded_list)
+
+def _play(options, mplayer_str, input_file, play_plan, caps):
+    """
+    Plays a file with VDPAU, falling back to software decoding if that
+    fails now or failed before for this kind of video
+    """
+    # Kinds of video hardware decoding failed for before go straight to
+    # software
+    caps_key = decodecaps.make_key(play_plan.vid_info)
+    if caps is not None and not options.retry_hw:
+        hw_works = caps.lookup(caps_key)
+    else:
+        hw_works = None
+
+    if hw_works is False:
+        print ("Hardware decoding of %s failed before on this machine, use \
+--retry-hw to try again." % caps_key)
+        failure = "known failure"
+    else:
+        mplayer_cmdline = ("-vo vdpau" + play_plan.vdpau_opts + " " +
+                           play_plan.vdpau_codec + " " +
+                           options.mplayer_opts + " \"" + input_file + "\"")
+        print "Running: " + mplayer_str + " " + mplayer_cmdline + "\n"
+        (failure, played) = _play_hardware(mplayer_str + " " +
+                                           mplayer_cmdline)
+        if failure is not None:
+            print "Hardware decoding failure: " + failure
+        if caps is not None:
+            if failure is not None:
+                caps.store(caps_key, False)
+            elif played >= _HW_CONFIRM_TIME:
+                caps.store(caps_key, True)
+    
+    if failure is not None:
+        print ""
+        print "== Hardware decoding FAILED. Falling back to software. =="
+        print ""
+        mplayer_cmdline = (play_plan.sw_opts + " " + options.mplayer_opts +
+                           " \"" + input_file + "\"")
+        print "Running: " + mplayer_str + " " + mplayer_cmdline + "\n"
+    
+        p = subprocess.Popen(mplayer_str + " " + mplayer_cmdline, shell=True)
+        p.communicate()
+
 def main(argv = sys.argv):
-    optparser = optparse.OptionParser()
+    optparser = optparse.OptionParser(
+        usage = "%prog [options] files, directories or m3u playlists")
     optparser.add_option("-d", "--debug", type="int", dest="debug_level",
                          help="Enable debug logging")
     optparser.add_option("-m", "--mplayer-opts", action="store",
@@ -29,6 +217,14 @@ def main(argv = sys.argv):
     optparser.add_option("-2", "--use-mplayer2", action = "store_true",
                          dest="use_mplayer2",
                          help="Use mplayer2 instead of mplayer")
+    optparser.add_option("--retry-hw", action = "store_true",
+                         dest="retry_hw",
+                         help="Try hardware decoding even if it failed \
+before for this kind of video")
+    optparser.add_option("--prefetch", type="int", dest="prefetch",
+                         default=DEFAULT_PREFETCH,
+                         help="Number of upcoming playlist items to probe \
+in the background while one plays (default %d)" % DEFAULT_PREFETCH)
     (options, extra_args) = optparser.parse_args()
     
     if not options.mplayer_opts:
@@ -44,76 +240,42 @@ def main(argv = sys.argv):
     DECISION_LOG = options.debug_level
     
     try:
-        vid_info = vidparse.VidParser(extra_args[0])
+        file_list = _expand_inputs(extra_args)
     except errors.MMFError as e:
         print e.msg
         sys.exit(1)
-    
-    # Decision steps
-    vdpau_codec=""
-    vdpau_opts=""
-    sw_opts=""
-    
-    # Deinterlace for non-progressive videos
-    if vid_info.vid_interlaced is not None:
-        if vid_info.vid_interlaced:
-            vdpau_opts = vdpau_opts + ":deint=4"
-            sw_opts = sw_opts + "-vf pp=yadif:1"
-        else:
-            # Sharpen and de-noise progressive videos. Using these filters in
-            # conjunction with deinterlace puts too much load on the GPU
-            vdpau_opts = vdpau_opts + ":sharpen=0.4:denoise=0.4"
-
-    # HQ scaling only if video isn't in native resolution
-    if (vid_info.vid_width is not None) and (vid_info.vid_height is not None):
-        if vid_info.vid_width != 1920 and vid_info.vid_height != 1080:
-            vdpau_opts = vdpau_opts + ":hqscaling=1"          
-    
-    # Codec selection
-    if vid_info.vid_codec is not None:  
-        if vid_info.vid_codec == vidparse.VIDEO_CODEC_H264:
-            vdpau_codec = "-vc ffh264vdpau"
-        elif vid_info.vid_codec == vidparse.VIDEO_CODEC_WMV3:
-            vdpau_codec = "-vc ffwmv3vdpau"
-        elif vid_info.vid_codec == vidparse.VIDEO_CODEC_DIVX:
-            vdpau_codec = "-vc ffodivxvdpau"
-        elif vid_info.vid_codec == vidparse.VIDEO_CODEC_MPEG12:
-            vdpau_codec = "-vc ffmpeg12vdpau"
-        elif vid_info.vid_codec == vidparse.VIDEO_CODEC_VC1:
-            vdpau_codec = "-vc ffvc1vdpau"
-        
-    if DECISION_LOG >= 1:
-        print "VDPAU options: " + vdpau_opts
-        print "VDPAU codec: " + vdpau_codec
-        print "S/W options: " + sw_opts
+    if len(file_list) == 0:
+        print "Nothing to play, exiting."
+        sys.exit(1)
     
     if options.use_mplayer2:
         mplayer_str = "mplayer2"
     else:
         mplayer_str = "mplayer"
+    caps = decodecaps.get_default_caps()
+
+    # Upcoming items are probed while the current one plays, so the next
+    # one starts without waiting for mediainfo
+    prefetch = max(0, options.prefetch)
+    probe_pool = multifile.ProbePool(file_list,
+                                     probecache.get_default_cache(),
+                                     max(1, prefetch), prefetch)
+    try:
+        for (idx, input_file) in enumerate(file_list):
+            (vid_info, error) = probe_pool.get(idx)
+            if error is not None:
+                print error.msg
+                if len(file_list) == 1:
+                    sys.exit(1)
+                print "Skipping " + input_file
+                continue
     
-    mplayer_cmdline = ("-vo vdpau" + vdpau_opts + " " + vdpau_codec + " " +
-                       options.mplayer_opts + " \"" + "".join(extra_args[0:]) +
-                       "\"")
-    print "Running: " + mplayer_str + " " + mplayer_cmdline + "\n"
-    
-    p = subprocess.Popen(mplayer_str + " " + mplayer_cmdline, shell=True,
-                         stderr=subprocess.PIPE)
-    p_errlog = p.communicate()
-    p_errlog_tokenized = p_errlog[1].split("\n")
-    
-    fatal = 0
-    for p_errlog_line in p_errlog_tokenized:
-        if "FATAL:" in p_errlog_line:
-            fatal = 1
-    
-    if fatal == 1:
-        print ""
-        print "== Hardware decoding FAILED. Falling back to software. =="
-        print ""
-        mplayer_cmdline = (sw_opts + " " + options.mplayer_opts + " \"" +
-                           "".join(extra_args[0:]) + "\"")
-        print "Running: " + mplayer_str + " " + mplayer_cmdline + "\n"
-    
-        p = subprocess.Popen(mplayer_str + " " + mplayer_cmdline, shell=True)
-        p.communicate()
\ No newline at end of file
+            if len(file_list) > 1:
+                print "Playing %d/%d: %s" % (idx + 1, len(file_list),
+                                             input_file)
+            play_plan = PlaybackPlan(vid_info)
+            if DECISION_LOG >= 1:
+                print play_plan
+            _play(options, mplayer_str, input_file, play_plan, caps)
+    finally:
+        probe_pool.cancel()
@@ -0,0 +1,307 @@
+#!/usr/bin/python
+# Mark's Media Framework
+# Copyright (C) 2011  Mark Pariente
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+import atexit
+import json
+import os
+import os.path
+import sqlite3
+import sys
+import threading
+import time
+
+from mmf import errors
+
+CACHE_ENV_VAR = "MMF_CACHE_DIR"
+NO_CACHE_ENV_VAR = "MMF_NO_PROBE_CACHE"
+DEFAULT_CACHE_DIR = "~/.mmf/cache"
+CACHE_FILE_NAME = "probe.db"
+
+DEFAULT_MAX_ENTRIES = 50000
+DEFAULT_MAX_AGE = 30 * 24 * 60 * 60 # 30 days in seconds
+
+# Lookups between writes of the batched access times and hit/miss counters
+_FLUSH_LOOKUPS = 64
+
+_default_cache = None
+
+def get_cache_dir():
+    """Returns the directory used for MMF's on-disk caches"""
+    env_dir = os.getenv(CACHE_ENV_VAR)
+    if env_dir is not None:
+        return env_dir
+    return os.path.expanduser(DEFAULT_CACHE_DIR)
+
+def get_default_cache():
+    """
+    Returns the process-wide probe cache, or None if caching is disabled
+    through the environment or the cache could not be opened
+    """
+    global _default_cache
+
+    if os.getenv(NO_CACHE_ENV_VAR):
+        return None
+
+    if _default_cache is None:
+        try:
+            _default_cache = ProbeCache(
+                os.path.join(get_cache_dir(), CACHE_FILE_NAME))
+        except errors.MMFError as e:
+            print "WARNING: " + e.msg
+            return None
+    return _default_cache
+
+def _get_fs_encoding():
+    return sys.getfilesystemencoding() or "utf-8"
+
+def decode_path(path):
+    """
+    Returns a file system path as unicode for binding into sqlite3, which
+    refuses non-ASCII byte strings. Names that don't fit the file system
+    encoding (e.g. UTF-8 names under the C locale) are read as UTF-8.
+    Returns None for a path that is valid in neither.
+    """
+    if isinstance(path, unicode):
+        return path
+    for encoding in (_get_fs_encoding(), "utf-8"):
+        try:
+            return path.decode(encoding)
+        except UnicodeDecodeError:
+            pass
+    return None
+
+def encode_path(path):
+    """Returns a path read from sqlite3 as a file system byte string"""
+    if not isinstance(path, unicode):
+        return path
+    try:
+        return path.encode(_get_fs_encoding())
+    except UnicodeEncodeError:
+        return path.encode("utf-8")
+
+def _file_identity(file_name):
+    """
+    Returns the (path, inode, size, mtime) cache key for a file, with path
+    None if the file can't be cached
+    """
+    path = os.path.abspath(file_name)
+    st = os.stat(path)
+    return (decode_path(path), st.st_ino, st.st_size, st.st_mtime)
+
+class ProbeCache:
+    """
+    Persistent cache of parsed mediainfo results keyed on file identity.
+
+    Entries are keyed on the absolute path, inode, size and modification time
+    of the probed file so any change to the file results in a miss. The cache
+    is bounded both in entry count and entry age, with least recently used
+    entries evicted first.
+
+    Hits don't write to the database right away: access times and the hit and
+    miss counters kept in the database are written in batches, with the next
+    store(), every _FLUSH_LOOKUPS lookups and at exit.
+    """
+
+    def __init__(self, cache_path, max_entries = DEFAULT_MAX_ENTRIES,
+                 max_age = DEFAULT_MAX_AGE):
+        self.cache_path = cache_path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._pending_access = {}
+        self._pending_hits = 0
+        self._pending_misses = 0
+
+        cache_dir = os.path.dirname(os.path.abspath(cache_path))
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            self._db = sqlite3.connect(cache_path, timeout = 30,
+                                       check_same_thread = False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS probe ("
+                "path TEXT PRIMARY KEY, inode INTEGER, size INTEGER, "
+                "mtime REAL, fields TEXT, created REAL, last_access REAL)")
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS probe_last_access "
+                "ON probe (last_access)")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS stats ("
+                "name TEXT PRIMARY KEY, value INTEGER)")
+            self._db.execute(
+                "INSERT OR IGNORE INTO stats VALUES ('hits', 0)")
+            self._db.execute(
+                "INSERT OR IGNORE INTO stats VALUES ('misses', 0)")
+            self._db.commit()
+        except (OSError, sqlite3.Error) as e:
+            raise errors.MMFError("Failed to open probe cache '%s': %s" %
+                                  (cache_path, e))
+        atexit.register(self.flush)
+
+    def lookup(self, file_name):
+        """Returns the cached field dict for a file, or None on a miss"""
+        try:
+            (path, inode, size, mtime) = _file_identity(file_name)
+        except OSError:
+            return None
+        if path is None:
+            return None
+
+        with self._lock:
+            try:
+                row = self._db.execute(
+                    "SELECT inode, size, mtime, fields, created FROM probe "
+                    "WHERE path = ?", (path,)).fetchone()
+            except sqlite3.Error as e:
+                print "WARNING: Failed to read probe cache '%s': %s" % (
+                    self.cache_path, e)
+                return None
+            now = time.time()
+            if (row is None or row[0] != inode or row[1] != size or
+                row[2] != mtime or now - row[4] > self.max_age):
+                self.misses += 1
+                self._pending_misses += 1
+                row = None
+            else:
+                self.hits += 1
+                self._pending_hits += 1
+                self._pending_access[path] = now
+            if self._pending_hits + self._pending_misses >= _FLUSH_LOOKUPS:
+                self._flush_and_commit()
+        if row is None:
+            return None
+        return json.loads(row[3])
+
+    def _flush(self):
+        """Writes the batched access times and counters, without committing"""
+        self._db.executemany(
+            "UPDATE probe SET last_access = ? WHERE path = ?",
+            [(access, path) for (path, access) in
+             self._pending_access.iteritems()])
+        self._db.execute("UPDATE stats SET value = value + ? WHERE name = ?",
+                         (self._pending_hits, "hits"))
+        self._db.execute("UPDATE stats SET value = value + ? WHERE name = ?",
+                         (self._pending_misses, "misses"))
+        self._pending_access = {}
+        self._pending_hits = 0
+        self._pending_misses = 0
+
+    def _flush_and_commit(self):
+        try:
+            self._flush()
+            self._db.commit()
+        except sqlite3.Error as e:
+            print "WARNING: Failed to update probe cache '%s': %s" % (
+                self.cache_path, e)
+
+    def flush(self):
+        """Writes the batched access times and hit/miss counters"""
+        with self._lock:
+            if (len(self._pending_access) == 0 and self._pending_hits == 0 and
+                self._pending_misses == 0):
+                return
+            self._flush_and_commit()
+
+    def get_totals(self):
+        """Returns the (hits, misses) of all processes using the cache"""
+        self.flush()
+        with self._lock:
+            totals = dict(self._db.execute(
+                "SELECT name, value FROM stats").fetchall())
+        return (totals.get("hits", 0), totals.get("misses", 0))
+
+    def store(self, file_name, fields):
+        """Stores the field dict for a file and evicts stale entries"""
+        try:
+            (path, inode, size, mtime) = _file_identity(file_name)
+        except OSError:
+            return
+        if path is None:
+            return
+
+        with self._lock:
+            now = time.time()
+            try:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO probe VALUES "
+                    "(?, ?, ?, ?, ?, ?, ?)",
+                    (path, inode, size, mtime, json.dumps(fields), now, now))
+                self._flush()
+                self._evict(now)
+                self._db.commit()
+            except sqlite3.Error as e:
+                # Only costs a probe next time
+                self._db.rollback()
+                print "WARNING: Failed to update probe cache '%s': %s" % (
+                    self.cache_path, e)
+
+    def _evict(self, now):
+        """Drops expired entries, then the least recently used overflow"""
+        self._db.execute("DELETE FROM probe WHERE created < ?",
+                         (now - self.max_age,))
+        count = self._db.execute("SELECT COUNT(*) FROM probe").fetchone()[0]
+        if count > self.max_entries:
+            self._db.execute(
+                "DELETE FROM probe WHERE path IN (SELECT path FROM probe "
+                "ORDER BY last_access ASC LIMIT ?)",
+                (count - self.max_entries,))
+
+    def invalidate(self, file_name):
+        """Removes the cache entry for a single file"""
+        path = decode_path(os.path.abspath(file_name))
+        if path is None:
+            return
+        with self._lock:
+            self._db.execute("DELETE FROM probe WHERE path = ?", (path,))
+            self._db.commit()
+
+    def clear(self):
+        """Removes all cache entries and resets the hit/miss counters"""
+        with self._lock:
+            self._pending_access = {}
+            self._pending_hits = 0
+            self._pending_misses = 0
+            self._db.execute("DELETE FROM probe")
+            self._db.execute("UPDATE stats SET value = 0")
+            self._db.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute(
+                "SELECT COUNT(*) FROM probe").fetchone()[0]
+
+    def __repr__(self):
+        retStr = "\nProbe cache: %s\n" % self.cache_path
+        retStr += "\tEntries: %d (max %d)\n" % (len(self), self.max_entries)
+        retStr += "\tMax age: %d seconds\n" % self.max_age
+        (total_hits, total_misses) = self.get_totals()
+        retStr += "\tHits: %d (%d in this process)\n" % (total_hits, self.hits)
+        retStr += "\tMisses: %d (%d in this process)\n" % (total_misses,
+                                                           self.misses)
+        return retStr
+
+if __name__ == "__main__":
+    import sys
+    testCache = get_default_cache()
+    if testCache is None:
+        print "Probe cache disabled."
+        sys.exit(1)
+    if len(sys.argv) > 1 and sys.argv[1] == "clear":
+        testCache.clear()
+    elif len(sys.argv) > 2 and sys.argv[1] == "invalidate":
+        for file_name in sys.argv[2:]:
+            testCache.invalidate(file_name)
+    print testCache
@@ -0,0 +1,543 @@
+#!/usr/bin/python
+# Mark's Media Framework
+# Copyright (C) 2011  Mark Pariente
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Process graphs driven from a single select() loop. A ProcessGraph starts
+# a set of processes, optionally chained stdout to stdin, and pumps every
+# pipe the parent holds from the thread calling run(): input files fed to a
+# process's stdin, captured stdout, stderr kept in a bounded ring buffer and
+# extra pipes such as ffmpeg's -progress output. Processes can have a
+# timeout, and a graph can be cancelled from any thread, which terminates
+# every process in it that is still running. A GraphGroup cancels the graphs
+# run by a set of threads together, e.g. those of the stages of a pipeline.
+#
+# Pipe ends held by the parent are close-on-exec and processes are spawned
+# under a lock, so a process never inherits the pipes of another one and
+# end of file arrives as soon as the processes that should hold a pipe exit.
+
+import collections
+import errno
+import fcntl
+import os
+import select
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+from mmf import errors
+
+PIPE = subprocess.PIPE # Capture stdout, or chain it to another process
+DEVNULL = -3 # Connect stdin or stdout to the null device
+
+STDERR_TAIL_SIZE = 64 * 1024 # Bytes of stderr kept per process
+STDERR_TAIL_LINES = 10 # Lines of stderr quoted in error messages
+
+_READ_SIZE = 64 * 1024
+# Seconds between checks for processes exiting, backing off from the
+# minimum as nothing happens since exits mostly follow end of file on their
+# pipes closely
+_MIN_POLL_INTERVAL = 0.001
+_POLL_INTERVAL = 0.1
+_KILL_GRACE = 5.0 # Seconds between SIGTERM and SIGKILL on cancellation
+
+_spawn_lock = threading.Lock()
+_running_graphs = set()
+_running_lock = threading.Lock()
+_thread_state = threading.local()
+
+def _set_cloexec(fd, cloexec = True):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    if cloexec:
+        flags |= fcntl.FD_CLOEXEC
+    else:
+        flags &= ~fcntl.FD_CLOEXEC
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags)
+
+def _set_nonblocking(fd):
+    fcntl.fcntl(fd, fcntl.F_SETFL,
+                fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+def cancel_all():
+    """Cancels every graph currently running in this process"""
+    with _running_lock:
+        graphs = list(_running_graphs)
+    for graph in graphs:
+        graph.cancel()
+
+def get_current_group():
+    """Returns the GraphGroup the calling thread entered, or None"""
+    return getattr(_thread_state, "group", None)
+
+class GraphGroup:
+    """
+    The graphs run by the threads that entered the group with enter(). Once
+    the group is cancelled, its running graphs and any it runs later are
+    cancelled.
+    """
+
+    def __init__(self):
+        self.cancelled = False
+        self._graphs = set()
+        self._lock = threading.Lock()
+
+    def enter(self):
+        """Makes the graphs run by the calling thread members of the group"""
+        _thread_state.group = self
+
+    def _add(self, graph):
+        with self._lock:
+            self._graphs.add(graph)
+            if self.cancelled:
+                graph.cancel()
+
+    def _discard(self, graph):
+        with self._lock:
+            self._graphs.discard(graph)
+
+    def cancel(self):
+        """Cancels the group's graphs, safe to call from any thread"""
+        with self._lock:
+            self.cancelled = True
+            graphs = list(self._graphs)
+        for graph in graphs:
+            graph.cancel()
+
+class RingBuffer:
+    """Keeps the last max_size bytes written to it"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.dropped = 0 # Bytes discarded from the front
+        self._chunks = collections.deque()
+        self._size = 0
+
+    def append(self, data):
+        self._chunks.append(data)
+        self._size += len(data)
+        while self._size > self.max_size:
+            excess = self._size - self.max_size
+            if len(self._chunks[0]) <= excess:
+                chunk = self._chunks.popleft()
+                self._size -= len(chunk)
+                self.dropped += len(chunk)
+            else:
+                self._chunks[0] = self._chunks[0][excess:]
+                self._size -= excess
+                self.dropped += excess
+
+    def get_value(self):
+        return "".join(self._chunks)
+
+    def get_lines(self, count):
+        """Returns up to the last count complete or partial lines"""
+        lines = self.get_value().replace("\r", "\n").split("\n")
+        lines = [line for line in lines if line.strip() != ""]
+        return lines[-count:]
+
+    def __len__(self):
+        return self._size
+
+class Process:
+    """A process of a ProcessGraph, holding its results once it has run"""
+
+    def __init__(self, name, args, cwd, stdin, stdout, echo_stderr,
+                 timeout, pass_fds, on_start, on_stderr):
+        self.name = name
+        self.args = args
+        self.cwd = cwd
+        self.stdin = stdin
+        self.stdout = stdout
+        self.echo_stderr = echo_stderr
+        self.timeout = timeout
+        self.pass_fds = list(pass_fds or [])
+        self.on_start = on_start
+        self.on_stderr = on_stderr
+        self.stderr_tail = RingBuffer(STDERR_TAIL_SIZE)
+        self.output = None # Captured stdout
+        self.returncode = None
+        self.feed_error = None # IOError feeding stdin, if it stopped reading
+        self.start_time = None
+        self.end_time = None
+        self._proc = None
+        self._consumer = None # Process reading this one's stdout
+
+    def get_stderr_str(self):
+        """Returns the end of the process's stderr for error messages"""
+        return "\n".join(self.stderr_tail.get_lines(STDERR_TAIL_LINES))
+
+    def get_failure_str(self):
+        """
+        Returns '<name> failed with exit code N', followed by the end of its
+        stderr unless that was echoed already
+        """
+        failure_str = "%s failed with exit code %d" % (self.name,
+                                                        self.returncode)
+        if not self.echo_stderr and len(self.stderr_tail) > 0:
+            failure_str += ":\n" + self.get_stderr_str()
+        return failure_str
+
+    def is_running(self):
+        return self._proc is not None and self.returncode is None
+
+    def terminate(self):
+        """
+        Sends the process SIGTERM, leaving the rest of the graph running.
+        Only safe from the thread running the graph, e.g. in on_stderr().
+        """
+        if self.is_running():
+            try:
+                os.kill(self._proc.pid, signal.SIGTERM)
+            except OSError:
+                # Exited in the meantime
+                pass
+
+class ProcessGraph:
+    """
+    A set of processes run together. Processes start in the order they
+    were added and run() returns once all of them have exited and all
+    pipes have been drained.
+    """
+
+    def __init__(self):
+        self.processes = []
+        self.timed_out = None # Process that exceeded its timeout
+        self._readers = [] # (fd, callback) of extra pipes
+        self._cancelled = False
+        self._kill_time = None
+        (self._wake_read, self._wake_write) = os.pipe()
+        for fd in (self._wake_read, self._wake_write):
+            _set_cloexec(fd)
+            _set_nonblocking(fd)
+
+    def add_process(self, name, args, cwd = None, stdin = None,
+                    stdout = None, echo_stderr = True, timeout = None,
+                    pass_fds = None, on_start = None, on_stderr = None):
+        """
+        Adds a process and returns it. stdin is None to inherit it, DEVNULL,
+        a Process added earlier with stdout set to PIPE to read its output,
+        or an input like MultiFileInput with set_output() and write_chunk().
+        stdout is None to inherit it, DEVNULL or PIPE to capture it or chain
+        it. stderr always goes to the ring buffer and, with echo_stderr, is
+        copied to our own stderr as well. The process is terminated along
+        with the rest of the graph if it runs longer than timeout seconds.
+        pass_fds are inherited by the process and on_start() is called once
+        it has been spawned. on_stderr(data) sees stderr as it is read, ""
+        at end of file.
+        """
+        process = Process(name, args, cwd, stdin, stdout, echo_stderr,
+                          timeout, pass_fds, on_start, on_stderr)
+        if isinstance(stdin, Process):
+            if stdin.stdout != PIPE or stdin._consumer is not None:
+                raise errors.MMFError("Output of '%s' isn't available to \
+'%s'" % (stdin.name, name))
+            stdin._consumer = process
+        self.processes.append(process)
+        return process
+
+    def add_reader(self, fd, callback):
+        """
+        Has the graph pump an extra pipe read end, calling callback(data)
+        for every read and callback("") at end of file
+        """
+        _set_cloexec(fd)
+        self._readers.append((fd, callback))
+
+    def cancel(self):
+        """Terminates the graph's processes, safe to call from any thread"""
+        self._cancelled = True
+        try:
+            os.write(self._wake_write, "x")
+        except OSError:
+            # Already woken or finished
+            pass
+
+    def _spawn(self, process):
+        null_fds = []
+        if isinstance(process.stdin, Process):
+            stdin = process.stdin._proc.stdout
+        elif process.stdin == DEVNULL:
+            stdin = open(os.devnull, 'r')
+            null_fds.append(stdin)
+        elif process.stdin is not None:
+            stdin = PIPE
+        else:
+            stdin = None
+        if process.stdout == DEVNULL:
+            stdout = open(os.devnull, 'w')
+            null_fds.append(stdout)
+        else:
+            stdout = process.stdout
+
+        with _spawn_lock:
+            for fd in process.pass_fds:
+                _set_cloexec(fd, False)
+            try:
+                process._proc = subprocess.Popen(process.args,
+                                                 stdin = stdin,
+                                                 stdout = stdout,
+                                                 stderr = PIPE,
+                                                 cwd = process.cwd)
+            except OSError as e:
+                raise errors.MMFError("Failed to run %s: %s" %
+                                      (process.name, e.strerror))
+            finally:
+                for fd in process.pass_fds:
+                    _set_cloexec(fd)
+                if process.on_start is not None:
+                    process.on_start()
+                for null_fd in null_fds:
+                    null_fd.close()
+            for pipe_fd in (process._proc.stdin, process._proc.stdout,
+                            process._proc.stderr):
+                if pipe_fd is not None:
+                    _set_cloexec(pipe_fd.fileno())
+        process.start_time = time.time()
+
+        if isinstance(process.stdin, Process):
+            # Only the consumer may hold the read end, or the producer never
+            # gets a broken pipe if the consumer exits early
+            process.stdin._proc.stdout.close()
+            process.stdin._proc.stdout = None
+        elif process._proc.stdin is not None:
+            _set_nonblocking(process._proc.stdin.fileno())
+            process.stdin.set_output(process._proc.stdin)
+        if process._proc.stdout is not None and process._consumer is None:
+            process.output = []
+
+    def _terminate(self, sig):
+        for process in self.processes:
+            if process.is_running():
+                try:
+                    os.kill(process._proc.pid, sig)
+                except OSError:
+                    # Exited in the meantime
+                    pass
+
+    def _feed(self, process):
+        """Writes the next chunk to a process's stdin"""
+        try:
+            if process.stdin.write_chunk() > 0:
+                return
+        except IOError as e:
+            if e.errno == errno.EAGAIN:
+                return
+            process.feed_error = e
+            try:
+                process._proc.stdin.close()
+            except IOError:
+                pass
+        # Closed by write_chunk() at the end of the input
+        process._proc.stdin = None
+
+    def _read(self, fd, callback):
+        """Reads from a pipe, returns False once it is at end of file"""
+        try:
+            data = os.read(fd, _READ_SIZE)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return True
+            data = ""
+        callback(data)
+        return data != ""
+
+    def _make_stderr_callback(self, process):
+        def on_stderr(data):
+            process.stderr_tail.append(data)
+            if process.echo_stderr and data != "":
+                sys.stderr.write(data)
+                sys.stderr.flush()
+            if process.on_stderr is not None:
+                process.on_stderr(data)
+        return on_stderr
+
+    def _make_stdout_callback(self, process):
+        def on_stdout(data):
+            process.output.append(data)
+        return on_stdout
+
+    def _check_timeouts(self, now):
+        """Returns seconds until the next timeout, or None"""
+        next_timeout = None
+        for process in self.processes:
+            if not process.is_running() or process.timeout is None:
+                continue
+            left = process.start_time + process.timeout - now
+            if left <= 0:
+                if not self._cancelled:
+                    self.timed_out = process
+                    self.cancel()
+            elif next_timeout is None or left < next_timeout:
+                next_timeout = left
+        return next_timeout
+
+    def _reap(self):
+        """Collects exited processes, returns whether any still run"""
+        running = False
+        for process in self._get_started():
+            if not process.is_running():
+                continue
+            if process._proc.poll() is None:
+                running = True
+                continue
+            process.returncode = process._proc.returncode
+            process.end_time = time.time()
+        return running
+
+    def _get_started(self):
+        return [process for process in self.processes
+                if process._proc is not None]
+
+    def _loop(self):
+        readers = {}
+        for process in self._get_started():
+            if process._proc.stderr is not None:
+                readers[process._proc.stderr.fileno()] = (
+                    self._make_stderr_callback(process))
+            if process.output is not None:
+                readers[process._proc.stdout.fileno()] = (
+                    self._make_stdout_callback(process))
+        for (fd, callback) in self._readers:
+            readers[fd] = callback
+
+        poll_interval = _MIN_POLL_INTERVAL
+        while True:
+            now = time.time()
+            select_timeout = self._check_timeouts(now)
+            if self._cancelled:
+                if self._kill_time is None:
+                    self._terminate(signal.SIGTERM)
+                    self._kill_time = now + _KILL_GRACE
+                elif now >= self._kill_time:
+                    self._terminate(signal.SIGKILL)
+                select_timeout = _POLL_INTERVAL
+
+            running = self._reap()
+            writers = {}
+            for process in self._get_started():
+                if process._proc.stdin is not None:
+                    if process.is_running() and not self._cancelled:
+                        writers[process._proc.stdin.fileno()] = process
+                    else:
+                        process._proc.stdin.close()
+                        process._proc.stdin = None
+            if not running and len(readers) == 0:
+                break
+            if running and (select_timeout is None or
+                            select_timeout > poll_interval):
+                # No notification for exits, poll for them
+                select_timeout = poll_interval
+
+            try:
+                (read_ready, write_ready, x) = select.select(
+                    readers.keys() + [self._wake_read], writers.keys(), [],
+                    select_timeout)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            if len(read_ready) + len(write_ready) == 0:
+                poll_interval = min(poll_interval * 2, _POLL_INTERVAL)
+            else:
+                poll_interval = _MIN_POLL_INTERVAL
+            for fd in read_ready:
+                if fd == self._wake_read:
+                    try:
+                        os.read(self._wake_read, _READ_SIZE)
+                    except OSError:
+                        pass
+                elif not self._read(fd, readers[fd]):
+                    del readers[fd]
+            for fd in write_ready:
+                self._feed(writers[fd])
+
+    def run(self):
+        """
+        Runs all processes to completion. Raises MMFError if a process can't
+        be started, if one timed out or if the graph was cancelled; exit
+        codes and feed errors are left to the caller to check.
+        """
+        group = get_current_group()
+        with _running_lock:
+            _running_graphs.add(self)
+        if group is not None:
+            group._add(self)
+        try:
+            for process in self.processes:
+                if self._cancelled:
+                    break
+                self._spawn(process)
+            self._loop()
+        except BaseException:
+            # Never leave processes behind, including on KeyboardInterrupt
+            self._terminate(signal.SIGKILL)
+            for process in self._get_started():
+                if process.is_running():
+                    process._proc.wait()
+                    process.returncode = process._proc.returncode
+            raise
+        finally:
+            with _running_lock:
+                _running_graphs.discard(self)
+            if group is not None:
+                group._discard(self)
+            for process in self._get_started():
+                for pipe_fd in (process._proc.stdin, process._proc.stdout,
+                                process._proc.stderr):
+                    if pipe_fd is not None and not pipe_fd.closed:
+                        pipe_fd.close()
+                if process.output is not None:
+                    process.output = "".join(process.output)
+            os.close(self._wake_read)
+            os.close(self._wake_write)
+
+        if self.timed_out is not None:
+            raise errors.MMFError("%s timed out after %d seconds" %
+                                  (self.timed_out.name,
+                                   self.timed_out.timeout))
+        if self._cancelled:
+            raise errors.MMFError("Cancelled while running %s" % ", ".join(
+                process.name for process in self.processes))
+
+    def __repr__(self):
+        retStr = "\nProcess graph:\n"
+        for process in self.processes:
+            if process.end_time is not None:
+                retStr += "\t%s: exit code %d after %.1f seconds\n" % (
+                    process.name, process.returncode,
+                    process.end_time - process.start_time)
+            else:
+                retStr += "\t%s: not run\n" % process.name
+        return retStr
+
+def run_capture(name, args, cwd = None, timeout = None):
+    """
+    Runs a single process, capturing its stdout and stderr, and returns the
+    finished Process
+    """
+    graph = ProcessGraph()
+    process = graph.add_process(name, args, cwd, stdout = PIPE,
+                                echo_stderr = False, timeout = timeout)
+    graph.run()
+    return process
+
+if __name__ == "__main__":
+    testGraph = ProcessGraph()
+    testSource = testGraph.add_process("source", sys.argv[1].split(),
+                                       stdout = PIPE)
+    testGraph.add_process("sink", sys.argv[2].split(), stdin = testSource,
+                          timeout = 10)
+    testGraph.run()
+    print testGraph
@@ -0,0 +1,240 @@
+#!/usr/bin/python
+# Mark's Media Framework
+# Copyright (C) 2011  Mark Pariente
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Encode progress reporting. ffmpeg writes its machine readable progress
+# (-progress) to a pipe, where blocks of key=value lines end with a
+# progress=continue or progress=end line. Every block is turned into a
+# record of per-pass metrics and written as a JSON line to a file or socket:
+#
+#   {"job": ..., "host": ..., "pass": ..., "time": ..., "frame": ...,
+#    "fps": ..., "speed": ..., "bitrate": ..., "out_time": ...,
+#    "total_size": ..., "percent": ..., "eta": ..., "status": ...}
+
+import json
+import os
+import socket
+import threading
+import time
+
+from mmf import errors
+
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+_TCP_PREFIX = "tcp:"
+_UNIX_PREFIX = "unix:"
+
+def _parse_float(value_str, suffix = ""):
+    """Parses an ffmpeg progress value like '1.5x', returns None for N/A"""
+    if suffix and value_str.endswith(suffix):
+        value_str = value_str[:-len(suffix)]
+    try:
+        return float(value_str)
+    except ValueError:
+        return None
+
+class ProgressReporter:
+    """
+    Writes progress records as JSON lines to a file (appending), a TCP socket
+    given as tcp:host:port or a UNIX socket given as unix:path. Records from
+    concurrent passes are written whole.
+    """
+
+    def __init__(self, dest, job_name):
+        self.dest = dest
+        self.job_name = job_name
+        self.host = socket.gethostname()
+        self._lock = threading.Lock()
+        self._sock = None
+        self._fd = None
+
+        try:
+            if dest.startswith(_TCP_PREFIX):
+                (host, sep, port) = dest[len(_TCP_PREFIX):].rpartition(":")
+                self._sock = socket.create_connection((host, int(port)))
+            elif dest.startswith(_UNIX_PREFIX):
+                self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self._sock.connect(dest[len(_UNIX_PREFIX):])
+            else:
+                self._fd = open(dest, 'a')
+        except (IOError, socket.error, ValueError) as e:
+            raise errors.MMFError("Failed to open progress output '%s': %s" %
+                                  (dest, e))
+
+    def emit(self, record):
+        """Stamps a record with the job, host and time and writes it out"""
+        record["job"] = self.job_name
+        record["host"] = self.host
+        record["time"] = time.time()
+        line = json.dumps(record, sort_keys = True) + "\n"
+        with self._lock:
+            try:
+                if self._sock is not None:
+                    self._sock.sendall(line)
+                elif self._fd is not None:
+                    self._fd.write(line)
+                    self._fd.flush()
+            except (IOError, socket.error) as e:
+                # A dashboard going away must not take the encode with it
+                print "WARNING: Progress output '%s' failed: %s" % (self.dest,
+                                                                    e)
+                self._sock = None
+                self._fd = None
+
+    def close(self):
+        with self._lock:
+            if self._sock is not None:
+                self._sock.close()
+                self._sock = None
+            if self._fd is not None:
+                self._fd.close()
+                self._fd = None
+
+class PassMonitor:
+    """
+    Follows the -progress output of a single ffmpeg pass and reports it. The
+    expected output duration in seconds, if known, enables percent and ETA.
+    """
+
+    def __init__(self, reporter, pass_name, duration = None):
+        self.reporter = reporter
+        self.pass_name = pass_name
+        self.duration = duration
+        self.last_record = None
+        self._read_fd = None
+        self._write_fd = None
+        self._thread = None
+        self._start_time = None
+        self._values = {}
+        self._partial = ""
+
+    def get_args(self):
+        """Returns the ffmpeg arguments sending progress to this monitor"""
+        (self._read_fd, self._write_fd) = os.pipe()
+        return ["-progress", "pipe:%d" % self._write_fd]
+
+    def get_fds(self):
+        """Returns the (read, write) ends of the pipe set up by get_args()"""
+        return (self._read_fd, self._write_fd)
+
+    def start(self, follow = True):
+        """
+        Starts following progress once ffmpeg has been started. Without
+        follow, the caller reads the pipe and passes the data to feed().
+        """
+        # ffmpeg holds its own copy, end of file comes when it exits
+        os.close(self._write_fd)
+        self._write_fd = None
+        self._start_time = time.time()
+        if follow:
+            self._thread = threading.Thread(target = self._follow)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _make_record(self, values):
+        record = {"pass": self.pass_name,
+                  "status": STATUS_RUNNING,
+                  "frame": None,
+                  "fps": None,
+                  "speed": None,
+                  "bitrate": None,
+                  "out_time": None,
+                  "total_size": None,
+                  "percent": None,
+                  "eta": None}
+        if "frame" in values:
+            record["frame"] = int(_parse_float(values["frame"]) or 0)
+        if "fps" in values:
+            record["fps"] = _parse_float(values["fps"])
+        if "speed" in values:
+            record["speed"] = _parse_float(values["speed"].strip(), "x")
+        if "bitrate" in values:
+            # Kbps
+            record["bitrate"] = _parse_float(values["bitrate"], "kbits/s")
+        if "total_size" in values:
+            total_size = _parse_float(values["total_size"])
+            if total_size is not None:
+                record["total_size"] = int(total_size)
+        # Despite its name out_time_ms is in microseconds as well
+        for out_time_key in ("out_time_us", "out_time_ms"):
+            if out_time_key in values:
+                out_time = _parse_float(values[out_time_key])
+                if out_time is not None:
+                    record["out_time"] = out_time / 1000000.0
+                break
+
+        if self.duration and record["out_time"] is not None:
+            record["percent"] = min(100.0, 100.0 * record["out_time"] /
+                                    self.duration)
+            elapsed = time.time() - self._start_time
+            if record["out_time"] > 0:
+                record["eta"] = max(0.0, elapsed * (self.duration -
+                                                    record["out_time"]) /
+                                    record["out_time"])
+        return record
+
+    def _parse_line(self, line):
+        (key, sep, value) = line.strip().partition("=")
+        if sep == "":
+            return
+        if key != "progress":
+            self._values[key] = value
+            return
+        self.last_record = self._make_record(self._values)
+        self.reporter.emit(self.last_record)
+        self._values = {}
+
+    def feed(self, data):
+        """Parses data read from the progress pipe, "" at end of file"""
+        if data == "":
+            os.close(self._read_fd)
+            self._read_fd = None
+            return
+        lines = (self._partial + data).split("\n")
+        self._partial = lines.pop()
+        for line in lines:
+            self._parse_line(line)
+
+    def _follow(self):
+        progress_fd = os.fdopen(self._read_fd, 'r')
+        for line in iter(progress_fd.readline, ""):
+            self._parse_line(line)
+        progress_fd.close()
+
+    def finish(self, returncode):
+        """Reports the final state of the pass after ffmpeg exits"""
+        if self._thread is not None:
+            self._thread.join()
+        if self.last_record is not None:
+            record = dict(self.last_record)
+        else:
+            record = self._make_record({})
+        if returncode == 0:
+            record["status"] = STATUS_DONE
+            record["eta"] = 0.0
+        else:
+            record["status"] = STATUS_FAILED
+        record["wall_time"] = time.time() - (self._start_time or time.time())
+        self.reporter.emit(record)
+
+if __name__ == "__main__":
+    import sys
+    # Follows a saved -progress output file, reporting to stdout
+    testReporter = ProgressReporter("/dev/stdout", "test")
+    testMonitor = PassMonitor(testReporter, "test", float(sys.argv[2]))
+    testMonitor._start_time = time.time()
+    testMonitor._read_fd = os.open(sys.argv[1], os.O_RDONLY)
+    testMonitor._follow()
+    testMonitor.finish(0)
@@ -0,0 +1,101 @@
+#!/usr/bin/python
+# Mark's Media Framework
+# Copyright (C) 2011  Mark Pariente
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+from mmf import errors
+from mmf import procgraph
+
+SEGMENT_FILE_FORMAT = "segment-%03d.ts"
+CONCAT_LIST_FILE = "segments.txt"
+
+# Seconds before a hung ffprobe is killed. ffprobe reads every packet of the
+# input, so this has to allow for large inputs on slow storage.
+DEFAULT_PROBE_TIMEOUT = 600.0
+
+def find_keyframes(input_file, timeout = DEFAULT_PROBE_TIMEOUT):
+    """
+    Returns a (keyframes, duration) tuple for the first video stream of the
+    input file, where keyframes is a sorted list of keyframe timestamps in
+    seconds and duration is the timestamp of the last video packet. Both are
+    relative to the start of the input, as -ss is, also for inputs such as
+    MPEG-TS whose timestamps don't start at zero.
+    """
+    fp = procgraph.run_capture("ffprobe",
+                               ['ffprobe', '-v', 'error',
+                                '-select_streams', 'v:0',
+                                '-show_entries',
+                                'packet=pts_time,flags:format=start_time',
+                                '-of', 'csv=p=0', input_file],
+                               timeout = timeout)
+    if fp.returncode != 0:
+        raise errors.MMFError("Failed to read keyframes from '%s': %s" %
+                              (input_file, fp.get_failure_str()))
+
+    keyframes = []
+    pts_list = []
+    start_time = 0.0
+    for fp_line in fp.output.split("\n"):
+        fp_tokenized = fp_line.strip().split(",")
+        if fp_tokenized[0] in ("", "N/A"):
+            continue
+        if len(fp_tokenized) == 1:
+            # The format section, after the packets
+            start_time = float(fp_tokenized[0])
+            continue
+        pts_time = float(fp_tokenized[0])
+        pts_list.append(pts_time)
+        if "K" in fp_tokenized[1]:
+            keyframes.append(pts_time)
+    keyframes = sorted(keyframe - start_time for keyframe in keyframes)
+    if len(pts_list) > 0:
+        duration = max(pts_list) - start_time
+    else:
+        duration = 0.0
+    return (keyframes, duration)
+
+def plan_segments(keyframes, start, end, segment_count):
+    """
+    Splits the [start, end) window into at most segment_count segments that
+    start on keyframes, returning a list of (start, duration) tuples. The
+    first segment always starts at the window start.
+    """
+    boundaries = [start]
+    window = float(end - start)
+    for i in range(1, segment_count):
+        split_time = start + window * i / segment_count
+        for keyframe in keyframes:
+            if keyframe >= split_time and keyframe > boundaries[-1]:
+                if keyframe < end:
+                    boundaries.append(keyframe)
+                break
+    boundaries.append(end)
+
+    segments = []
+    for i in range(len(boundaries) - 1):
+        segments.append((boundaries[i], boundaries[i + 1] - boundaries[i]))
+    return segments
+
+def write_concat_list(list_path, segment_files):
+    """Writes an ffmpeg concat demuxer list for the segment files"""
+    list_fd = open(list_path, 'w')
+    for segment_file in segment_files:
+        list_fd.write("file '%s'\n" % segment_file.replace("'", "'\\''"))
+    list_fd.close()
+
+if __name__ == "__main__":
+    import sys
+    (testKeyframes, testDuration) = find_keyframes(sys.argv[1])
+    print "Duration: %.3f, %d keyframes" % (testDuration, len(testKeyframes))
+    for testSegment in plan_segments(testKeyframes, 0.0, testDuration,
+                                     int(sys.argv[2])):
+        print "Segment at %.3f for %.3f seconds" % testSegment
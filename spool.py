@@ -0,0 +1,319 @@
+#!/usr/bin/python
+# Mark's Media Framework
+# Copyright (C) 2011  Mark Pariente
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Shared spool directory job queue. Jobs move between sub-directories with
+# rename(), which is atomic on local file systems and NFS, so any number of
+# workers on any number of hosts can share a spool without a broker:
+#
+#   pending/<job>.job            waiting to be claimed, not before its mtime
+#   claimed/<job>.job@<worker>   being run by a worker, mtime is the heartbeat
+#   done/<job>.job               finished, with the result in <job>.result
+#   failed/<job>.job             unreadable job file, the error in <job>.result
+#   logs/job-<job>.log           output of the mmfxcode run
+#   workers/<worker>             per-worker heartbeat and status
+#
+# A worker that finds its claim gone stops its job right away. Reclaimed jobs
+# can't be claimed again for a grace period that covers this, so a job never
+# runs twice at the same time.
+
+import errno
+import json
+import optparse
+import os
+import os.path
+import socket
+import sys
+import time
+
+from mmf import batch
+from mmf import errors
+
+PENDING_DIR = "pending"
+CLAIMED_DIR = "claimed"
+DONE_DIR = "done"
+FAILED_DIR = "failed"
+LOG_DIR = "logs"
+WORKERS_DIR = "workers"
+JOB_EXTENSION = ".job"
+RESULT_EXTENSION = ".result"
+_CLAIM_SEPARATOR = "@"
+
+DEFAULT_POLL_INTERVAL = 5 # Seconds between spool scans when idle
+DEFAULT_HEARTBEAT_INTERVAL = 30 # Seconds between claim heartbeats
+DEFAULT_CLAIM_TIMEOUT = 300 # Seconds without heartbeat before reclaiming
+_JOB_POLL_INTERVAL = 0.5 # Seconds between checks on the running job
+
+# Seconds before a reclaimed job can be claimed again, long enough for a
+# worker that lost its claim to notice and stop the job
+_RECLAIM_GRACE = 4 * _JOB_POLL_INTERVAL + batch.KILL_GRACE
+
+def _write_atomic(path, data):
+    """Writes a file so that readers only ever see its complete contents"""
+    temp_path = "%s.tmp-%s-%d" % (path, socket.gethostname(), os.getpid())
+    temp_fd = open(temp_path, 'w')
+    temp_fd.write(data)
+    temp_fd.close()
+    os.rename(temp_path, path)
+
+def init_spool(spool_dir):
+    """Creates the spool directory layout if it doesn't exist yet"""
+    for sub_dir in (PENDING_DIR, CLAIMED_DIR, DONE_DIR, FAILED_DIR, LOG_DIR,
+                    WORKERS_DIR):
+        path = os.path.join(spool_dir, sub_dir)
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError as e:
+                # Another worker may have created it concurrently
+                if e.errno != errno.EEXIST:
+                    raise
+
+def submit(spool_dir, args, work_dir = None):
+    """
+    Queues a job running mmfxcode with the given arguments and returns its
+    name. Relative paths in the arguments are resolved against work_dir,
+    which defaults to the current directory.
+    """
+    if work_dir is None:
+        work_dir = os.getcwd()
+    job = batch.BatchJob(None, args, work_dir)
+    if job.status == batch.STATUS_INVALID:
+        raise errors.MMFError("Invalid job arguments: %s" % job.error)
+
+    init_spool(spool_dir)
+    job_name = "%.6f-%s-%d" % (time.time(), socket.gethostname(),
+                               os.getpid())
+    _write_atomic(os.path.join(spool_dir, PENDING_DIR,
+                               job_name + JOB_EXTENSION),
+                  json.dumps({"args": args, "work_dir": work_dir}))
+    return job_name
+
+class Worker:
+    """Worker claiming and running jobs from a shared spool directory"""
+
+    def __init__(self, spool_dir, poll_interval = DEFAULT_POLL_INTERVAL,
+                 heartbeat_interval = DEFAULT_HEARTBEAT_INTERVAL,
+                 claim_timeout = DEFAULT_CLAIM_TIMEOUT):
+        self.spool_dir = os.path.abspath(spool_dir)
+        self.poll_interval = poll_interval
+        self.heartbeat_interval = heartbeat_interval
+        self.claim_timeout = claim_timeout
+        self.worker_id = "%s-%d" % (socket.gethostname(), os.getpid())
+        self.jobs_run = 0
+        init_spool(self.spool_dir)
+
+    def _path(self, sub_dir, name):
+        return os.path.join(self.spool_dir, sub_dir, name)
+
+    def _heartbeat(self, job_name):
+        """Records that this worker is alive and what it is working on"""
+        _write_atomic(self._path(WORKERS_DIR, self.worker_id),
+                      json.dumps({"worker": self.worker_id,
+                                  "job": job_name,
+                                  "jobs_run": self.jobs_run,
+                                  "time": time.time()}))
+
+    def reclaim_expired(self):
+        """
+        Moves claims whose heartbeat has expired back to pending, where they
+        become claimable after _RECLAIM_GRACE seconds
+        """
+        now = time.time()
+        for claim_name in os.listdir(os.path.join(self.spool_dir,
+                                                  CLAIMED_DIR)):
+            claim_path = self._path(CLAIMED_DIR, claim_name)
+            try:
+                if now - os.stat(claim_path).st_mtime < self.claim_timeout:
+                    continue
+                # The owner may still be alive and heartbeat at any time, so
+                # it gets the grace period to notice the claim is gone
+                not_before = now + _RECLAIM_GRACE
+                os.utime(claim_path, (not_before, not_before))
+                job_file = claim_name.rpartition(_CLAIM_SEPARATOR)[0]
+                os.rename(claim_path, self._path(PENDING_DIR, job_file))
+                print "Reclaimed expired job %s" % claim_name
+            except OSError:
+                # Heartbeat file vanished, someone else got to it first
+                continue
+
+    def claim_next(self):
+        """
+        Claims the oldest pending job, returning a (job_name, claim_path)
+        tuple or None if there is nothing to do
+        """
+        now = time.time()
+        for job_file in sorted(os.listdir(os.path.join(self.spool_dir,
+                                                       PENDING_DIR))):
+            if not job_file.endswith(JOB_EXTENSION):
+                continue
+            pending_path = self._path(PENDING_DIR, job_file)
+            claim_path = self._path(CLAIMED_DIR, job_file +
+                                    _CLAIM_SEPARATOR + self.worker_id)
+            try:
+                if os.stat(pending_path).st_mtime > now:
+                    # Reclaimed, its previous owner may still be stopping it
+                    continue
+                # Renaming keeps the mtime, so start the heartbeat before the
+                # claim becomes visible to reclaim_expired()
+                os.utime(pending_path, None)
+                os.rename(pending_path, claim_path)
+            except OSError:
+                # Lost the race for this job to another worker
+                continue
+            return (job_file[:-len(JOB_EXTENSION)], claim_path)
+        return None
+
+    def _fail_job_file(self, job_name, claim_path, error):
+        """
+        Moves a job file that can't be run to failed/ so that no worker
+        picks it up again
+        """
+        print "Job %s is unreadable: %s" % (job_name, error)
+        _write_atomic(self._path(FAILED_DIR, job_name + RESULT_EXTENSION),
+                      json.dumps({"job": job_name, "error": error,
+                                  "worker": self.worker_id}, indent = 2))
+        try:
+            os.rename(claim_path, self._path(FAILED_DIR,
+                                             job_name + JOB_EXTENSION))
+        except OSError:
+            print "Lost claim on job %s" % job_name
+
+    def run_job(self, job_name, claim_path):
+        """Runs a claimed job to completion and records its result"""
+        try:
+            job_fd = open(claim_path, 'r')
+            job_spec = json.load(job_fd)
+            job_fd.close()
+            job = batch.BatchJob(job_name, list(job_spec["args"]),
+                                 job_spec.get("work_dir"))
+        except IOError as e:
+            print "Lost claim on job %s: %s" % (job_name, e.strerror)
+            return
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            self._fail_job_file(job_name, claim_path, str(e))
+            return
+
+        if job.status != batch.STATUS_INVALID:
+            print "Running job %s: %s" % (job_name, " ".join(job.args))
+            job.start(os.path.join(self.spool_dir, LOG_DIR))
+            last_heartbeat = time.time()
+            while not job.poll():
+                time.sleep(_JOB_POLL_INTERVAL)
+                try:
+                    # Checked on every poll, another worker may run the job
+                    # once the reclaim grace period is over
+                    if time.time() - last_heartbeat < self.heartbeat_interval:
+                        os.stat(claim_path)
+                        continue
+                    last_heartbeat = time.time()
+                    os.utime(claim_path, None)
+                except OSError:
+                    print "Lost claim on job %s, abandoning it" % job_name
+                    job.kill()
+                    return
+                self._heartbeat(job_name)
+
+        self.jobs_run += 1
+        print "Job %s %s" % (job_name, job.status)
+        result = job.get_summary()
+        result["worker"] = self.worker_id
+        _write_atomic(self._path(DONE_DIR, job_name + RESULT_EXTENSION),
+                      json.dumps(result, indent = 2))
+        try:
+            os.rename(claim_path, self._path(DONE_DIR,
+                                             job_name + JOB_EXTENSION))
+        except OSError:
+            print "Lost claim on job %s after it finished" % job_name
+
+    def run(self, exit_when_idle = False):
+        """
+        Processes jobs until interrupted or, with exit_when_idle set, until
+        no jobs are pending or claimed
+        """
+        print "Worker %s polling %s" % (self.worker_id, self.spool_dir)
+        try:
+            while True:
+                self.reclaim_expired()
+                claim = self.claim_next()
+                if claim is not None:
+                    self._heartbeat(claim[0])
+                    self.run_job(claim[0], claim[1])
+                    continue
+
+                self._heartbeat(None)
+                # Reclaimed jobs wait in pending for their grace period
+                if (exit_when_idle and
+                    len(os.listdir(os.path.join(self.spool_dir,
+                                                CLAIMED_DIR))) == 0 and
+                    len(os.listdir(os.path.join(self.spool_dir,
+                                                PENDING_DIR))) == 0):
+                    break
+                time.sleep(self.poll_interval)
+        finally:
+            try:
+                os.remove(self._path(WORKERS_DIR, self.worker_id))
+            except OSError:
+                pass
+
+def main(argv = sys.argv):
+    """Entry point for 'mmfxcode worker' and 'mmfxcode submit'"""
+    if len(argv) > 1 and argv[1] == "submit":
+        optparser = optparse.OptionParser(
+            usage = "%prog submit spool_dir [mmfxcode options] input...")
+        optparser.disable_interspersed_args()
+        (options, extra_args) = optparser.parse_args(argv[2:])
+        if len(extra_args) < 2:
+            print "No spool directory or job specified, exiting."
+            sys.exit(1)
+        try:
+            print submit(extra_args[0], extra_args[1:])
+        except errors.MMFError as e:
+            print e.msg
+            sys.exit(1)
+        return
+
+    optparser = optparse.OptionParser(usage = "%prog worker [options] spool_dir")
+    optparser.add_option(
+        "--poll-interval", type="float", dest="poll_interval",
+        default=DEFAULT_POLL_INTERVAL,
+        help="Seconds between spool scans when idle (default %default)")
+    optparser.add_option(
+        "--heartbeat-interval", type="float", dest="heartbeat_interval",
+        default=DEFAULT_HEARTBEAT_INTERVAL,
+        help="Seconds between heartbeats on a claimed job (default %default)")
+    optparser.add_option(
+        "--claim-timeout", type="float", dest="claim_timeout",
+        default=DEFAULT_CLAIM_TIMEOUT,
+        help="Seconds without a heartbeat after which other workers reclaim \
+a job (default %default)")
+    optparser.add_option(
+        "--exit-when-idle", action = "store_true", dest="exit_when_idle",
+        help="Exit once no jobs are pending or claimed")
+    (options, extra_args) = optparser.parse_args(argv[2:])
+
+    if len(extra_args) != 1:
+        print "No spool directory specified, exiting."
+        sys.exit(1)
+
+    worker = Worker(extra_args[0], options.poll_interval,
+                    options.heartbeat_interval, options.claim_timeout)
+    worker.run(options.exit_when_idle)
+
+if __name__ == "__main__":
+    for testDir in (PENDING_DIR, CLAIMED_DIR, DONE_DIR, FAILED_DIR,
+                    WORKERS_DIR):
+        testEntries = os.listdir(os.path.join(sys.argv[1], testDir))
+        print "%s: %d" % (testDir, len(testEntries))
+        for testEntry in sorted(testEntries):
+            print "\t" + testEntry
@@ -0,0 +1,196 @@
+#!/usr/bin/python
+# Mark's Media Framework
+# Copyright (C) 2011  Mark Pariente
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# Segmented output for targets with a MAX_OUTPUT_DURATION. ffmpeg's segment
+# muxer writes fixed duration segments into a hidden staging directory next
+# to the output and appends each one to a CSV segment list once it is
+# closed. The segments are followed while the encode runs, renamed into the
+# output directory and added to an HLS playlist that is rewritten
+# atomically, so consumers can start on the first segments right away and
+# never see a partial segment or playlist:
+#
+#   <output>.m3u8        playlist, ends with #EXT-X-ENDLIST once complete
+#   <output>-00000.ts    segments
+#
+# Segments are always MPEG-TS, also for a .mp4 output name: the playlist is
+# plain HLS version 3, which has no initialization segment (#EXT-X-MAP) for
+# fragmented MP4, and standalone MP4 files are not valid HLS segments.
+
+import math
+import os
+import os.path
+import shutil
+import threading
+
+from mmf import errors
+
+PLAYLIST_EXTENSION = ".m3u8"
+_OUTPUT_EXTENSIONS = [".mp4", ".ts"]
+_SEGMENT_EXTENSION = ".ts"
+_SEGMENT_FORMAT = "mpegts"
+_SEGMENT_LIST_FILE = "segments.csv"
+_STAGING_PREFIX = ".mmf-segments-"
+_POLL_INTERVAL = 0.5 # Seconds between checks for closed segments
+
+class SegmentWriter:
+    """
+    Publishes the segments of a segmented ffmpeg output as they are closed.
+    Call start() before running ffmpeg and finish() once it has exited.
+    """
+
+    def __init__(self, output_path, segment_duration):
+        (base_path, extension) = os.path.splitext(output_path)
+        if extension.lower() not in _OUTPUT_EXTENSIONS:
+            raise errors.MMFError(
+                "Segmented output needs a %s output file, not '%s'" %
+                (" or ".join(_OUTPUT_EXTENSIONS), output_path))
+
+        self.segment_duration = segment_duration
+        self.segment_format = _SEGMENT_FORMAT
+        self.output_dir = os.path.dirname(output_path)
+        self.playlist_path = base_path + PLAYLIST_EXTENSION
+        self.segment_pattern = (os.path.basename(base_path) + "-%05d" +
+                                _SEGMENT_EXTENSION)
+        self.segments = [] # (file name, duration) of published segments
+        self._staging_dir = os.path.join(
+            self.output_dir, "%s%s-%d" % (_STAGING_PREFIX,
+                                          os.path.basename(base_path),
+                                          os.getpid()))
+        self._list_offset = 0
+        self._done = threading.Event()
+        self._thread = None
+
+    def get_keyframe_str(self):
+        """
+        Returns the ffmpeg option forcing keyframes on segment boundaries so
+        every segment is full length. A first pass needs it as well, since
+        the second pass follows its frame type decisions.
+        """
+        return (" -force_key_frames \"expr:gte(t,n_forced*%d)\"" %
+                self.segment_duration)
+
+    def get_output_str(self, encode_video):
+        """
+        Returns the ffmpeg output options and file replacing the output file
+        on the command line. When the video gets encoded, keyframes are
+        forced on segment boundaries.
+        """
+        output_str = ""
+        if encode_video:
+            output_str += self.get_keyframe_str()
+        output_str += (" -f segment -segment_time %d -segment_format %s" %
+                       (self.segment_duration, self.segment_format))
+        output_str += (" -segment_list \"%s\" -segment_list_type csv \"%s\"" %
+                       (os.path.join(self._staging_dir, _SEGMENT_LIST_FILE),
+                        os.path.join(self._staging_dir,
+                                     self.segment_pattern)))
+        return output_str
+
+    def _write_playlist(self, complete):
+        """Atomically replaces the playlist with the published segments"""
+        target_duration = self.segment_duration
+        for (file_name, duration) in self.segments:
+            target_duration = max(target_duration, duration)
+
+        playlist_str = "#EXTM3U\n#EXT-X-VERSION:3\n"
+        playlist_str += "#EXT-X-TARGETDURATION:%d\n" % math.ceil(
+            target_duration)
+        playlist_str += "#EXT-X-MEDIA-SEQUENCE:0\n"
+        for (file_name, duration) in self.segments:
+            playlist_str += "#EXTINF:%.3f,\n%s\n" % (duration, file_name)
+        if complete:
+            playlist_str += "#EXT-X-ENDLIST\n"
+
+        temp_path = os.path.join(self._staging_dir,
+                                 os.path.basename(self.playlist_path))
+        temp_fd = open(temp_path, 'w')
+        temp_fd.write(playlist_str)
+        temp_fd.close()
+        os.rename(temp_path, self.playlist_path)
+
+    def _publish_closed(self):
+        """Moves segments closed since the last check to the output"""
+        try:
+            list_fd = open(os.path.join(self._staging_dir,
+                                        _SEGMENT_LIST_FILE), 'r')
+        except IOError:
+            # No segment closed yet
+            return
+        list_fd.seek(self._list_offset)
+        published = False
+        try:
+            for line in iter(list_fd.readline, ""):
+                if not line.endswith("\n"):
+                    # Entry still being written
+                    break
+                (file_name, start, end) = line.strip().rsplit(",", 2)
+                file_name = os.path.basename(file_name)
+                os.rename(os.path.join(self._staging_dir, file_name),
+                          os.path.join(self.output_dir, file_name))
+                self._list_offset += len(line)
+                self.segments.append((file_name, float(end) - float(start)))
+                published = True
+        finally:
+            list_fd.close()
+            if published:
+                self._write_playlist(False)
+
+    def _follow(self):
+        while not self._done.is_set():
+            try:
+                self._publish_closed()
+            except (IOError, OSError) as e:
+                # Retried by the next check and finish()
+                print "WARNING: Failed to publish segment: %s" % e
+            self._done.wait(_POLL_INTERVAL)
+
+    def start(self):
+        """Prepares the staging directory and starts following segments"""
+        try:
+            if os.path.isdir(self._staging_dir):
+                shutil.rmtree(self._staging_dir)
+            os.mkdir(self._staging_dir)
+        except OSError as e:
+            raise errors.MMFError("Failed to create segment directory \
+'%s': %s" % (self._staging_dir, e.strerror))
+        self._thread = threading.Thread(target = self._follow)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def finish(self, success):
+        """
+        Publishes the remaining closed segments and, if the encode succeeded,
+        marks the playlist complete. Segments of a failed encode that were
+        published stay in place.
+        """
+        if self._thread is None:
+            return
+        self._done.set()
+        self._thread.join()
+        self._thread = None
+        try:
+            self._publish_closed()
+            if success:
+                self._write_playlist(True)
+        except (IOError, OSError) as e:
+            raise errors.MMFError("Failed to publish segments of '%s': %s" %
+                                  (self.playlist_path, e))
+        finally:
+            shutil.rmtree(self._staging_dir, True)
+
+    def __repr__(self):
+        retStr = "\nSegmented output: %s\n" % self.playlist_path
+        retStr += "\tSegment duration: %d seconds\n" % self.segment_duration
+        retStr += "\tSegments: %d\n" % len(self.segments)
+        return retStr
@@ -21,15 +21,39 @@ TARGET_FILE_EXTENSION=".mmftarget"
 TARGET_DIRECTORY="targets"
 INSTALL_ENV_VAR="MMF_INSTALL_DIR"
 
-def find_target_file(target_string):
-    """Finds the target file location given a target string"""
-    
+# Fields read from a target file, as returned by TargetConfig.get_fields()
+_PARSED_FIELDS = ["target_name", "device_class", "video_max_width",
+                  "video_max_height", "video_max_bitrate", "video_interlaced",
+                  "codec_h264_profile", "codec_h264_level",
+                  "audio_max_bitrate", "audio_sample_rate",
+                  "audio_channel_count", "max_output_duration"]
+
+def get_target_dir():
+    """Returns the directory holding the installed target files"""
     # Grab the install directory from the environment variable
     env_dir = os.getenv(INSTALL_ENV_VAR);
     if env_dir is not None:
-        target_prefix = "%s/%s" % (env_dir, TARGET_DIRECTORY)
+        return "%s/%s" % (env_dir, TARGET_DIRECTORY)
     else:
-        target_prefix = TARGET_DIRECTORY;
+        return TARGET_DIRECTORY;
+
+def list_target_files(target_dir = None):
+    """Returns the paths of all target files in the target directory"""
+    if target_dir is None:
+        target_dir = get_target_dir()
+    try:
+        file_names = os.listdir(target_dir)
+    except OSError as e:
+        raise errors.MMFError("Failed to list target directory '%s': %s" %
+                              (target_dir, e.strerror))
+    return ["%s/%s" % (target_dir, file_name)
+            for file_name in sorted(file_names)
+            if file_name.endswith(TARGET_FILE_EXTENSION)]
+
+def find_target_file(target_string):
+    """Finds the target file location given a target string"""
+    
+    target_prefix = get_target_dir()
 
     # Add extension if not specified
     if TARGET_FILE_EXTENSION in target_string:
@@ -94,11 +118,16 @@ class TargetConfig:
                 "Incomplete target file %s - no audio channel count specified" %
                 self.target_file)
             
-    def __init__(self, target_string):
-        """Loads target configuration from file for given target string"""
+    def __init__(self, target_string, fields = None):
+        """
+        Loads target configuration from file for given target string. Callers
+        that already have the parsed fields (e.g. from the target catalog
+        index) can pass them in directly along with the target file path.
+        """
         
         # Initialize all values - file could be missing fields
         self.target_name = None
+        self.device_class = None
         self.video_max_width = None
         self.video_max_height = None
         self.video_max_bitrate = None
@@ -108,19 +137,38 @@ class TargetConfig:
         self.codec_h264_level = None
         self.audio_max_bitrate = None
         self.audio_max_samplerate = None
+        self.audio_sample_rate = None
         self.audio_channel_count = None
+        self.max_output_duration = None # Seconds per output segment
         
-        target_file = find_target_file(target_string)
-        if target_file is not None:
-            self.target_file = target_file
+        if fields is not None:
+            self.target_file = target_string
+            self._load_fields(fields)
         else:
-            raise errors.MMFError("Target file for '%s' not found." %
-                                  target_string)
+            target_file = find_target_file(target_string)
+            if target_file is not None:
+                self.target_file = target_file
+            else:
+                raise errors.MMFError("Target file for '%s' not found." %
+                                      target_string)
+            self._parse_file()
         
+        try:
+            self._validate()
+        except errors.MMFError:
+            raise
+        
+        if (self.codec_h264_level.lower() == "same" or
+            self.codec_h264_profile.lower() == "same"):
+            self.codec_h264_same = True
+
+    def _parse_file(self):
         cur_file = open(self.target_file, 'r')
         for line in cur_file:
             if line.startswith("TARGET_NAME_STRING"):
                 self.target_name = _get_string_field(line)
+            elif line.startswith("TARGET_DEVICE_CLASS"):
+                self.device_class = _get_string_field(line).lower()
             elif line.startswith("VIDEO_MAX_WIDTH"):
                 self.video_max_width = _get_int_field(line)
             elif line.startswith("VIDEO_MAX_HEIGHT"):
@@ -141,19 +189,26 @@ class TargetConfig:
                 self.audio_sample_rate = _get_int_field(line)
             elif line.startswith("AUDIO_CHANNEL_COUNT"):
                 self.audio_channel_count = _get_int_field(line)
-        
-        try:
-            self._validate()
-        except errors.MMFError:
-            raise
-        
-        if (self.codec_h264_level.lower() == "same" or
-            self.codec_h264_profile.lower() == "same"):
-            self.codec_h264_same = True
+            elif line.startswith("MAX_OUTPUT_DURATION"):
+                self.max_output_duration = _get_int_field(line)
+        cur_file.close()
+
+    def get_fields(self):
+        """Returns the parsed fields as a dict suitable for caching"""
+        fields = {}
+        for field in _PARSED_FIELDS:
+            fields[field] = getattr(self, field)
+        return fields
+
+    def _load_fields(self, fields):
+        """Sets parsed fields from a dict returned by get_fields()"""
+        for field in _PARSED_FIELDS:
+            setattr(self, field, fields.get(field))
 
     def __repr__(self):
         retStr = "\nTarget file: "+ self.target_file + "\n"
         retStr += "Target name: %s\n" % self.target_name
+        retStr += "Device class: %s\n" % self.device_class
         retStr += "Video:\n"
         retStr += "\tMax width: %s\n" % str(self.video_max_width)
         retStr += "\tMax height: %s\n" % str(self.video_max_height)
@@ -164,6 +219,10 @@ class TargetConfig:
         retStr += "\tMax bitrate: %s\n" % str(self.audio_max_bitrate)
         retStr += "\tSample rate: %s\n" % str(self.audio_sample_rate)
         retStr += "\tChannel count: %s\n" % str(self.audio_channel_count)
+        if self.max_output_duration is not None:
+            retStr += "Output:\n"
+            retStr += "\tMax duration: %d seconds per segment\n" % \
+                self.max_output_duration
         return retStr
 
 if __name__ == "__main__":
@@ -0,0 +1,143 @@
+#!/usr/bin/python
+# Mark's Media Framework
+# Copyright (C) 2011  Mark Pariente
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from mmf import catalog
+from mmf import errors
+from mmf import targetconfig
+from mmf import vidparse
+
+TARGET_DIR = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "targets")
+
+# 1080p H.264 High@L4.1 with stereo AAC
+_H264_FIELDS = {"vid_stream_id": 1, "vid_format_profile": "High@L4.1",
+                "vid_interlaced": False, "vid_width": 1920,
+                "vid_height": 1080, "vid_bitrate": 8000, "vid_fps": 23.976,
+                "_vid_codec_id": "V_MPEG4/ISO/AVC", "_vid_format": "AVC",
+                "audio_stream_id": 2, "audio_format": "AAC",
+                "audio_codec_id": "A_AAC", "audio_channels": 2,
+                "audio_bitrate": 192, "audio_samplerate": 48000,
+                "duration": 100.0}
+
+# 1080i MPEG-2 with 5.1 AC-3, as broadcast
+_MPEG2_FIELDS = dict(_H264_FIELDS, vid_format_profile = "Main@High",
+                     vid_interlaced = True, vid_fps = 29.97,
+                     _vid_codec_id = "2", _vid_format = "MPEG Video",
+                     audio_format = "AC-3", audio_codec_id = "129",
+                     audio_channels = 6, audio_bitrate = 384)
+
+class RankTargetsTest(unittest.TestCase):
+
+    def setUp(self):
+        (input_fd, self.input_file) = tempfile.mkstemp(".mkv")
+        os.close(input_fd)
+        self.target_list = [targetconfig.TargetConfig(target_file)
+                            for target_file in
+                            targetconfig.list_target_files(TARGET_DIR)]
+
+    def tearDown(self):
+        os.remove(self.input_file)
+
+    def _rank(self, fields):
+        vid_info = vidparse.VidParser(self.input_file, None, fields)
+        return dict((os.path.basename(ranked.target_config.target_file),
+                     ranked) for ranked in
+                    catalog.rank_targets(vid_info, self.target_list))
+
+    def test_progressive_h264_tiers(self):
+        ranked = self._rank(_H264_FIELDS)
+        self.assertEqual(ranked["1080p-mp4-h264-aac.mmftarget"].tier,
+                         catalog.TIER_PASSTHROUGH)
+        self.assertEqual(ranked["youtube-1080p.mmftarget"].tier,
+                         catalog.TIER_ENCODE)
+        self.assertEqual(ranked["ipad.mmftarget"].tier,
+                         catalog.TIER_RESCALE)
+        # Interlaced output needs interlaced input
+        self.assertFalse("1080i-mp4-h264-aac.mmftarget" in ranked)
+
+    def test_interlaced_mpeg2_tiers(self):
+        ranked = self._rank(_MPEG2_FIELDS)
+        self.assertEqual(ranked["youtube-1080p.mmftarget"].tier,
+                         catalog.TIER_DEINTERLACE)
+        self.assertEqual(ranked["ipad.mmftarget"].tier,
+                         catalog.TIER_DEINTERLACE_RESCALE)
+        # No H.264 profile and level to keep
+        self.assertFalse("1080p-mp4-h264-aac.mmftarget" in ranked)
+        self.assertFalse("1080i-mp4-h264-aac.mmftarget" in ranked)
+
+    def test_cheapest_first(self):
+        vid_info = vidparse.VidParser(self.input_file, None, _H264_FIELDS)
+        ranked_list = catalog.rank_targets(vid_info, self.target_list)
+        cost_list = [ranked.get_cost() for ranked in ranked_list]
+        self.assertEqual(cost_list, sorted(cost_list))
+        self.assertEqual(ranked_list[0].tier, catalog.TIER_PASSTHROUGH)
+
+    def test_smaller_size_is_cheaper_within_tier(self):
+        ranked = self._rank(_H264_FIELDS)
+        self.assertTrue(ranked["iphone3gs.mmftarget"].get_cost() <
+                        ranked["ipad.mmftarget"].get_cost())
+
+class TargetCatalogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.target_dir = os.path.join(self.temp_dir, "targets")
+        os.mkdir(self.target_dir)
+        for target_name in ["ipad", "youtube-1080p"]:
+            shutil.copy(os.path.join(TARGET_DIR, target_name +
+                                     targetconfig.TARGET_FILE_EXTENSION),
+                        self.target_dir)
+        self.index_file = os.path.join(self.temp_dir, "targets.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_index(self):
+        target_catalog = catalog.TargetCatalog(self.target_dir,
+                                               self.index_file)
+        self.assertEqual((target_catalog.index_hits,
+                          target_catalog.index_misses), (0, 2))
+        target_catalog = catalog.TargetCatalog(self.target_dir,
+                                               self.index_file)
+        self.assertEqual((target_catalog.index_hits,
+                          target_catalog.index_misses), (2, 0))
+        self.assertEqual(target_catalog.get_device_classes(),
+                         ["tablet", "web"])
+
+    def test_skips_broken_target(self):
+        broken_fd = open(os.path.join(self.target_dir, "broken" +
+                                      targetconfig.TARGET_FILE_EXTENSION),
+                         'w')
+        broken_fd.write("VIDEO_MAX_WIDTH=wide\n")
+        broken_fd.close()
+        target_catalog = catalog.TargetCatalog(self.target_dir,
+                                               self.index_file)
+        self.assertEqual(len(target_catalog), 2)
+
+    def test_unknown_device_class(self):
+        target_catalog = catalog.TargetCatalog(self.target_dir)
+        (input_fd, input_file) = tempfile.mkstemp(".mkv", dir = self.temp_dir)
+        os.close(input_fd)
+        vid_info = vidparse.VidParser(input_file, None, _H264_FIELDS)
+        self.assertRaises(errors.MMFError, catalog.rank_device_class,
+                          vid_info, target_catalog, "phone")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,168 @@
+#!/usr/bin/python
+# Mark's Media Framework
+# Copyright (C) 2011  Mark Pariente
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+import os
+import os.path
+import shutil
+import stat
+import tempfile
+import unittest
+
+from mmf import checkpoint
+from mmf import errors
+
+_JOB_KEY = "0123456789abcdef"
+
+class JobDirTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_root = tempfile.mkdtemp()
+        self.job_dirs = []
+
+    def tearDown(self):
+        for job_dir in self.job_dirs:
+            if job_dir._lock_fd is not None:
+                job_dir.remove_all()
+        shutil.rmtree(self.temp_root)
+
+    def _open(self, resume = False, job_key = _JOB_KEY):
+        job_dir = checkpoint.JobDir(self.temp_root, job_key, resume)
+        self.job_dirs.append(job_dir)
+        return job_dir
+
+    def _release(self, job_dir):
+        """Lets go of job_dir as a killed run would, leaving its files"""
+        os.close(job_dir._lock_fd)
+        job_dir._lock_fd = None
+
+    def _make_file(self, job_dir, file_name):
+        file_fd = open(os.path.join(job_dir.path, file_name), 'w')
+        file_fd.write("x")
+        file_fd.close()
+
+    def test_private_directory(self):
+        job_dir = self._open()
+        self.assertEqual(os.path.basename(job_dir.path),
+                         checkpoint.JOB_DIR_PREFIX + _JOB_KEY)
+        self.assertEqual(stat.S_IMODE(os.stat(job_dir.path).st_mode), 0700)
+        self.assertFalse(job_dir.has_checkpoints())
+
+    def test_resume(self):
+        job_dir = self._open()
+        self._make_file(job_dir, "pass1.log")
+        job_dir.record("pass1")
+        job_dir.set_value("crop", "1920:800:0:140")
+        self._release(job_dir)
+
+        resumed = self._open(True)
+        self.assertTrue(resumed.is_done("pass1"))
+        self.assertFalse(resumed.is_done("pass2"))
+        self.assertEqual(resumed.get_value("crop"), "1920:800:0:140")
+        self.assertFalse(resumed.discarded)
+        self.assertTrue(os.path.exists(os.path.join(resumed.path,
+                                                    "pass1.log")))
+
+    def test_no_resume_discards(self):
+        job_dir = self._open()
+        self._make_file(job_dir, "pass1.log")
+        job_dir.record("pass1")
+        self._release(job_dir)
+
+        fresh = self._open()
+        self.assertFalse(fresh.is_done("pass1"))
+        self.assertTrue(fresh.discarded)
+        self.assertEqual(os.listdir(fresh.path), [checkpoint._LOCK_FILE])
+
+    def test_resume_other_key_discards(self):
+        job_dir = self._open()
+        job_dir.record("pass1")
+        self._release(job_dir)
+        os.rename(job_dir.path, os.path.join(
+            self.temp_root, checkpoint.JOB_DIR_PREFIX + "other"))
+
+        resumed = self._open(True, "other")
+        self.assertFalse(resumed.has_checkpoints())
+        self.assertTrue(resumed.discarded)
+
+    def test_locked(self):
+        self._open()
+        self.assertRaises(errors.MMFError, checkpoint.JobDir,
+                          self.temp_root, _JOB_KEY, True)
+
+    def test_refuses_shared_directory(self):
+        job_path = os.path.join(self.temp_root,
+                                checkpoint.JOB_DIR_PREFIX + _JOB_KEY)
+        os.mkdir(job_path)
+        os.chmod(job_path, 0777)
+        self.assertRaises(errors.MMFError, checkpoint.JobDir,
+                          self.temp_root, _JOB_KEY)
+
+    def test_fixes_readable_directory(self):
+        job_path = os.path.join(self.temp_root,
+                                checkpoint.JOB_DIR_PREFIX + _JOB_KEY)
+        os.mkdir(job_path)
+        os.chmod(job_path, 0755)
+        self._open()
+        self.assertEqual(stat.S_IMODE(os.stat(job_path).st_mode), 0700)
+
+    def test_remove(self):
+        job_dir = self._open()
+        job_dir.record("pass1")
+        job_dir.remove()
+        self.assertFalse(os.path.exists(job_dir.path))
+
+    def test_sync_dir_skips_vanished_file(self):
+        job_dir = self._open()
+        self._make_file(job_dir, "x264_2pass.log.temp")
+        vanished = os.path.join(job_dir.path, "x264_2pass.log.temp")
+        real_open = os.open
+
+        def racing_open(path, flags, *args):
+            # The encoder renames its log between listdir() and open()
+            if path == vanished and os.path.exists(path):
+                os.rename(path, path[:-len(".temp")])
+            return real_open(path, flags, *args)
+
+        os.open = racing_open
+        try:
+            job_dir.record("pass1")
+        finally:
+            os.open = real_open
+        self.assertTrue(os.path.exists(job_dir.checkpoint_file))
+
+class MakeJobKeyTest(unittest.TestCase):
+
+    def setUp(self):
+        (input_fd, self.input_file) = tempfile.mkstemp(".mkv")
+        os.close(input_fd)
+
+    def tearDown(self):
+        os.remove(self.input_file)
+
+    def test_key_follows_inputs(self):
+        args = ["-t", "ipad", self.input_file]
+        job_key = checkpoint.make_job_key(args, [self.input_file])
+        self.assertEqual(checkpoint.make_job_key(args, [self.input_file]),
+                         job_key)
+        self.assertNotEqual(checkpoint.make_job_key(args + ["-q"],
+                                                    [self.input_file]),
+                            job_key)
+        input_fd = open(self.input_file, 'w')
+        input_fd.write("changed")
+        input_fd.close()
+        self.assertNotEqual(checkpoint.make_job_key(args, [self.input_file]),
+                            job_key)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,143 @@
+#!/usr/bin/python
+# Mark's Media Framework
+# Copyright (C) 2011  Mark Pariente
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from mmf import errors
+from mmf import library
+from mmf import vidparse
+
+_FIELDS = {"vid_stream_id": 1, "vid_format_profile": "High@L4.1",
+           "vid_interlaced": False, "vid_width": 1920, "vid_height": 1080,
+           "vid_bitrate": 8000, "vid_fps": 23.976,
+           "_vid_codec_id": "V_MPEG4/ISO/AVC", "_vid_format": "AVC",
+           "audio_stream_id": 2, "audio_format": "AAC",
+           "audio_codec_id": "A_AAC", "audio_channels": 2,
+           "audio_bitrate": 192, "audio_samplerate": 48000,
+           "duration": 100.0}
+
+class LibraryIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.lib_dir = os.path.join(self.temp_dir, "lib")
+        self.index = library.LibraryIndex(os.path.join(self.temp_dir,
+                                                       "library.db"))
+        self.probed = []
+        self._probe_library = library.plan.probe_library
+        library.plan.probe_library = self._fake_probe_library
+
+    def tearDown(self):
+        library.plan.probe_library = self._probe_library
+        self.index.close()
+        shutil.rmtree(self.temp_dir)
+
+    def _fake_probe_library(self, file_list, cache):
+        """Files named bad* fail, the others are 1080p H.264"""
+        results = []
+        for file_name in file_list:
+            self.probed.append(file_name)
+            if os.path.basename(file_name).startswith("bad"):
+                results.append((None, errors.MMFError(
+                    "Failed to parse video file '%s'" % file_name)))
+            else:
+                results.append((vidparse.VidParser(file_name, None,
+                                                   _FIELDS), None))
+        return results
+
+    def _make_file(self, rel_path, data = "x"):
+        file_path = os.path.join(self.temp_dir, rel_path)
+        if not os.path.isdir(os.path.dirname(file_path)):
+            os.makedirs(os.path.dirname(file_path))
+        file_fd = open(file_path, 'w')
+        file_fd.write(data)
+        file_fd.close()
+        return file_path
+
+    def _query_paths(self, path_list, include_errors = False):
+        return [os.path.relpath(record.path, self.temp_dir)
+                for record in self.index.query(
+                    path_list = path_list, include_errors = include_errors)]
+
+    def test_path_query_is_a_directory_prefix(self):
+        for rel_path in ["lib/a.mkv", "lib/sub/b.mkv", "lib2/c.mkv",
+                         "lib.mkv"]:
+            self._make_file(rel_path)
+        self.index.scan([self.temp_dir])
+        self.assertEqual(self._query_paths([self.lib_dir]),
+                         ["lib/a.mkv", "lib/sub/b.mkv"])
+        self.assertEqual(self._query_paths([self.lib_dir + "/"]),
+                         ["lib/a.mkv", "lib/sub/b.mkv"])
+        self.assertEqual(self._query_paths([os.path.join(self.lib_dir,
+                                                         "a.mkv")]),
+                         ["lib/a.mkv"])
+        self.assertEqual(self._query_paths([os.path.join(self.temp_dir,
+                                                         "lib2")]),
+                         ["lib2/c.mkv"])
+
+    def test_path_query_uses_primary_key(self):
+        plan_rows = self.index._db.execute(
+            "EXPLAIN QUERY PLAN SELECT path FROM media WHERE " +
+            library._PATH_CONDITION,
+            library._get_path_params(self.lib_dir)).fetchall()
+        self.assertFalse(any(row[-1].startswith("SCAN")
+                             for row in plan_rows))
+
+    def test_incremental_scan(self):
+        self._make_file("lib/a.mkv")
+        self._make_file("lib/bad.mkv")
+        self._make_file("lib/notes.nfo")
+        self.index.scan([self.lib_dir])
+        self.assertEqual((self.index.probed, self.index.failed), (1, 1))
+        self.assertEqual(self._query_paths([self.lib_dir]), ["lib/a.mkv"])
+        self.assertEqual(self._query_paths([self.lib_dir], True),
+                         ["lib/a.mkv", "lib/bad.mkv"])
+
+        self.probed = []
+        self._make_file("lib/a.mkv", "changed")
+        os.remove(os.path.join(self.lib_dir, "bad.mkv"))
+        self.index.scan([self.lib_dir])
+        self.assertEqual(self.probed, [os.path.join(self.lib_dir, "a.mkv")])
+        self.assertEqual(self.index.removed, 1)
+        self.assertEqual(self._query_paths([self.lib_dir], True),
+                         ["lib/a.mkv"])
+
+    def test_non_ascii_path(self):
+        file_path = self._make_file("lib/Am\xc3\xa9lie.mkv")
+        self._make_file("lib/bad-\xc3\xa9.mkv")
+        self.index.scan([self.lib_dir])
+        record_list = self.index.query(path_list = [self.lib_dir],
+                                       include_errors = True)
+        self.assertEqual([record.path for record in record_list],
+                         [file_path,
+                          os.path.join(self.lib_dir, "bad-\xc3\xa9.mkv")])
+        self.assertTrue(isinstance(record_list[0].path, str))
+        self.probed = []
+        self.index.scan([self.lib_dir])
+        self.assertEqual(self.probed, [])
+
+    def test_field_query(self):
+        self._make_file("lib/a.mkv")
+        self.index.scan([self.lib_dir])
+        self.assertEqual(len(self.index.query(
+            codec = vidparse.VIDEO_CODEC_H264, min_width = 1920)), 1)
+        self.assertEqual(len(self.index.query(interlaced = True)), 0)
+        self.assertEqual(len(self.index.query(max_height = 720)), 0)
+
+if __name__ == "__main__":
+    unittest.main()
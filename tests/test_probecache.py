@@ -0,0 +1,139 @@
+#!/usr/bin/python
+# Mark's Media Framework
+# Copyright (C) 2011  Mark Pariente
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+import os
+import os.path
+import shutil
+import tempfile
+import time
+import unittest
+
+from mmf import probecache
+
+class ProbeCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.temp_dir, "probe.db")
+        self.caches = []
+
+    def tearDown(self):
+        # Otherwise flushed at exit, after the database is gone
+        for cache in self.caches:
+            cache.flush()
+        shutil.rmtree(self.temp_dir)
+
+    def _open_cache(self, **kwargs):
+        cache = probecache.ProbeCache(self.cache_path, **kwargs)
+        self.caches.append(cache)
+        return cache
+
+    def _make_file(self, file_name, data = "x"):
+        file_path = os.path.join(self.temp_dir, file_name)
+        file_fd = open(file_path, 'w')
+        file_fd.write(data)
+        file_fd.close()
+        return file_path
+
+    def test_hit_and_miss(self):
+        cache = self._open_cache()
+        file_path = self._make_file("a.mkv")
+        self.assertEqual(cache.lookup(file_path), None)
+        cache.store(file_path, {"vid_width": 1920})
+        self.assertEqual(cache.lookup(file_path), {"vid_width": 1920})
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_relative_path_shares_entry(self):
+        cache = self._open_cache()
+        file_path = self._make_file("a.mkv")
+        cache.store(file_path, {"vid_width": 1920})
+        cwd = os.getcwd()
+        os.chdir(self.temp_dir)
+        try:
+            self.assertEqual(cache.lookup("a.mkv"), {"vid_width": 1920})
+        finally:
+            os.chdir(cwd)
+
+    def test_modified_file_misses(self):
+        cache = self._open_cache()
+        file_path = self._make_file("a.mkv")
+        cache.store(file_path, {"vid_width": 1920})
+        self._make_file("a.mkv", "longer")
+        self.assertEqual(cache.lookup(file_path), None)
+
+    def test_touched_file_misses(self):
+        cache = self._open_cache()
+        file_path = self._make_file("a.mkv")
+        cache.store(file_path, {"vid_width": 1920})
+        st = os.stat(file_path)
+        os.utime(file_path, (st.st_atime, st.st_mtime + 10))
+        self.assertEqual(cache.lookup(file_path), None)
+
+    def test_non_ascii_path(self):
+        cache = self._open_cache()
+        file_path = self._make_file("Am\xc3\xa9lie.mkv")
+        self.assertEqual(cache.lookup(file_path), None)
+        cache.store(file_path, {"vid_width": 1920})
+        self.assertEqual(cache.lookup(file_path), {"vid_width": 1920})
+        cache.invalidate(file_path)
+        self.assertEqual(len(cache), 0)
+
+    def test_path_round_trip(self):
+        file_path = os.path.join(self.temp_dir, "Am\xc3\xa9lie.mkv")
+        db_path = probecache.decode_path(file_path)
+        self.assertTrue(isinstance(db_path, unicode))
+        self.assertEqual(probecache.encode_path(db_path), file_path)
+
+    def test_evicts_least_recently_used(self):
+        cache = self._open_cache(max_entries = 2)
+        file_list = [self._make_file("%d.mkv" % i) for i in range(3)]
+        cache.store(file_list[0], {"index": 0})
+        time.sleep(0.01)
+        cache.store(file_list[1], {"index": 1})
+        time.sleep(0.01)
+        # Using the oldest entry keeps it over the second one
+        self.assertEqual(cache.lookup(file_list[0]), {"index": 0})
+        time.sleep(0.01)
+        cache.store(file_list[2], {"index": 2})
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.lookup(file_list[0]), {"index": 0})
+        self.assertEqual(cache.lookup(file_list[1]), None)
+        self.assertEqual(cache.lookup(file_list[2]), {"index": 2})
+
+    def test_evicts_expired(self):
+        cache = self._open_cache(max_age = 1)
+        file_path = self._make_file("a.mkv")
+        cache.store(file_path, {"vid_width": 1920})
+        cache.max_age = 0
+        time.sleep(0.01)
+        self.assertEqual(cache.lookup(file_path), None)
+        cache.store(self._make_file("b.mkv"), {"vid_width": 1280})
+        self.assertEqual(len(cache), 1)
+
+    def test_totals_persist(self):
+        cache = self._open_cache()
+        file_path = self._make_file("a.mkv")
+        cache.lookup(file_path)
+        cache.store(file_path, {"vid_width": 1920})
+        cache.lookup(file_path)
+        cache.flush()
+
+        other_cache = self._open_cache()
+        other_cache.lookup(file_path)
+        self.assertEqual(other_cache.get_totals(), (2, 1))
+        other_cache.clear()
+        self.assertEqual(other_cache.get_totals(), (0, 0))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,99 @@
+#!/usr/bin/python
+# Mark's Media Framework
+# Copyright (C) 2011  Mark Pariente
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+import unittest
+
+from mmf import errors
+from mmf import segment
+
+class _FakeProcess:
+    """Stands in for the finished ffprobe Process of run_capture()"""
+
+    def __init__(self, output, returncode = 0):
+        self.output = output
+        self.returncode = returncode
+
+    def get_failure_str(self):
+        return "exit status %d" % self.returncode
+
+class PlanSegmentsTest(unittest.TestCase):
+
+    def test_splits_on_keyframes(self):
+        keyframes = [0.0, 2.0, 4.0, 6.0, 8.0]
+        self.assertEqual(segment.plan_segments(keyframes, 0.0, 10.0, 2),
+                         [(0.0, 6.0), (6.0, 4.0)])
+
+    def test_first_segment_starts_at_window_start(self):
+        keyframes = [0.0, 5.0, 10.0, 15.0]
+        segments = segment.plan_segments(keyframes, 3.0, 20.0, 2)
+        self.assertEqual(segments[0][0], 3.0)
+        self.assertEqual(segments, [(3.0, 12.0), (15.0, 5.0)])
+
+    def test_segments_cover_window(self):
+        keyframes = [i * 2.002 for i in range(50)]
+        segments = segment.plan_segments(keyframes, 0.0, 100.0, 4)
+        self.assertEqual(len(segments), 4)
+        for (cur, following) in zip(segments, segments[1:]):
+            self.assertAlmostEqual(cur[0] + cur[1], following[0])
+        self.assertAlmostEqual(segments[-1][0] + segments[-1][1], 100.0)
+
+    def test_too_few_keyframes(self):
+        # No keyframe after the split point leaves a single segment
+        self.assertEqual(segment.plan_segments([0.0], 0.0, 10.0, 3),
+                         [(0.0, 10.0)])
+
+    def test_keyframe_at_end_is_not_a_boundary(self):
+        self.assertEqual(segment.plan_segments([0.0, 10.0], 0.0, 10.0, 2),
+                         [(0.0, 10.0)])
+
+class FindKeyframesTest(unittest.TestCase):
+
+    def setUp(self):
+        self._run_capture = segment.procgraph.run_capture
+        self.output = ""
+        self.returncode = 0
+        segment.procgraph.run_capture = self._fake_run_capture
+
+    def tearDown(self):
+        segment.procgraph.run_capture = self._run_capture
+
+    def _fake_run_capture(self, name, args, cwd = None, timeout = None):
+        self.args = args
+        return _FakeProcess(self.output, self.returncode)
+
+    def test_zero_start_time(self):
+        self.output = "0.000000,K_\n0.500000,__\n1.000000,K_\n0.000000\n"
+        self.assertEqual(segment.find_keyframes("in.mkv"), ([0.0, 1.0], 1.0))
+        self.assertTrue("packet=pts_time,flags:format=start_time" in self.args)
+
+    def test_times_relative_to_start_time(self):
+        # MPEG-TS timestamps start wherever the broadcast was at
+        self.output = ("1.400000,K_\n1.900000,__\n3.400000,K_\n"
+                       "4.400000,__\nN/A,__\n1.400000\n")
+        (keyframes, duration) = segment.find_keyframes("in.ts")
+        self.assertEqual(len(keyframes), 2)
+        self.assertAlmostEqual(keyframes[0], 0.0)
+        self.assertAlmostEqual(keyframes[1], 2.0)
+        self.assertAlmostEqual(duration, 3.0)
+
+    def test_unordered_packets(self):
+        self.output = "2.000000,K_\n0.000000,K_\n1.000000,__\n0.000000\n"
+        self.assertEqual(segment.find_keyframes("in.mkv"), ([0.0, 2.0], 2.0))
+
+    def test_failure(self):
+        self.returncode = 1
+        self.assertRaises(errors.MMFError, segment.find_keyframes, "in.mkv")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,141 @@
+#!/usr/bin/python
+# Mark's Media Framework
+# Copyright (C) 2011  Mark Pariente
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+import json
+import os
+import os.path
+import shutil
+import tempfile
+import time
+import unittest
+
+from mmf import errors
+from mmf import spool
+
+_JOB_ARGS = ["-t", "ipad", "-o", "out.mp4", "in.mkv"]
+
+class SpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.spool_dir = os.path.join(self.temp_dir, "spool")
+        spool.init_spool(self.spool_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _make_worker(self, worker_id, claim_timeout = 60):
+        worker = spool.Worker(self.spool_dir, claim_timeout = claim_timeout)
+        # Workers of one process would share their id otherwise
+        worker.worker_id = worker_id
+        return worker
+
+    def _list(self, sub_dir):
+        return sorted(os.listdir(os.path.join(self.spool_dir, sub_dir)))
+
+    def _write_job(self, job_name, data):
+        job_fd = open(os.path.join(self.spool_dir, spool.PENDING_DIR,
+                                   job_name + spool.JOB_EXTENSION), 'w')
+        job_fd.write(data)
+        job_fd.close()
+
+    def test_submit(self):
+        job_name = spool.submit(self.spool_dir, _JOB_ARGS, self.temp_dir)
+        self.assertEqual(self._list(spool.PENDING_DIR),
+                         [job_name + spool.JOB_EXTENSION])
+        job_fd = open(os.path.join(self.spool_dir, spool.PENDING_DIR,
+                                   job_name + spool.JOB_EXTENSION), 'r')
+        self.assertEqual(json.load(job_fd), {"args": _JOB_ARGS,
+                                             "work_dir": self.temp_dir})
+        job_fd.close()
+
+    def test_submit_invalid(self):
+        self.assertRaises(errors.MMFError, spool.submit, self.spool_dir,
+                          ["in.mkv"], self.temp_dir)
+
+    def test_claim_once(self):
+        job_name = spool.submit(self.spool_dir, _JOB_ARGS, self.temp_dir)
+        first = self._make_worker("first")
+        second = self._make_worker("second")
+        (claimed_name, claim_path) = first.claim_next()
+        self.assertEqual(claimed_name, job_name)
+        self.assertEqual(os.path.basename(claim_path),
+                         job_name + spool.JOB_EXTENSION + "@first")
+        self.assertEqual(second.claim_next(), None)
+        self.assertEqual(self._list(spool.PENDING_DIR), [])
+
+    def test_claim_oldest_first(self):
+        self._write_job("2", "{}")
+        self._write_job("1", "{}")
+        worker = self._make_worker("worker")
+        self.assertEqual(worker.claim_next()[0], "1")
+        self.assertEqual(worker.claim_next()[0], "2")
+        self.assertEqual(worker.claim_next(), None)
+
+    def test_claim_starts_heartbeat(self):
+        self._write_job("1", "{}")
+        pending_path = os.path.join(self.spool_dir, spool.PENDING_DIR,
+                                    "1" + spool.JOB_EXTENSION)
+        os.utime(pending_path, (0, 0))
+        (job_name, claim_path) = self._make_worker("worker").claim_next()
+        self.assertTrue(time.time() - os.stat(claim_path).st_mtime < 60)
+
+    def test_reclaim_waits_out_grace(self):
+        spool.submit(self.spool_dir, _JOB_ARGS, self.temp_dir)
+        owner = self._make_worker("owner")
+        (job_name, claim_path) = owner.claim_next()
+        os.utime(claim_path, (0, 0))
+
+        other = self._make_worker("other")
+        other.reclaim_expired()
+        self.assertFalse(os.path.exists(claim_path))
+        self.assertEqual(self._list(spool.PENDING_DIR),
+                         [job_name + spool.JOB_EXTENSION])
+        # The owner gets the grace period to notice and stop
+        self.assertEqual(other.claim_next(), None)
+
+        pending_path = os.path.join(self.spool_dir, spool.PENDING_DIR,
+                                    job_name + spool.JOB_EXTENSION)
+        os.utime(pending_path, (time.time() - 1, time.time() - 1))
+        self.assertEqual(other.claim_next()[0], job_name)
+
+    def test_live_claim_is_kept(self):
+        spool.submit(self.spool_dir, _JOB_ARGS, self.temp_dir)
+        (job_name, claim_path) = self._make_worker("owner").claim_next()
+        self._make_worker("other").reclaim_expired()
+        self.assertTrue(os.path.exists(claim_path))
+
+    def test_unreadable_job_fails(self):
+        self._write_job("1", "{not json")
+        worker = self._make_worker("worker")
+        (job_name, claim_path) = worker.claim_next()
+        worker.run_job(job_name, claim_path)
+        self.assertEqual(self._list(spool.CLAIMED_DIR), [])
+        self.assertEqual(self._list(spool.FAILED_DIR),
+                         ["1" + spool.JOB_EXTENSION,
+                          "1" + spool.RESULT_EXTENSION])
+        self.assertEqual(worker.claim_next(), None)
+
+    def test_invalid_job_is_done_without_running(self):
+        self._write_job("1", json.dumps({"args": ["in.mkv"],
+                                         "work_dir": self.temp_dir}))
+        worker = self._make_worker("worker")
+        worker.run_job(*worker.claim_next())
+        self.assertEqual(self._list(spool.DONE_DIR),
+                         ["1" + spool.JOB_EXTENSION,
+                          "1" + spool.RESULT_EXTENSION])
+        self.assertEqual(self._list(spool.LOG_DIR), [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -12,30 +12,484 @@
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 # GNU General Public License for more details.
 
+import errno
+import functools
+import glob
+import json
+import multiprocessing
 import optparse
 import os
 import shlex
-import subprocess
+import signal
 import sys
-import tempfile
+import threading
+import time
 
 from mmf import *
 
-def _calc_scaled_bitrate(target_config, video_max_bitrate,
-                         scaled_width, scaled_height):
-    return (int(video_max_bitrate * 
-            float(scaled_width * scaled_height) /
-            float(target_config.video_max_width * 
-                  target_config.video_max_height)))
+# Audio file produced by the ffmpeg audio encode in segmented mode
+_SEGMENT_AUDIO_FILE = "output-audio.m4a"
 
-def main(argv = sys.argv):
+# Audio file produced by neroAacEnc, and the named pipe used instead with
+# --audio-pipe
+_NEROAAC_AUDIO_FILE = "output-audio.aac"
+_NEROAAC_AUDIO_FIFO = "output-audio-fifo.aac"
+_FIFO_RETRY_INTERVAL = 0.5 # Seconds between attempts to release a FIFO
+
+TEMP_DIR_ENV_VAR = "MMF_TEMP_DIR"
+
+# Pass log prefix for each output in multiple target mode
+_MULTI_PASSLOG_PREFIX = "mmf-pass"
+
+# Ways of feeding multiple input files to ffmpeg
+CONCAT_PIPE = "pipe" # Stream the files to ffmpeg's stdin on every pass
+CONCAT_LIST = "list" # Have ffmpeg's concat demuxer read the files directly
+CONCAT_FILE = "file" # Concatenate the files once into the working directory
+
+# Prefix for the concatenated input built in list and file concat modes
+_CONCAT_INPUT_PREFIX = "input-concat"
+
+# Start of the line reporting how much input data a job streamed
+INPUT_BYTES_READ_PREFIX = "Input bytes read: "
+
+# Checkpoint of the concatenated input built in list and file concat modes
+_CONCAT_INPUT_STAGE = "concat input"
+
+def _target_output_path(output_path, target_string):
+    """Derives a per-target output path from a single output path"""
+    (output_root, output_ext) = os.path.splitext(output_path)
+    target_name = os.path.splitext(os.path.basename(target_string))[0]
+    return "%s-%s%s" % (output_root, target_name, output_ext)
+
+def _pass_monitor(reporter, pass_name, duration):
+    """Returns a PassMonitor for a pass, or None without progress output"""
+    if reporter is None:
+        return None
+    return progress.PassMonitor(reporter, pass_name, duration)
+
+def _run_ffmpeg(ffmpeg_cmdline, single_file, input_files, work_dir,
+                monitor = None, timeout = None):
+    """
+    Runs an ffmpeg command line to completion in the given working directory,
+    streaming the input files to its stdin in multiple file mode and
+    reporting progress to the optional PassMonitor. Raises MMFError if
+    ffmpeg fails or runs longer than timeout seconds.
+    """
+    print ffmpeg_cmdline
+    ffmpeg_args = shlex.split(ffmpeg_cmdline)
+    graph = procgraph.ProcessGraph()
+    pass_fds = []
+    on_start = None
+    if monitor is not None:
+        ffmpeg_args[1:1] = monitor.get_args()
+        (progress_fd, progress_write_fd) = monitor.get_fds()
+        pass_fds = [progress_write_fd]
+        on_start = functools.partial(monitor.start, False)
+        graph.add_reader(progress_fd, monitor.feed)
+    if single_file:
+        ffmpeg_stdin = None
+    else:
+        ffmpeg_stdin = input_files
+    ffmpeg = graph.add_process("FFMpeg", ffmpeg_args, work_dir, ffmpeg_stdin,
+                               timeout = timeout, pass_fds = pass_fds,
+                               on_start = on_start)
+    try:
+        graph.run()
+    finally:
+        if monitor is not None:
+            monitor.finish(ffmpeg.returncode)
+        if not single_file:
+            input_files.rewind()
+
+    if ffmpeg.feed_error is not None:
+        raise errors.MMFError("FFMpeg was killed or input files not \
+compatible with concatenation\n%s" % ffmpeg.feed_error)
+    if ffmpeg.returncode != 0:
+        raise errors.MMFError("FFMpeg failed with exit code %d" %
+                              ffmpeg.returncode)
+
+def _prepare_concat_input(concat_mode, input_files, work_dir, reuse = False):
+    """
+    Builds the single input that all passes read multiple input files from in
+    list or file concat mode, returning its path in the working directory.
+    With reuse the input built by an earlier run of the job is used.
+    """
+    file_list = input_files.get_file_list()
+    if concat_mode == CONCAT_LIST:
+        concat_path = os.path.join(work_dir, _CONCAT_INPUT_PREFIX + ".txt")
+    else:
+        concat_path = os.path.join(work_dir, _CONCAT_INPUT_PREFIX +
+                                   os.path.splitext(file_list[0])[1])
+    if reuse:
+        return concat_path
+
+    if concat_mode == CONCAT_LIST:
+        segment.write_concat_list(concat_path, file_list)
+        return concat_path
+
+    print "Concatenating input files to " + concat_path
+    input_files.set_output(open(concat_path, 'wb'))
+    try:
+        input_files.write_all()
+    except IOError as e:
+        raise errors.MMFError("Failed to concatenate input files: %s" % e)
+    input_files.rewind()
+    return concat_path
+
+def _remove_concat_input(work_dir):
+    """Removes the input built by _prepare_concat_input(), if any"""
+    for concat_file in glob.glob(os.path.join(work_dir,
+                                              _CONCAT_INPUT_PREFIX + "*")):
+        os.remove(concat_file)
+
+def _print_bytes_read(input_readers):
+    """Prints how much input file data the readers streamed for the job"""
+    if len(input_readers) == 0:
+        return
+    bytes_read = 0
+    for input_reader in input_readers:
+        bytes_read += input_reader.bytes_read
+    total_size = input_readers[0].get_total_size()
+    print (INPUT_BYTES_READ_PREFIX + "%d (%.1fx the %d bytes of input)" %
+           (bytes_read, float(bytes_read) / max(total_size, 1), total_size))
+
+def _run_first_pass(ffmpeg_cmdline, single_file, input_files, work_dir,
+                    monitor, pass_cache, pass_key):
+    """Runs the video first pass and caches its pass logs for reuse"""
+    _run_ffmpeg(ffmpeg_cmdline, single_file, input_files, work_dir, monitor)
+    if pass_cache is not None:
+        pass_cache.store(pass_key, work_dir)
+
+def _add_stage(stage_pipeline, job_dir, name, func, deps = None):
+    """
+    Adds a stage that records a checkpoint in the job directory once it has
+    finished and returns it. A stage that finished in an earlier run of the
+    job isn't added and None is returned instead.
+    """
+    if job_dir.is_done(name):
+        print "Skipping %s, finished in an earlier run" % name
+        return None
+    return stage_pipeline.add_stage(name, job_dir.wrap(name, func),
+                                    [dep for dep in deps or []
+                                     if dep is not None])
+
+def _fail_job(job_dir, msg):
+    """
+    Exits after a failure. The job directory is kept for --resume if anything
+    has been checkpointed, otherwise it is removed.
+    """
+    print msg
+    if job_dir.has_checkpoints():
+        print "Checkpoints are kept in %s, rerun with --resume to continue" % \
+            job_dir.path
+    else:
+        job_dir.remove_all()
+    sys.exit(1)
+
+def _handle_sigterm(signum, frame):
+    # Wind the job down like Ctrl-C, so that running processes are terminated
+    # and the checkpoints stay consistent
+    raise KeyboardInterrupt()
+
+def _run_final_pass_segmented(ffmpeg_cmdline, single_file, input_files,
+                              work_dir, monitor, segment_writer):
+    """Runs the final pass publishing its output segments as they close"""
+    segment_writer.start()
+    try:
+        _run_ffmpeg(ffmpeg_cmdline, single_file, input_files, work_dir,
+                    monitor)
+    except errors.MMFError:
+        segment_writer.finish(False)
+        raise
+    segment_writer.finish(True)
+
+def _encode_audio_neroaac(offset_str, length_str, input_file_str,
+                          single_file, input_files, target_config,
+                          audio_bitrate, work_dir, audio_file):
+    """
+    Encodes the input's audio to audio_file in the working directory using
+    ffmpeg to convert the input to pcm for neroAacEnc
+    """
+    ffmpeg_cmdline = ("ffmpeg -v 0 -y" + offset_str + length_str +
+                      input_file_str + " -vn -acodec pcm_s16le -ac " +
+                      str(target_config.audio_channel_count) + " -ar " +
+                      str(target_config.audio_sample_rate) +
+                      " -f wav pipe:1")
+    print ffmpeg_cmdline
+    ffmpeg_args = shlex.split(ffmpeg_cmdline)
+
+    try:
+        neroaac_dir = os.environ['NEROAAC_DIR']
+    except KeyError:
+        neroaac_dir = ""
+    neroaac_path = os.path.join(neroaac_dir, "neroAacEnc")
+    neroaac_cmdline = (neroaac_path + " -cbr " + str(audio_bitrate) +
+                       " -lc -ignorelength -if - -of " + audio_file)
+    print neroaac_cmdline
+    neroaac_args = shlex.split(neroaac_cmdline)
+
+    # ffmpeg decodes to wav straight into neroAacEnc's stdin, its stderr is
+    # only shown if it fails
+    graph = procgraph.ProcessGraph()
+    if single_file:
+        ffmpeg_stdin = procgraph.DEVNULL
+    else:
+        ffmpeg_stdin = input_files
+    ffmpeg = graph.add_process("FFMpeg", ffmpeg_args, work_dir, ffmpeg_stdin,
+                               procgraph.PIPE, echo_stderr = False)
+    neroaac = graph.add_process("neroAacEnc", neroaac_args, work_dir, ffmpeg)
+    try:
+        graph.run()
+    finally:
+        if not single_file:
+            input_files.rewind()
+
+    if neroaac.returncode != 0:
+        raise errors.MMFError("neroAacEnc failed with exit code %d" %
+                              neroaac.returncode)
+    if ffmpeg.feed_error is not None:
+        raise errors.MMFError("FFMpeg was killed or input files not \
+compatible with concatenation\n%s" % ffmpeg.feed_error)
+    if ffmpeg.returncode != 0:
+        raise errors.MMFError(ffmpeg.get_failure_str())
+
+def _release_fifo(fifo_path, flags, done = None):
+    """
+    Opens and closes the other end of a FIFO to release a process blocked
+    opening it, retrying until done is set while nobody has the FIFO open
+    """
+    while True:
+        try:
+            os.close(os.open(fifo_path, flags | os.O_NONBLOCK))
+            return
+        except OSError as e:
+            # ENXIO is a writer finding no reader yet
+            if e.errno != errno.ENXIO:
+                return
+        if done is None or done.wait(_FIFO_RETRY_INTERVAL):
+            return
+
+def _run_final_pass_fifo(final_pass, encode_audio, audio_fifo):
+    """
+    Runs the final pass while the audio encode streams into it through the
+    named pipe audio_fifo. Opening a FIFO blocks until the other end is
+    opened too, so whichever side fails first releases the other.
+    """
+    audio_errors = []
+    final_done = threading.Event()
+    graphs = procgraph.get_current_group()
+
+    def run_audio():
+        if graphs is not None:
+            # Cancelled along with the final pass
+            graphs.enter()
+        try:
+            encode_audio()
+        except errors.MMFError as e:
+            audio_errors.append(e)
+            _release_fifo(audio_fifo, os.O_WRONLY, final_done)
+
+    audio_thread = threading.Thread(target = run_audio)
+    audio_thread.daemon = True
+    audio_thread.start()
+    try:
+        final_pass()
+    finally:
+        final_done.set()
+        while audio_thread.is_alive():
+            _release_fifo(audio_fifo, os.O_RDONLY)
+            audio_thread.join(_FIFO_RETRY_INTERVAL)
+    if len(audio_errors) > 0:
+        raise audio_errors[0]
+
+def _build_filter_graph(branches):
+    """
+    Builds an ffmpeg filter graph decoding the input video once and feeding
+    one output label [vN] per branch. Each branch is a (deinterlace, size)
+    tuple; all deinterlaced branches share a single yadif instance.
+    """
+    chains = []
+    groups = []
+    for deinterlace in (False, True):
+        group = [idx for (idx, branch) in enumerate(branches)
+                 if branch[0] == deinterlace]
+        if len(group) > 0:
+            groups.append((deinterlace, group))
+
+    if len(groups) > 1:
+        chains.append("[0:v]split=2[src0][src1]")
+        source_labels = ["[src0]", "[src1]"]
+    else:
+        source_labels = ["[0:v]"]
+
+    for ((deinterlace, group), source_label) in zip(groups, source_labels):
+        chain = source_label
+        if deinterlace:
+            chain += "yadif=1,"
+        if len(group) > 1:
+            chain += "split=%d" % len(group)
+        else:
+            chain += "null"
+        for idx in group:
+            chain += "[split%d]" % idx
+        chains.append(chain)
+
+        for idx in group:
+            size = branches[idx][1]
+            if size is not None:
+                chains.append("[split%d]scale=%d:%d[v%d]" %
+                              (idx, size[0], size[1], idx))
+            else:
+                chains.append("[split%d]null[v%d]" % (idx, idx))
+
+    return ";".join(chains)
+
+def _transcode_multi_target(options, vid_info, target_list, output_list,
+                            single_file, input_files, input_file_str,
+                            offset_str, length_str, temp_dir, reporter,
+                            out_duration):
+    """
+    Encodes all targets with a single ffmpeg job that decodes (and if needed
+    deinterlaces) the input once and writes every output in parallel
+    """
+    branches = []
+    output_strs = []
+    first_pass_strs = []
+    for (idx, (target_config, output_path)) in enumerate(zip(target_list,
+                                                             output_list)):
+        target_plan = plan.plan_transcode(vid_info, target_config,
+                                          options.video_bitrate,
+                                          passthrough = False)
+        for warning in target_plan.warnings:
+            print "WARNING: " + warning
+        branches.append((target_plan.deinterlace, target_plan.size))
+
+        video_str = target_plan.get_video_str(options.ffmpeg_preset,
+                                              filtered = True)
+        if options.double_pass:
+            passlog_str = (" -passlogfile %s-%d" %
+                           (_MULTI_PASSLOG_PREFIX, idx))
+            first_pass_strs.append(" -map [v%d] -an -pass 1%s%s" %
+                                   (idx, passlog_str, video_str) +
+                                   " -f rawvideo /dev/null")
+            pass_str = " -pass 2" + passlog_str
+        else:
+            pass_str = ""
+        audio_codec_str = target_plan.get_audio_str()
+        output_strs.append(" -map [v%d] -map 0:a:0%s%s%s \"%s\"" %
+                           (idx, pass_str, video_str, audio_codec_str,
+                            output_path))
+
+    filter_str = " -filter_complex \"" + _build_filter_graph(branches) + "\""
+    ffmpeg_prefix = ("ffmpeg -y" + offset_str + length_str + input_file_str +
+                     filter_str)
+
+    if options.double_pass:
+        _run_ffmpeg(ffmpeg_prefix + "".join(first_pass_strs), single_file,
+                    input_files, temp_dir,
+                    _pass_monitor(reporter, "video pass 1", out_duration),
+                    options.stage_timeout)
+    _run_ffmpeg(ffmpeg_prefix + "".join(output_strs), single_file,
+                input_files, temp_dir,
+                _pass_monitor(reporter, "final pass", out_duration),
+                options.stage_timeout)
+
+def _transcode_segmented(options, input_file, output_path, video_str,
+                         encode_audio, audio_file, job_dir, reporter):
+    """
+    Splits the encode into keyframe aligned time segments that are encoded in
+    parallel with identical settings and then concatenated without
+    re-encoding. The audio is encoded into audio_file by encode_audio()
+    alongside the segments. Segments finished by an earlier run of the job
+    are kept.
+    """
+    temp_dir = job_dir.path
+    (keyframes, duration) = segment.find_keyframes(
+        input_file, options.stage_timeout or segment.DEFAULT_PROBE_TIMEOUT)
+
+    start = float(options.start_offset or 0)
+    if options.duration:
+        end = min(duration, start + options.duration)
+    else:
+        end = duration
+    segments = segment.plan_segments(keyframes, start, end,
+                                     options.segment_count)
+    print "Encoding %d segments" % len(segments)
+
+    segment_pipeline = pipeline.Pipeline(options.segment_jobs, None,
+                                         options.stage_timeout)
+    mux_deps = [_add_stage(segment_pipeline, job_dir, "audio", encode_audio)]
+    segment_files = []
+    for (idx, (seg_start, seg_duration)) in enumerate(segments):
+        segment_file = segment.SEGMENT_FILE_FORMAT % idx
+        segment_files.append(segment_file)
+
+        # Leave the last segment open ended unless a length was requested so
+        # that the final frame isn't cut off
+        if idx < len(segments) - 1 or options.duration:
+            seg_length_str = " -t %.6f" % seg_duration
+        else:
+            seg_length_str = ""
+        ffmpeg_cmdline = ("ffmpeg -y -ss %.6f -i \"%s\"" %
+                          (seg_start, input_file) + seg_length_str +
+                          video_str + " -an")
+        if options.double_pass:
+            passlog_str = " -passlogfile " + os.path.splitext(segment_file)[0]
+            pass_name = "segment %d pass 1" % idx
+            first_pass = _add_stage(
+                segment_pipeline, job_dir, pass_name, functools.partial(
+                    _run_ffmpeg, ffmpeg_cmdline + " -pass 1" + passlog_str +
+                    " -f mpegts /dev/null", True, None, temp_dir,
+                    _pass_monitor(reporter, pass_name, seg_duration)))
+            pass_name = "segment %d pass 2" % idx
+            mux_deps.append(_add_stage(
+                segment_pipeline, job_dir, pass_name, functools.partial(
+                    _run_ffmpeg, ffmpeg_cmdline + " -pass 2" + passlog_str +
+                    " " + segment_file, True, None, temp_dir,
+                    _pass_monitor(reporter, pass_name, seg_duration)),
+                [first_pass]))
+        else:
+            pass_name = "segment %d" % idx
+            mux_deps.append(_add_stage(
+                segment_pipeline, job_dir, pass_name, functools.partial(
+                    _run_ffmpeg, ffmpeg_cmdline + " " + segment_file, True,
+                    None, temp_dir,
+                    _pass_monitor(reporter, pass_name, seg_duration))))
+
+    ffmpeg_cmdline = ("ffmpeg -y -f concat -i " + segment.CONCAT_LIST_FILE +
+                      " -i " + audio_file + " -map 0:v -map 1:a -c copy \"" +
+                      output_path + "\"")
+    segment.write_concat_list(os.path.join(temp_dir, segment.CONCAT_LIST_FILE),
+                              segment_files)
+    segment_pipeline.add_stage("mux", functools.partial(
+        _run_ffmpeg, ffmpeg_cmdline, True, None, temp_dir,
+        _pass_monitor(reporter, "mux", end - start)),
+        [dep for dep in mux_deps if dep is not None])
+    segment_pipeline.run()
+    print segment_pipeline
+
+    # Clean up intermediate files
+    for segment_file in glob.glob(os.path.join(temp_dir, "segment-*")):
+        os.remove(segment_file)
+    os.remove(os.path.join(temp_dir, segment.CONCAT_LIST_FILE))
+    os.remove(os.path.join(temp_dir, audio_file))
+
+def make_option_parser():
+    """Returns the option parser for mmfxcode command lines"""
     optparser = optparse.OptionParser()
     optparser.add_option(
-        "-o", "--output", action="store", type="string",
-        dest="output_file", help="Output file name")
+        "-o", "--output", action="append", type="string",
+        dest="output_files", help="Output file name. With multiple targets, \
+give one per target or a single name to derive per-target names from")
     optparser.add_option(
-        "-t", "--target", action="store", type="string",
-        dest="target_string", help="Target device name")
+        "-t", "--target", action="append", type="string",
+        dest="target_strings", help="Target device name. May be given \
+multiple times to encode several targets from a single decode of the input")
+    optparser.add_option(
+        "-d", "--device-class", action="store", type="string",
+        dest="device_class", help="Instead of -t, pick the target of this \
+device class (e.g. phone, tablet, tv) that is cheapest to transcode the \
+input to")
     optparser.add_option(
         "-l", "--length", type="int", dest="duration",
         help="Number of seconds to encode (defaults to whole file)")
@@ -48,62 +502,335 @@ def main(argv = sys.argv):
     optparser.add_option(
         "-p", "--preset", action="store", type="string", dest="ffmpeg_preset",
         help="FFMpeg preset to use for encoding")
+    optparser.add_option(
+        "--crf", type="int", dest="crf",
+        help="Analyze the input with short constant quality encodes at this \
+x264 CRF (e.g. 23) and lower the video bitrate to what that quality needs, \
+capped at the target maximum")
+    optparser.add_option(
+        "--deadline", action="store", type="string", dest="deadline",
+        help="Instead of -p, pick the slowest x264 preset that finishes the \
+encode within this time, given in seconds or with an s, m or h suffix, from \
+short calibration encodes of the input")
     optparser.add_option(
         "-n", "--use-neroaac", action = "store_true", dest="use_neroaac",
         help="Use neroAacEnc instead of ffmpeg for audio encoding")
+    optparser.add_option(
+        "--audio-pipe", action = "store_true", dest="audio_pipe",
+        help="Stream the neroAacEnc output into the final pass through a \
+named pipe instead of a temporary file")
+    optparser.add_option(
+        "--temp-dir", action="store", type="string", dest="temp_dir",
+        default=os.getenv(TEMP_DIR_ENV_VAR),
+        help="Directory for the working directory with intermediate files, \
+e.g. on tmpfs or a fast scratch disk (default $%s or the system temporary \
+directory)" % TEMP_DIR_ENV_VAR)
     optparser.add_option(
         "-v", "--video-bitrate", action = "store", type="string", dest="video_bitrate",
         help="Override video bitrate information from input file")
-    (options, extra_args) = optparser.parse_args()
-    
-    if options.output_file is None:
-        print "No output file specified, exiting."
-        sys.exit(1)
+    optparser.add_option(
+        "--probe-jobs", type="int", dest="probe_jobs",
+        default=multifile.DEFAULT_PROBE_JOBS,
+        help="Number of input files to probe concurrently in multiple file \
+mode (default %default)")
+    optparser.add_option(
+        "--fail-fast", action = "store_true", dest="fail_fast",
+        help="Don't wait for running probes of input files once an \
+incompatible one is found")
+    optparser.add_option(
+        "--chunk-size", type="int", dest="chunk_size",
+        default=multifile.DEFAULT_CHUNK_SIZE / 1024,
+        help="Size in KB of each transfer when streaming multiple input \
+files to ffmpeg (default %default)")
+    optparser.add_option(
+        "--no-zero-copy", action = "store_false", dest="zero_copy",
+        default=True,
+        help="Stream multiple input files through a user space buffer \
+instead of splice()/sendfile()")
+    optparser.add_option(
+        "--concat-mode", type="choice", dest="concat_mode",
+        choices=[CONCAT_PIPE, CONCAT_LIST, CONCAT_FILE], default=CONCAT_PIPE,
+        help="How multiple input files are fed to ffmpeg: '" + CONCAT_PIPE +
+        "' streams them to ffmpeg on every pass, '" + CONCAT_LIST + "' has \
+ffmpeg's concat demuxer read them directly and '" + CONCAT_FILE + "' \
+concatenates them once into the working directory (default %default)")
+    optparser.add_option(
+        "--segments", type="int", dest="segment_count",
+        help="Split the encode into this many keyframe aligned time segments \
+that are encoded in parallel and joined without re-encoding")
+    optparser.add_option(
+        "--segment-jobs", type="int", dest="segment_jobs",
+        default=multiprocessing.cpu_count(),
+        help="Number of segments to encode concurrently (default %default)")
+    optparser.add_option(
+        "--no-passthrough", action = "store_false", dest="passthrough",
+        default=True,
+        help="Always re-encode, even if the input video or audio stream \
+already satisfies the target and could be copied as is")
+    optparser.add_option(
+        "--progress", action="store", type="string", dest="progress_dest",
+        help="Write per-pass encode progress (fps, speed, bitrate, frames, \
+ETA) as JSON lines to this file, or to a socket given as tcp:host:port or \
+unix:path")
+    optparser.add_option(
+        "--resume", action = "store_true", dest="resume",
+        help="Continue an interrupted run of the same command from its last \
+checkpoint instead of starting over: finished audio encodes, first passes \
+and segments are kept in the working directory")
+    optparser.add_option(
+        "--stage-timeout", action="store", type="float",
+        dest="stage_timeout",
+        help="Abort the job if an encoding stage (a pass, the audio encode \
+or a segment) runs longer than this many seconds")
+    optparser.add_option(
+        "--job-name", action="store", type="string", dest="job_name",
+        help="Job name for progress records (defaults to the output file \
+name)")
+    optparser.add_option(
+        "--plan-only", action = "store_true", dest="plan_only",
+        help="Don't encode anything, print the encoding plan of every input \
+file (directories are searched recursively) for every target as JSON")
+    optparser.add_option(
+        "--no-pass-cache", action = "store_false", dest="pass_cache",
+        default=True,
+        help="Always run the first pass of --double-pass instead of reusing \
+cached statistics from an earlier encode of the same input")
+    return optparser
+
+def get_output_list(options, work_dir = ""):
+    """
+    Returns the absolute output path for each target in parsed options, with
+    relative paths taken relative to work_dir (defaults to the current
+    directory)
+    """
+    # A device class stands for the single target picked for it
+    target_strings = options.target_strings or [options.device_class]
+    if options.output_files is None or target_strings == [None]:
+        raise errors.MMFError("No output file specified, exiting.")
+    elif len(options.output_files) == len(target_strings):
+        return [os.path.abspath(os.path.join(work_dir, output_file))
+                for output_file in options.output_files]
+    elif len(options.output_files) == 1:
+        return [_target_output_path(os.path.abspath(
+                    os.path.join(work_dir, options.output_files[0])),
+                                    target_string)
+                for target_string in target_strings]
     else:
-        output_path = os.path.abspath(options.output_file)
+        raise errors.MMFError(
+            "Specify either one output file or one per target, exiting.")
+
+def main(argv = sys.argv):
+    start_time = time.time()
+    optparser = make_option_parser()
+    (options, extra_args) = optparser.parse_args(argv[1:])
+    signal.signal(signal.SIGTERM, _handle_sigterm)
     
-    if options.target_string is None:
+    if options.target_strings is None and options.device_class is None:
         print "No target specified, exiting."
         sys.exit(1)
+    elif options.target_strings is not None and options.device_class:
+        print "Specify either targets or a device class, exiting."
+        sys.exit(1)
+
+    if options.plan_only:
+        if len(extra_args) == 0:
+            print "No input file specified, exiting."
+            sys.exit(1)
+        try:
+            if options.device_class is not None:
+                target_list = catalog.get_default_catalog().get_targets(
+                    options.device_class)
+            else:
+                target_list = [targetconfig.TargetConfig(target_string)
+                               for target_string in options.target_strings]
+        except errors.MMFError as e:
+            print e.msg
+            sys.exit(1)
+        plan_list = plan.plan_library(extra_args, target_list,
+                                      options.video_bitrate,
+                                      options.start_offset,
+                                      options.passthrough,
+                                      probecache.get_default_cache())
+        print json.dumps(plan_list, indent = 2)
+        return
+
+    try:
+        output_list = get_output_list(options)
+    except errors.MMFError as e:
+        print e.msg
+        sys.exit(1)
+    output_path = output_list[0]
+    multi_target = len(output_list) > 1
     
+    if multi_target and options.use_neroaac:
+        print "Multiple targets are not compatible with --use-neroaac."
+        sys.exit(1)
+
+    if multi_target and options.segment_count:
+        print "Multiple targets are not compatible with --segments."
+        sys.exit(1)
+
+    if options.audio_pipe:
+        if not options.use_neroaac:
+            print "--audio-pipe needs --use-neroaac."
+            sys.exit(1)
+        if options.segment_count:
+            print "--audio-pipe is not compatible with --segments."
+            sys.exit(1)
+
+    if options.crf is not None:
+        if multi_target:
+            print "Multiple targets are not compatible with --crf."
+            sys.exit(1)
+        if options.video_bitrate is not None:
+            print "Specify either a video bitrate or --crf, exiting."
+            sys.exit(1)
+
+    if options.deadline is not None:
+        if multi_target:
+            print "Multiple targets are not compatible with --deadline."
+            sys.exit(1)
+        if options.ffmpeg_preset is not None:
+            print "Specify either a preset or a deadline, exiting."
+            sys.exit(1)
+        if options.crf is not None:
+            # The CRF bitrate depends on the preset, which the deadline
+            # calibration picks last with the time left
+            print "--crf is not compatible with --deadline."
+            sys.exit(1)
+        try:
+            deadline = calibrate.parse_deadline(options.deadline)
+        except errors.MMFError as e:
+            print e.msg
+            sys.exit(1)
+    
+    probe_cache = probecache.get_default_cache()
+
     if len(extra_args) == 0:
         print "No input file specified, exiting."
         sys.exit(1)
     elif len(extra_args) == 1:
         single_file = True
+        input_files = None
         input_file = os.path.abspath(extra_args[0])
         input_file_str = " -i \"" + input_file + "\""
     else:
-        if options.duration or options.start_offset:
+        if ((options.duration or options.start_offset) and
+            options.concat_mode == CONCAT_PIPE):
             print "Multiple file mode is not compatible with --length or \
---offset."
+--offset unless --concat-mode is '%s' or '%s'." % (CONCAT_LIST, CONCAT_FILE)
+            sys.exit(1)
+        if options.segment_count and options.concat_mode != CONCAT_FILE:
+            print "Multiple file mode is not compatible with --segments \
+unless --concat-mode is '%s'." % CONCAT_FILE
             sys.exit(1)
         single_file = False
         try:
-            input_files = multifile.MultiFileInput(extra_args)
+            input_files = multifile.MultiFileInput(extra_args, probe_cache,
+                                                   options.probe_jobs,
+                                                   options.fail_fast,
+                                                   options.chunk_size * 1024,
+                                                   options.zero_copy)
         except errors.MMFError as e:
             print e.msg
             sys.exit(1) 
         input_file_str = " -i -"
     
+    if single_file:
+        source_files = [input_file]
+    else:
+        source_files = input_files.get_file_list()
+    
     try:
         if single_file:
-            vid_info = vidparse.VidParser(extra_args[0])
+            vid_info = vidparse.VidParser(extra_args[0], probe_cache)
         else:
             vid_info = input_files.parser
     except errors.MMFError as e:
         print e.msg
         sys.exit(1)
 
+    target_list = []
+    if options.device_class is not None:
+        try:
+            ranked_list = catalog.rank_device_class(
+                vid_info, catalog.get_default_catalog(), options.device_class,
+                options.video_bitrate, options.start_offset,
+                options.passthrough)
+        except errors.MMFError as e:
+            print e.msg
+            sys.exit(1)
+        print "Targets for device class '%s' by predicted cost:" % \
+            options.device_class
+        for ranked in ranked_list:
+            print "\t" + str(ranked)
+        target_list.append(ranked_list[0].target_config)
+        print "Selected target: " + ranked_list[0].target_config.target_name
+    for target_string in options.target_strings or []:
+        try:
+            target_list.append(targetconfig.TargetConfig(target_string))
+        except errors.MMFError as e:
+            print e.msg
+            sys.exit(1)
+    target_config = target_list[0]
+
+    if any(cur_config.max_output_duration for cur_config in target_list):
+        if multi_target:
+            print "Multiple targets are not compatible with segmented output \
+(MAX_OUTPUT_DURATION)."
+            sys.exit(1)
+        if options.segment_count:
+            print "--segments is not compatible with segmented output \
+(MAX_OUTPUT_DURATION)."
+            sys.exit(1)
+        try:
+            segment_writer = streamout.SegmentWriter(
+                output_path, target_config.max_output_duration)
+        except errors.MMFError as e:
+            print e.msg
+            sys.exit(1)
+    else:
+        segment_writer = None
+    
+    # The working directory is named after the job so that --resume finds
+    # the checkpoints of an earlier run, and kept when the job fails
+    stale_count = checkpoint.clean_stale(options.temp_dir)
+    if stale_count > 0:
+        print "Removed %d stale working directories" % stale_count
+    job_key = checkpoint.make_job_key(
+        [arg for arg in argv[1:] if arg != "--resume"], source_files)
     try:
-        target_config = targetconfig.TargetConfig(options.target_string)
+        job_dir = checkpoint.JobDir(options.temp_dir, job_key, options.resume)
     except errors.MMFError as e:
         print e.msg
-        sys.exit(1) 
-    
-    temp_dir = tempfile.mkdtemp()
+        sys.exit(1)
+    temp_dir = job_dir.path
     print "Working directory: " + temp_dir
-    os.chdir(temp_dir)
+    if job_dir.discarded:
+        print "Discarded the files of an earlier run, use --resume to \
+continue from its checkpoints"
+    elif job_dir.has_checkpoints():
+        print "Resuming from the checkpoints of an earlier run"
+
+    if single_file:
+        input_readers = []
+    else:
+        input_readers = [input_files]
+    if not single_file and options.concat_mode != CONCAT_PIPE:
+        # Every pass reads the same concatenated input, so from here on this
+        # works just like a single input file
+        try:
+            input_file = _prepare_concat_input(
+                options.concat_mode, input_files, temp_dir,
+                job_dir.is_done(_CONCAT_INPUT_STAGE))
+        except errors.MMFError as e:
+            _fail_job(job_dir, e.msg)
+        job_dir.record(_CONCAT_INPUT_STAGE)
+        if options.concat_mode == CONCAT_LIST:
+            input_file_str = " -f concat -safe 0 -i \"" + input_file + "\""
+        else:
+            input_file_str = " -i \"" + input_file + "\""
+        single_file = True
     
     # Prepare duration strings
     if not options.duration:
@@ -116,265 +843,276 @@ def main(argv = sys.argv):
     else:
         offset_str = " -ss " + str(options.start_offset)
     
-    # Audio parameter calculation
-    if vid_info.audio_bitrate is None:
-        print (("WARNING: No audio bitrate information for %s using %d Kbps") % 
-               (vid_info.input_file_name, target_config.audio_max_bitrate))
-        audio_bitrate = target_config.audio_max_bitrate
+    # Progress output, with the expected output duration for ETAs
+    if options.progress_dest:
+        try:
+            reporter = progress.ProgressReporter(
+                options.progress_dest,
+                options.job_name or os.path.basename(output_path))
+        except errors.MMFError as e:
+            _fail_job(job_dir, e.msg)
     else:
-        audio_bitrate = min(vid_info.audio_bitrate,
-                            target_config.audio_max_bitrate)
-    if audio_bitrate < target_config.audio_max_bitrate:
-        # Round up bitrate to a standard step unless it is > 320 in which
-        # case just keep it
-        audio_bitrate_steps = [320, 256, 192, 160, 128, 112, 96, 64, 0]
-        prev_rate = audio_bitrate
-        for rate in audio_bitrate_steps:
-            if audio_bitrate > rate:
-                audio_bitrate = prev_rate
-                break
-            prev_rate = rate
-    audio_bitrate = audio_bitrate * 1000
+        reporter = None
+    if input_files is not None:
+        out_duration = input_files.duration
+    else:
+        out_duration = vid_info.duration
+    if out_duration is not None and options.start_offset:
+        out_duration = max(0, out_duration - options.start_offset)
+    if options.duration:
+        out_duration = min(out_duration or options.duration,
+                           options.duration)
     
-    if options.use_neroaac:
-        # Audio encode with neroAacEnc using ffmpeg to convert input to pcm
-        ffmpeg_cmdline = ("ffmpeg -v 0 -y" + offset_str + length_str +
-                          input_file_str + " -vn -acodec pcm_s16le -ac " +
-                          str(target_config.audio_channel_count) + " -ar " + 
-                          str(target_config.audio_sample_rate) +
-                          " -f wav pipe:1")
-        print ffmpeg_cmdline
-        ffmpeg_args = shlex.split(ffmpeg_cmdline)
-        null_device = open(os.devnull, 'w')
-        if single_file:
-            ffmpeg = subprocess.Popen(ffmpeg_args, stdout = subprocess.PIPE,
-                                      stderr = null_device)
-        else:
-            ffmpeg = subprocess.Popen(ffmpeg_args, stdin = subprocess.PIPE, 
-                                      stdout = subprocess.PIPE,
-                                      stderr = null_device)
-        
+    if multi_target:
         try:
-            neroaac_dir = os.environ['NEROAAC_DIR']
-        except KeyError:
-            neroaac_dir = ""
-        neroaac_path = os.path.join(neroaac_dir, "neroAacEnc")
-        neroaac_cmdline = (neroaac_path + " -cbr " + str(audio_bitrate) +
-                           " -lc -ignorelength -if - -of output-audio.aac")
-        print neroaac_cmdline
-        neroaac_args = shlex.split(neroaac_cmdline)
-        neroaac = subprocess.Popen(neroaac_args, stdin = ffmpeg.stdout)
-    
-        if single_file:
-            while ffmpeg.returncode is not None:
-                buf = ffmpeg.communicate()
-                neroaac.communicate(buf)
-            neroaac.wait()
+            _transcode_multi_target(options, vid_info, target_list,
+                                    output_list, single_file, input_files,
+                                    input_file_str, offset_str, length_str,
+                                    temp_dir, reporter, out_duration)
+        except errors.MMFError as e:
+            _fail_job(job_dir, e.msg)
+        except KeyboardInterrupt:
+            _fail_job(job_dir, "Interrupted")
+
+        # Clean up intermediate files
+        for passlog_file in glob.glob(os.path.join(
+                temp_dir, _MULTI_PASSLOG_PREFIX + "-*")):
+            os.remove(passlog_file)
+        _remove_concat_input(temp_dir)
+        job_dir.remove()
+        _print_bytes_read(input_readers)
+        return
+
+    try:
+        target_plan = plan.plan_transcode(vid_info, target_config,
+                                          options.video_bitrate,
+                                          options.start_offset,
+                                          options.passthrough)
+    except errors.MMFError as e:
+        _fail_job(job_dir, e.msg)
+    for warning in target_plan.warnings:
+        print "WARNING: " + warning
+    copy_video = target_plan.copy_video
+    copy_audio = target_plan.copy_audio
+    if copy_video:
+        print "Input video satisfies target, copying video stream"
+    if copy_audio:
+        print "Input audio satisfies target, copying audio stream"
+    audio_codec_str = target_plan.get_audio_str()
+
+    # Sample encodes read the part of the input that gets encoded
+    if len(source_files) == 1:
+        sample_range = (options.start_offset or 0, out_duration)
+    else:
+        # Concatenated inputs match, so the first one stands for all
+        sample_range = (0, vid_info.duration)
+
+    # Calibration results are checkpointed, a resumed job has to finish with
+    # the settings its finished stages were encoded with
+    if options.crf is not None and not copy_video:
+        needed_bitrate = job_dir.get_value("crf bitrate")
+        if needed_bitrate is None:
+            try:
+                analysis = calibrate.ComplexityAnalysis(
+                    source_files[0], target_plan, options.crf, sample_range,
+                    temp_dir)
+                needed_bitrate = analysis.run(options.ffmpeg_preset)
+            except errors.MMFError as e:
+                _fail_job(job_dir, e.msg)
+            except KeyboardInterrupt:
+                _fail_job(job_dir, "Interrupted")
+            print analysis
+            job_dir.set_value("crf bitrate", needed_bitrate)
+        if needed_bitrate < target_plan.video_bitrate:
+            print "Lowering video bitrate from %d to %d Kbps" % (
+                target_plan.video_bitrate, needed_bitrate)
+            target_plan.video_bitrate = needed_bitrate
+
+    if options.deadline is not None and not copy_video:
+        if options.double_pass:
+            pass_count = 2
         else:
-            input_files.set_output(ffmpeg.stdin)
+            pass_count = 1
+        options.ffmpeg_preset = job_dir.get_value("deadline preset")
+        if options.ffmpeg_preset is None:
             try:
-                input_files.write_all()
-            except IOError as e:
-                print "FFMpeg was killed or input files not \
-compatible with concatenation"
-                print e
-                sys.exit(1)
-        
-            # Flush ffmpeg's stdout and kill it, couldn't find any other way
-            # of making neroaac drain ffmpeg's stdout without hanging
-            ffmpeg.stdout.flush()
-            ffmpeg.kill()
-            neroaac.wait()
-    
-            input_files.rewind()
-        
-        null_device.close()
-        
-    # Video parameter calculations
-    if target_config.codec_h264_same:
-        # use same profile/level as input
-        if vid_info.vid_format_profile is None:
-            print vid_info
-            print "Same H.264 profile/level as input requested, but no info\
-found in input file."
-            sys.exit(1)
-        partition = vid_info.vid_format_profile.partition('@')
-        h264_profile_str = partition[0].lower()
-        h264_level_str = partition[2].replace('.','').replace('L','')        
-    else:
-        # use target preset for profile/level
-        h264_level_str = target_config.codec_h264_level.replace('.', '')
-        h264_profile_str = target_config.codec_h264_profile.lower()
-    
-    if options.video_bitrate is not None:
-        video_max_bitrate = min(target_config.video_max_bitrate,
-                                int(options.video_bitrate))
-    elif vid_info.vid_bitrate is not None:
-        video_max_bitrate = min(target_config.video_max_bitrate,
-                                vid_info.vid_bitrate)
-    else: 
-        print ("No video bitrate information for '%s' use -v [bitrate]" %
-               vid_info.input_file_name)
-        sys.exit(1)
+                calibration = calibrate.PresetCalibration(
+                    source_files[0], target_plan, vid_info.vid_fps,
+                    out_duration, start_time + deadline, pass_count,
+                    temp_dir, sample_range)
+                options.ffmpeg_preset = calibration.run()
+            except errors.MMFError as e:
+                _fail_job(job_dir, e.msg)
+            except KeyboardInterrupt:
+                _fail_job(job_dir, "Interrupted")
+            print calibration
+            job_dir.set_value("deadline preset", options.ffmpeg_preset)
+        else:
+            print "Using preset '%s' calibrated by an earlier run" % \
+                options.ffmpeg_preset
 
-    if vid_info.vid_width is None or vid_info.vid_height is None:
-        print ("No video width/height information for '%s'" %
-               vid_info.input_file_name)
-        sys.exit(1)
-    
-    if vid_info.vid_width > target_config.video_max_width:
-        # Scale down width and see if height is within maximum allowed
-        scale_factor = (float(target_config.video_max_width) /
-                        vid_info.vid_width)
-        scaled_height = int(float(vid_info.vid_height) * scale_factor)
-        if scaled_height % 2 == 1: # make sure scaled height divisible by 2
-            scaled_height += 1
-        if scaled_height < target_config.video_max_height:
-            vid_size_str = (" -s " + str(target_config.video_max_width) +
-                            "x" + str(scaled_height))
-            bit_rate = _calc_scaled_bitrate(target_config,
-                                            video_max_bitrate,
-                                            target_config.video_max_width,
-                                            scaled_height)
+    audio_fifo = None
+    if options.use_neroaac and not copy_audio:
+        # neroAacEnc audio encode, runs alongside the video first pass so
+        # only the final muxing pass waits on it. Through a named pipe it
+        # runs alongside the final pass instead.
+        if single_file:
+            audio_input_files = None
         else:
-            # Failed, have to break aspect ratio
-            vid_size_str = (" -s " + str(target_config.video_max_width) +
-                            "x" + str(target_config.video_max_height))
-            bit_rate = video_max_bitrate
-    elif vid_info.vid_height > target_config.video_max_height:
-        # Scale down height and see if width is within maximum allowed
-        scale_factor = (float(target_config.video_max_height) /
-                        vid_info.vid_height)
-        scaled_width = int(float(vid_info.vid_width) * scale_factor)
-        if scaled_width % 2 == 1: # make sure scaled width divisible by 2
-            scaled_width += 1
-        if scaled_width < target_config.video_max_width:
-            vid_size_str = (" -s " + str(scaled_width) + "x" +
-                            str(target_config.video_max_height))
-            bit_rate = _calc_scaled_bitrate(target_config,
-                                            video_max_bitrate,
-                                            scaled_width,
-                                            target_config.video_max_height)
+            audio_input_files = input_files.clone()
+            input_readers.append(audio_input_files)
+        if options.audio_pipe:
+            audio_file = _NEROAAC_AUDIO_FIFO
+            audio_fifo = os.path.join(temp_dir, audio_file)
+            if os.path.exists(audio_fifo):
+                # Left behind by an interrupted run
+                os.remove(audio_fifo)
+            os.mkfifo(audio_fifo)
         else:
-            # Failed, have to break aspect ratio
-            vid_size_str = (" -s " + str(target_config.video_max_width) + "x" +
-                            str(target_config.video_max_height))
-            bit_rate = video_max_bitrate
-    else:
-        # Video is smaller than target's max width/height, use max bitrate
-        vid_size_str = ""
-        bit_rate = video_max_bitrate
-    vid_bitrate_str = " -b:v " + str(bit_rate * 1000)
-    
-    if options.ffmpeg_preset:
-        preset_str = " -preset " + options.ffmpeg_preset
+            audio_file = _NEROAAC_AUDIO_FILE
+        encode_audio = functools.partial(_encode_audio_neroaac, offset_str,
+                                         length_str, input_file_str,
+                                         single_file, audio_input_files,
+                                         target_config,
+                                         target_plan.audio_bitrate, temp_dir,
+                                         audio_file)
+    elif options.segment_count and not copy_video:
+        # Separate ffmpeg audio encode running alongside the segments
+        audio_file = _SEGMENT_AUDIO_FILE
+        encode_audio = functools.partial(
+            _run_ffmpeg, "ffmpeg -y" + offset_str + length_str +
+            input_file_str + " -vn" + audio_codec_str + " " + audio_file,
+            True, None, temp_dir,
+            _pass_monitor(reporter, "audio", out_duration))
     else:
-        preset_str = ""
+        # Audio gets encoded (or copied) by the final pass
+        audio_file = None
+        encode_audio = None
+
+    video_str = target_plan.get_video_str(options.ffmpeg_preset)
+
+    if options.segment_count and not copy_video:
+        try:
+            _transcode_segmented(options, input_file, output_path, video_str,
+                                 encode_audio, audio_file, job_dir,
+                                 reporter)
+        except errors.MMFError as e:
+            _fail_job(job_dir, e.msg)
+        except KeyboardInterrupt:
+            _fail_job(job_dir, "Interrupted")
+        _remove_concat_input(temp_dir)
+        job_dir.remove()
+        _print_bytes_read(input_readers)
+        return
+
+    transcode_pipeline = pipeline.Pipeline(None, None, options.stage_timeout)
+    final_deps = []
+    if encode_audio is not None and audio_fifo is None:
+        final_deps.append(_add_stage(transcode_pipeline, job_dir, "audio",
+                                     encode_audio))
     
-    # Interlace handling
-    if vid_info.vid_interlaced:
-        if target_config.video_interlaced:
-            int_str = " -flags +ildct"
+    double_pass = options.double_pass and not copy_video
+    if double_pass:
+        # The first pass statistics don't depend on the bit rate, so they
+        # can be reused by later encodes with the same analysis settings
+        if options.pass_cache:
+            pass_cache = passcache.get_default_cache()
         else:
-            int_str = " -vf yadif=1"
-
-        if vid_info.vid_fps is None:
-            fps_str = ""  
-        elif vid_info.vid_fps == 23.976:
-            fps_str = " -r 24000/1001"
-        elif vid_info.vid_fps == 29.970:
-            fps_str = " -r 30000/1001"
+            pass_cache = None
+        if pass_cache is not None:
+            pass_key = passcache.make_key(source_files,
+                                          [offset_str, length_str,
+                                           target_plan.size,
+                                           target_plan.h264_level,
+                                           target_plan.h264_profile,
+                                           options.ffmpeg_preset,
+                                           target_plan.deinterlace,
+                                           target_plan.ildct,
+                                           target_plan.fps,
+                                           target_config.max_output_duration])
         else:
-            fps_str = " -r " + str(vid_info.vid_fps)
-    else:
-        if target_config.video_interlaced:
-            print "WARNING: Interlaced output for progressive input \
-not supported!"
-        int_str = ""
-        fps_str = ""
-    
-    if options.double_pass:
-        # Video first pass
-        ffmpeg_cmdline = ("ffmpeg -y" + offset_str + length_str +
-                          input_file_str + vid_size_str +
-                          " -pass 1 -vcodec libx264" + " -threads 0 -level " +
-                          h264_level_str + preset_str + " -vprofile " +
-                          h264_profile_str + vid_bitrate_str + int_str +
-                          fps_str + " -acodec copy -f rawvideo /dev/null")
-        print ffmpeg_cmdline
-        ffmpeg_args = shlex.split(ffmpeg_cmdline)
-        if single_file:
-            ffmpeg = subprocess.Popen(ffmpeg_args)
+            pass_key = None
+
+        if job_dir.is_done("video pass 1"):
+            print "Skipping video pass 1, finished in an earlier run"
+        elif pass_cache is not None and pass_cache.lookup(pass_key,
+                                                          temp_dir):
+            print "Reusing cached first pass statistics"
         else:
-            ffmpeg = subprocess.Popen(ffmpeg_args, stdin = subprocess.PIPE)
-            input_files.set_output(ffmpeg.stdin)
-            try:
-                input_files.write_all()
-            except IOError as e:
-                print "FFMpeg was killed or input files not \
-compatible with concatenation"
-                print e
-                sys.exit(1)
-    
-        ffmpeg.wait()
-        
-        if not single_file:
-            input_files.rewind()
+            # Video first pass
+            if segment_writer is not None:
+                keyframe_str = segment_writer.get_keyframe_str()
+            else:
+                keyframe_str = ""
+            ffmpeg_cmdline = ("ffmpeg -y" + offset_str + length_str +
+                              input_file_str + " -pass 1" + video_str +
+                              keyframe_str +
+                              " -acodec copy -f rawvideo /dev/null")
+            final_deps.append(_add_stage(
+                transcode_pipeline, job_dir, "video pass 1",
+                functools.partial(
+                    _run_first_pass, ffmpeg_cmdline, single_file,
+                    input_files, temp_dir,
+                    _pass_monitor(reporter, "video pass 1", out_duration),
+                    pass_cache, pass_key)))
         pass_str = " -pass 2"
     else:
         pass_str = ""
     
     # Video second (or first) pass + muxer step (+ audio encode if not using
     # neroAac)
-    if options.use_neroaac:
-        # Stream mapping calculation
-        if (vid_info.audio_stream_id is None or
-            vid_info.vid_stream_id is None):
-            stream_map_str = ""
-        if vid_info.audio_stream_id > vid_info.vid_stream_id:
-            stream_map_str = " -map 0:0 -map 1:0"
+    if audio_file is not None:
+        stream_map_str = target_plan.get_stream_map_str()
+        if audio_fifo is not None:
+            # Nothing to probe the format from until the audio encode runs
+            audio_input_str = " -f aac -i " + audio_file
         else:
-            stream_map_str = " -map 0:1 -map 1:0"
-    
-        audio_input_str = " -i output-audio.aac"
+            audio_input_str = " -i " + audio_file
         audio_codec_str = " -acodec copy"
     else:
         stream_map_str = ""
         audio_input_str = ""
-        audio_codec_str = (" -acodec libvo_aacenc -ac " +
-                           str(target_config.audio_channel_count) + " -ar " +
-                           str(target_config.audio_sample_rate) + " -ab " +
-                           str(audio_bitrate))
     
+    if segment_writer is not None:
+        output_str = segment_writer.get_output_str(not copy_video)
+    else:
+        output_str = " \"" + output_path + "\""
     ffmpeg_cmdline = ("ffmpeg -y" + offset_str + length_str + input_file_str +
-                      audio_input_str + stream_map_str + vid_size_str +
-                      pass_str + " -vcodec libx264 -threads 0 -level " +
-                      h264_level_str + preset_str +" -vprofile " +
-                      h264_profile_str + vid_bitrate_str + int_str +
-                      fps_str + audio_codec_str + " \"" + output_path + "\"")
-    print ffmpeg_cmdline
-    ffmpeg_args = shlex.split(ffmpeg_cmdline)
-    
-    if single_file:
-        ffmpeg = subprocess.Popen(ffmpeg_args)
+                      audio_input_str + stream_map_str + pass_str +
+                      video_str + audio_codec_str + output_str)
+    final_monitor = _pass_monitor(reporter, "final pass", out_duration)
+    if segment_writer is not None:
+        final_pass = functools.partial(_run_final_pass_segmented,
+                                       ffmpeg_cmdline, single_file,
+                                       input_files, temp_dir, final_monitor,
+                                       segment_writer)
     else:
-        ffmpeg = subprocess.Popen(ffmpeg_args, stdin = subprocess.PIPE)
-        input_files.set_output(ffmpeg.stdin)
-        try:
-            input_files.write_all()
-        except IOError as e:
-            print "FFMpeg was killed or input files not \
-compatible with concatenation"
-            print e
-            sys.exit(1)
-    
-    ffmpeg.wait()
+        final_pass = functools.partial(_run_ffmpeg, ffmpeg_cmdline,
+                                       single_file, input_files, temp_dir,
+                                       final_monitor)
+    if audio_fifo is not None:
+        final_pass = functools.partial(_run_final_pass_fifo, final_pass,
+                                       encode_audio, audio_fifo)
+    transcode_pipeline.add_stage("final pass", final_pass,
+                                 [dep for dep in final_deps
+                                  if dep is not None])
+
+    try:
+        transcode_pipeline.run()
+    except errors.MMFError as e:
+        _fail_job(job_dir, e.msg)
+    except KeyboardInterrupt:
+        _fail_job(job_dir, "Interrupted")
+    print transcode_pipeline
+    if segment_writer is not None:
+        print segment_writer
     
     # Clean up intermediate files
-    if options.use_neroaac:
-        os.remove(os.path.join(temp_dir, "output-audio.aac"))
-    if options.double_pass:
-        os.remove(os.path.join(temp_dir, "ffmpeg2pass-0.log"))
-        os.remove(os.path.join(temp_dir, "x264_2pass.log.mbtree"))
-        os.remove(os.path.join(temp_dir, "x264_2pass.log"))
-    os.rmdir(temp_dir)
+    if audio_file is not None:
+        os.remove(os.path.join(temp_dir, audio_file))
+    if double_pass:
+        for log_file in passcache.PASS_LOG_FILES:
+            os.remove(os.path.join(temp_dir, log_file))
+    _remove_concat_input(temp_dir)
+    job_dir.remove()
+    _print_bytes_read(input_readers)
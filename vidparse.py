@@ -12,11 +12,12 @@
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 # GNU General Public License for more details.
 
+import json
 import os.path
 import re
-import subprocess
 
 from mmf import errors
+from mmf import procgraph
 
 VIDEO_CODEC_H264 = "H.264"
 VIDEO_CODEC_WMV3 = "WMV3"
@@ -25,6 +26,29 @@ VIDEO_CODEC_MPEG12 = "MPEG 1/2"
 VIDEO_CODEC_VC1 = "VC-1"
 VIDEO_CODEC_XVID = "XVID"
 
+# Bump whenever the meaning of a parsed field changes so that stale probe
+# cache entries are ignored
+PROBE_VERSION = 5
+
+# Maximum number of files handed to a single mediainfo run by probe_batch()
+_BATCH_SIZE = 64
+
+# File extensions of the containers looked for when searching directories
+MEDIA_EXTENSIONS = [".avi", ".divx", ".flv", ".m2ts", ".m4v", ".mkv", ".mov",
+                    ".mp4", ".mpeg", ".mpg", ".mts", ".ogm", ".ts", ".vob",
+                    ".webm", ".wmv"]
+
+# Seconds per file before a hung mediainfo (e.g. on a stale network mount)
+# is killed
+_PROBE_TIMEOUT = 60.0
+
+# Attributes that make up the result of a probe, in get_fields() order
+PARSED_FIELDS = ["vid_stream_id", "vid_format_profile", "vid_interlaced",
+                  "vid_width", "vid_height", "vid_bitrate", "vid_fps",
+                  "_vid_codec_id", "_vid_format", "audio_stream_id",
+                  "audio_format", "audio_codec_id", "audio_channels",
+                  "audio_bitrate", "audio_samplerate", "duration"]
+
 def _get_field_value(line_str):
     splitter = re.compile(r'[:]+')
     line_tokenized = splitter.split(line_str)
@@ -49,13 +73,220 @@ def _float_to_str_trunc(float_val):
     return str(round(float_val, 0))[:-2]
 
 def _bit_rate_convert(bit_rate_tokenized):
+    # mediainfo uses decimal units, 1 Mbps is 1000 Kbps
     if bit_rate_tokenized[1] == "Kbps":
         return _float_to_str_trunc(float(bit_rate_tokenized[0]))
     elif bit_rate_tokenized[1] == "Mbps":
-        return _float_to_str_trunc(float(bit_rate_tokenized[0]) * 1024)
+        return _float_to_str_trunc(float(bit_rate_tokenized[0]) * 1000)
     else:
         raise errors.MMFError("Unknown bit rate string")
                  
+def _duration_convert(duration_str):
+    """
+    Converts a mediainfo duration like '1h 23mn' or '1 h 23 min 45 s' to
+    seconds, returns None for unknown formats
+    """
+    duration = 0.0
+    units = {"h": 3600, "mn": 60, "min": 60, "s": 1, "ms": 0.001}
+    tokens = re.findall(r'([0-9.]+) ?(ms|mn|min|h|s)(?![a-z])', duration_str)
+    if len(tokens) == 0:
+        return None
+    for (value, unit) in tokens:
+        duration += float(value) * units[unit]
+    return duration
+
+def _json_int(value_str):
+    """Converts a raw mediainfo value like '4113' or '4113-1' to an int"""
+    match = re.match(r'[0-9]+', value_str)
+    if match is None:
+        raise errors.MMFError("Unknown integer value '%s'" % value_str)
+    return int(match.group(0))
+
+def _json_bit_rate(value_str):
+    """Converts a raw mediainfo bit rate in bps to Kbps"""
+    return int(_float_to_str_trunc(float(value_str) / 1000))
+
+def _json_codec_id(codec_id):
+    """
+    Converts a codec ID to the form of the text output, which leaves out the
+    AAC object type that the JSON output adds to Matroska AAC ('A_AAC-2')
+    """
+    if codec_id is not None and re.match(r'^A_AAC-[0-9]+$', codec_id):
+        return "A_AAC"
+    return codec_id
+
+def _parse_json_media(media):
+    """
+    Converts a single 'media' object from mediainfo's JSON output to a field
+    dict as returned by VidParser.get_fields()
+    """
+    fields = {"version": PROBE_VERSION}
+    video_track = None
+    audio_track = None
+    for track in media.get("track", []):
+        if track.get("@type") == "General" and "Duration" in track:
+            fields["duration"] = float(track["Duration"])
+        elif track.get("@type") == "Video" and video_track is None:
+            video_track = track
+        elif track.get("@type") == "Audio" and audio_track is None:
+            audio_track = track
+
+    if video_track is not None:
+        fields["_vid_format"] = video_track.get("Format")
+        fields["_vid_codec_id"] = video_track.get("CodecID")
+        if "Format_Profile" in video_track:
+            # Matches the text output: "High@L4.1" for H.264 but
+            # "Main@Main" for MPEG-2, whose levels are names
+            level = video_track.get("Format_Level")
+            if level is not None and re.match(r'[0-9.]+$', level):
+                fields["vid_format_profile"] = (
+                    video_track["Format_Profile"] + "@L" + level)
+            elif level is not None:
+                fields["vid_format_profile"] = (
+                    video_track["Format_Profile"] + "@" + level)
+            else:
+                fields["vid_format_profile"] = video_track["Format_Profile"]
+        if "ID" in video_track:
+            fields["vid_stream_id"] = _json_int(video_track["ID"])
+        if video_track.get("ScanType") in ("Interlaced", "MBAFF"):
+            fields["vid_interlaced"] = True
+        elif video_track.get("ScanType") == "Progressive":
+            fields["vid_interlaced"] = False
+        if "Width" in video_track:
+            fields["vid_width"] = _json_int(video_track["Width"])
+        if "Height" in video_track:
+            fields["vid_height"] = _json_int(video_track["Height"])
+        if "BitRate" in video_track:
+            fields["vid_bitrate"] = _json_bit_rate(video_track["BitRate"])
+        elif "BitRate_Nominal" in video_track:
+            fields["vid_bitrate"] = _json_bit_rate(
+                video_track["BitRate_Nominal"])
+        if "FrameRate" in video_track:
+            fields["vid_fps"] = float(video_track["FrameRate"])
+
+    if audio_track is not None:
+        fields["audio_format"] = audio_track.get("Format")
+        fields["audio_codec_id"] = _json_codec_id(audio_track.get("CodecID"))
+        if "ID" in audio_track:
+            fields["audio_stream_id"] = _json_int(audio_track["ID"])
+        if "BitRate" in audio_track:
+            fields["audio_bitrate"] = _json_bit_rate(audio_track["BitRate"])
+        if "SamplingRate" in audio_track:
+            fields["audio_samplerate"] = int(_float_to_str_trunc(
+                float(audio_track["SamplingRate"])))
+        if "Channels" in audio_track:
+            fields["audio_channels"] = _json_int(audio_track["Channels"])
+
+    return fields
+
+def _probe_json(file_list):
+    """
+    Runs a single mediainfo process with JSON output over the given files and
+    returns a list of field dicts in the same order, or None if this
+    mediainfo doesn't support JSON output
+    """
+    mp = procgraph.run_capture("mediainfo",
+                               ['mediainfo', '--Output=JSON'] + file_list,
+                               timeout = _PROBE_TIMEOUT * len(file_list))
+    try:
+        mp_json = json.loads(mp.output)
+    except ValueError:
+        return None
+
+    # A single file results in a bare object instead of a list
+    if not isinstance(mp_json, list):
+        mp_json = [mp_json]
+    media_list = [entry.get("media", {}) for entry in mp_json]
+
+    # Match results to inputs by reference, falling back to output order
+    media_by_ref = {}
+    for media in media_list:
+        media_by_ref[media.get("@ref")] = media
+    if all(file_name in media_by_ref for file_name in file_list):
+        media_list = [media_by_ref[file_name] for file_name in file_list]
+    elif len(media_list) != len(file_list):
+        raise errors.MMFError(
+            "mediainfo returned %d results for %d files" %
+            (len(media_list), len(file_list)))
+
+    fields_list = []
+    for media in media_list:
+        try:
+            fields_list.append(_parse_json_media(media))
+        except (errors.MMFError, ValueError, TypeError, AttributeError):
+            # VidParser() probes this one on its own
+            fields_list.append(None)
+    return fields_list
+
+def is_media_file(file_name):
+    """Returns whether a file name has one of MEDIA_EXTENSIONS"""
+    return os.path.splitext(file_name)[1].lower() in MEDIA_EXTENSIONS
+
+def probe_batch_results(file_list, cache = None, batch_size = _BATCH_SIZE):
+    """
+    Returns a (VidParser, None) or (None, MMFError) tuple for each of the
+    given files, probing all files that miss the cache with one mediainfo run
+    per batch_size files using mediainfo's JSON output. Falls back to probing
+    files one at a time if mediainfo is too old to support JSON output. A
+    file that fails to probe doesn't affect the others.
+    """
+    fields_list = [None] * len(file_list)
+    probe_idx_list = []
+    probe_idx_set = set()
+    for idx, file_name in enumerate(file_list):
+        if not os.path.isfile(file_name):
+            # Left to VidParser() to report
+            continue
+        if cache is not None:
+            fields = cache.lookup(file_name)
+            if fields is not None and fields.get("version") == PROBE_VERSION:
+                fields_list[idx] = fields
+                continue
+        probe_idx_list.append(idx)
+        probe_idx_set.add(idx)
+
+    for batch_start in range(0, len(probe_idx_list), batch_size):
+        batch_idx_list = probe_idx_list[batch_start:batch_start + batch_size]
+        try:
+            batch_fields = _probe_json([file_list[idx]
+                                        for idx in batch_idx_list])
+        except errors.MMFError:
+            # e.g. a timeout or results that can't be matched to the files,
+            # VidParser() probes these individually and reports the failures
+            continue
+        if batch_fields is None:
+            # No JSON support, VidParser() will probe these individually
+            break
+        for (idx, fields) in zip(batch_idx_list, batch_fields):
+            fields_list[idx] = fields
+
+    results = []
+    for (idx, file_name) in enumerate(file_list):
+        # Freshly probed (or no JSON support) files fill the cache with
+        # the result
+        file_cache = cache if idx in probe_idx_set else None
+        try:
+            results.append((VidParser(file_name, file_cache,
+                                      fields_list[idx]), None))
+        except errors.MMFError as e:
+            results.append((None, e))
+        except Exception as e:
+            results.append((None, errors.MMFError(
+                "Failed to parse '%s': %s" % (file_name, e))))
+    return results
+
+def probe_batch(file_list, cache = None, batch_size = _BATCH_SIZE):
+    """
+    Returns a list of VidParser objects for the given files, probed as by
+    probe_batch_results(). Raises the error of the first file that fails.
+    """
+    parser_list = []
+    for (parser, error) in probe_batch_results(file_list, cache, batch_size):
+        if error is not None:
+            raise error
+        parser_list.append(parser)
+    return parser_list
+
 class VidParser:
     """Video file parser class using mediainfo"""
 
@@ -63,8 +294,15 @@ class VidParser:
     VIDEO_SECTION = 1
     AUDIO_SECTION = 2
     TEXT_SECTION = 3
+    GENERAL_SECTION = 4
         
-    def __init__(self, input_file_name):
+    def __init__(self, input_file_name, cache = None, fields = None):
+        """
+        Parses the given file with mediainfo. If a probe cache is given it is
+        consulted first and the mediainfo run is skipped on a hit. Callers
+        that already have the parsed fields (e.g. from a batch probe) can
+        pass them in directly instead.
+        """
         self.vid_stream_id = None
         self.vid_format_profile = None
         self.vid_codec = None
@@ -83,6 +321,8 @@ class VidParser:
         self.audio_bitrate = None
         self.audio_samplerate = None
 
+        self.duration = None
+
         self.diff_str = None        
     
         if not os.path.isfile(input_file_name):
@@ -90,20 +330,51 @@ class VidParser:
                                   input_file_name);
 
         self.input_file_name = input_file_name
+
+        cache_hit = False
+        if fields is None and cache is not None:
+            fields = cache.lookup(input_file_name)
+            if fields is not None and fields.get("version") != PROBE_VERSION:
+                fields = None
+            cache_hit = fields is not None
+
+        if fields is not None:
+            self._load_fields(fields)
+        else:
+            mp = procgraph.run_capture("mediainfo",
+                                       ['mediainfo',
+                                        "".join(input_file_name)],
+                                       timeout = _PROBE_TIMEOUT)
+            self._parse_text(mp.output)
+
+        self._set_codec()
+                
+        try:
+            self._validate()
+        except errors.MMFError:
+            raise
+
+        if cache is not None and not cache_hit:
+            cache.store(input_file_name, self.get_fields())
+
+    def _parse_text(self, mp_output):
+        """Parses mediainfo's default human readable output"""
         current_section = VidParser.INVALID_SECTION
         
-        mp = subprocess.Popen(['mediainfo', "".join(input_file_name)],
-                              stdout=subprocess.PIPE)
-        mp_output = mp.communicate()
-        
-        mp_tokenized = mp_output[0].split("\n")
+        mp_tokenized = mp_output.split("\n")
         for mp_line in mp_tokenized:
-            if mp_line == "Video":
+            if mp_line == "General":
+                current_section = VidParser.GENERAL_SECTION
+            elif mp_line == "Video":
                 current_section = VidParser.VIDEO_SECTION
             elif mp_line == "Audio" or mp_line == "Audio #1":
                 current_section = VidParser.AUDIO_SECTION
             elif mp_line == "Text":
                 current_section = VidParser.TEXT_SECTION
+            elif current_section == VidParser.GENERAL_SECTION:
+                if mp_line.startswith("Duration  ") and self.duration is None:
+                    self.duration = _duration_convert(
+                        _get_field_value(mp_line))
             elif current_section == VidParser.VIDEO_SECTION:
                 if mp_line.startswith("Format  "):
                     self._vid_format = _get_field_value(mp_line)
@@ -150,13 +421,21 @@ class VidParser:
                         _field_collapse_thousands(audio_bit_rate_str)))
                 elif mp_line.startswith("Sampling rate "):
                     audio_sample_rate_str = _get_field_value(mp_line)
+                    audio_sample_rate_tokenized = _tokenize_field(
+                        audio_sample_rate_str)
+                    audio_sample_rate = float(audio_sample_rate_tokenized[0])
+                    if (len(audio_sample_rate_tokenized) > 1 and
+                        audio_sample_rate_tokenized[1] == "KHz"):
+                        audio_sample_rate *= 1000
                     self.audio_samplerate = int(_float_to_str_trunc(
-                        float(_tokenize_field(audio_sample_rate_str)[0])))
+                        audio_sample_rate))
                 elif mp_line.startswith("Channel(s)"):
                     audio_channel_str = _get_field_value(mp_line)
                     self.audio_channels = int(_tokenize_field(
                         audio_channel_str)[0])
 
+    def _set_codec(self):
+        """Derives the video codec from the parsed codec ID and format"""
         if (self._vid_codec_id == "avc1" or
             self._vid_codec_id == "V_MPEG4/ISO/AVC" or
             self._vid_format == "AVC" or
@@ -172,11 +451,18 @@ class VidParser:
             self.vid_codec = VIDEO_CODEC_VC1
         elif self._vid_codec_id == "XVID":
             self.vid_codec = VIDEO_CODEC_XVID
-                
-        try:
-            self._validate()
-        except errors.MMFError:
-            raise
+
+    def get_fields(self):
+        """Returns the parsed fields as a dict suitable for caching"""
+        fields = {"version": PROBE_VERSION}
+        for field in PARSED_FIELDS:
+            fields[field] = getattr(self, field)
+        return fields
+
+    def _load_fields(self, fields):
+        """Sets parsed fields from a dict returned by get_fields()"""
+        for field in PARSED_FIELDS:
+            setattr(self, field, fields.get(field))
 
     def _validate(self):
         if self.vid_fps is None:
@@ -258,6 +544,7 @@ class VidParser:
 
     def __repr__(self):
         retStr = "\nInput file: %s\n" % self.input_file_name
+        retStr += "Duration: %s\n" % str(self.duration)
         retStr += "\nVideo:\n"
         retStr += "\tStream ID: %s\n" % str(self.vid_stream_id)
         retStr += "\tFormat profile: %s\n" % self.vid_format_profile
@@ -278,5 +565,9 @@ class VidParser:
 
 if __name__ == "__main__":
     import sys
-    testParser = VidParser(sys.argv[1])
-    print testParser
+    if len(sys.argv) > 2:
+        for testParser in probe_batch(sys.argv[1:]):
+            print testParser
+    else:
+        testParser = VidParser(sys.argv[1])
+        print testParser